@@ -1,14 +1,78 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.util import unquote
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.http import Http404, HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.utils.encoding import force_text
 
-from cuff.models import Replicate, RunInfo, Experiment, ExpStat
+from cuff.models import (Replicate, RunInfo, Experiment, ExpStat, ImportStep, ImportProfile,
+    Annotation)
+from cuff.purge import purge_experiment
 
 admin.autodiscover()
 
 class ExperimentAdmin(admin.ModelAdmin):
+    '''
+    Experiments are deleted with `cuff.purge`, the cascade collector
+    of the stock delete view and action loads all the related rows.
+    '''
     list_display = ('run_date', 'analysis_date', 'title', 'species',
-        'library', 'description')
+        'library', 'description', 'archived')
     date_hierarchy = 'run_date'
-    list_filter = ('species', 'library',)
+    list_filter = ('species', 'library', 'archived',)
+    actions = ['purge_experiments']
+
+    def get_actions(self, request):
+        actions = super(ExperimentAdmin, self).get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
+
+    def purge_experiments(self, request, queryset):
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        for exp in queryset:
+            self.log_deletion(request, exp, force_text(exp))
+            purge_experiment(exp)
+        self.message_user(request, 'Deleted {num} experiments.'.format(num=len(queryset)),
+            messages.SUCCESS)
+    purge_experiments.short_description = 'Delete selected experiments'
+
+    def delete_model(self, request, obj):
+        purge_experiment(obj)
+
+    def delete_view(self, request, object_id, extra_context=None):
+        '''
+        The stock delete view without the list of related objects.
+        '''
+        opts = self.model._meta
+        obj = self.get_object(request, unquote(object_id))
+        if not self.has_delete_permission(request, obj):
+            raise PermissionDenied
+        if obj is None:
+            raise Http404('Experiment with primary key {0} does not exist.'.format(object_id))
+        if request.POST:
+            obj_display = force_text(obj)
+            self.log_deletion(request, obj, obj_display)
+            self.delete_model(request, obj)
+            self.message_user(request, 'The experiment "{0}" was deleted successfully.'.format(
+                obj_display), messages.SUCCESS)
+            return HttpResponseRedirect(reverse('admin:cuff_experiment_changelist',
+                current_app=self.admin_site.name))
+        context = {
+            'title': 'Are you sure?',
+            'object_name': force_text(opts.verbose_name),
+            'object': obj,
+            'deleted_objects': [force_text(obj), ['All its tracks, data, features and '
+                'import records']],
+            'perms_lacking': False,
+            'protected': False,
+            'opts': opts,
+            'app_label': opts.app_label,
+            }
+        context.update(extra_context or {})
+        return TemplateResponse(request, 'admin/delete_confirmation.html', context,
+            current_app=self.admin_site.name)
 
 admin.site.register(Experiment, ExperimentAdmin)
 
@@ -33,3 +97,26 @@ class ExpStatAdmin(admin.ModelAdmin):
         'splicing_count', 'isoform_count', 'cds_count', 'relcds_count',)
 
 admin.site.register(ExpStat, ExpStatAdmin)
+
+class AnnotationAdmin(admin.ModelAdmin):
+    model = Annotation
+    list_display = ('gene_short_name', 'nearest_ref_id', 'locus',)
+    search_fields = ('gene_short_name', 'nearest_ref_id',)
+
+admin.site.register(Annotation, AnnotationAdmin)
+
+class ImportStepAdmin(admin.ModelAdmin):
+    model = ImportStep
+    list_display = ('experiment', 'name', 'status', 'rows', 'size',
+        'started', 'finished', 'wall_time', 'rate', 'peak_rss',)
+    list_filter = ('experiment', 'status',)
+
+admin.site.register(ImportStep, ImportStepAdmin)
+
+class ImportProfileAdmin(admin.ModelAdmin):
+    model = ImportProfile
+    list_display = ('experiment', 'created', 'host', 'options', 'wall_time',
+        'rows', 'peak_rss',)
+    list_filter = ('experiment', 'host',)
+
+admin.site.register(ImportProfile, ImportProfileAdmin)
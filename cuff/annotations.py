@@ -0,0 +1,96 @@
+'''
+Shared reference annotation dictionary.
+
+Every experiment imports the same reference genes again, so the
+annotation of the tracks (gene_short_name for a nearest_ref_id and
+locus) is kept once in the Annotation table and the tracks reference it
+by integer id instead of carrying the columns. `import_exp` maps every
+batch of tracks with an AnnotationDictionary:
+
+    >>> annotations = AnnotationDictionary()
+    >>> tracks = annotations.annotate(tracks)
+
+The missing annotations are inserted in bulk with the vendor's "insert
+or ignore" statement (see `cuff.loaders.insert_ignore`), so parallel
+import steps (and imports) adding the same annotation don't fail, and
+the first imported name of an annotation is kept. The ids of the
+annotations a batch needs are then read by their keys, so that rows
+committed by the other import processes in any order are found.
+Annotations are never deleted, the dictionary only grows.
+'''
+import pandas as pd
+
+from django.db import connection as default_connection
+from django.utils.encoding import force_text
+
+from cuff.loaders import insert_ignore
+from cuff.models import Annotation
+
+# Columns identifying an annotation
+KEY = ('nearest_ref_id', 'locus',)
+COLUMNS = KEY + ('gene_short_name',)
+# Number of annotations looked up at once, two query parameters each
+LOOKUP_SIZE = 400
+
+
+def _keys(frame):
+    # Text, as read from the database
+    return [tuple(force_text(v) for v in key) for key in zip(*[frame[c] for c in KEY])]
+
+
+class AnnotationDictionary(object):
+    '''
+    Primary keys of the annotations by (nearest_ref_id, locus), read
+    from the database as needed.
+    '''
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+        self.ids = {}
+
+    def lookup(self, keys):
+        '''
+        Reads the ids of the annotations with the (nearest_ref_id,
+        locus) `keys`.
+        '''
+        keys = list(keys)
+        annotations = Annotation.objects.using(self.connection.alias)
+        for start in range(0, len(keys), LOOKUP_SIZE):
+            chunk = set(keys[start:start + LOOKUP_SIZE])
+            # Superset of the chunk, filtered here
+            rows = annotations.filter(
+                nearest_ref_id__in=set(ref for ref, locus in chunk),
+                locus__in=set(locus for ref, locus in chunk)).values_list('pk', *KEY)
+            for row in rows:
+                if row[1:] in chunk:
+                    self.ids[row[1:]] = row[0]
+
+    def upsert(self, tracks):
+        '''
+        Adds the missing annotations of `tracks` (DataFrame with the
+        COLUMNS) and returns their primary keys as a Series aligned
+        with `tracks`. Tracks without a reference id or locus get None.
+        '''
+        if not all(c in tracks for c in COLUMNS):
+            return pd.Series(None, index=tracks.index, dtype=object)
+        frame = tracks[list(COLUMNS)]
+        frame = frame[frame[list(KEY)].notnull().all(axis=1)]
+        keys = _keys(frame)
+        self.lookup(set(key for key in keys if key not in self.ids))
+        missing = frame[[key not in self.ids for key in keys]].drop_duplicates(list(KEY))
+        if len(missing):
+            insert_ignore(Annotation, COLUMNS, [tuple(None if pd.isnull(v) else v
+                for v in row) for row in missing.itertuples(index=False)], self.connection)
+            self.lookup(_keys(missing))
+            lost = sum(1 for key in _keys(missing) if key not in self.ids)
+            if lost:
+                raise ValueError('{0} annotations were neither inserted nor found'.format(lost))
+        return pd.Series([self.ids.get(key) for key in keys], index=frame.index,
+            dtype=object).reindex(tracks.index)
+
+    def annotate(self, tracks):
+        '''
+        Returns `tracks` with the annotation COLUMNS replaced by the
+        `annotation_id` column.
+        '''
+        tracks['annotation_id'] = self.upsert(tracks)
+        return tracks.drop([c for c in COLUMNS if c in tracks], axis=1)
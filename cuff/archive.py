@@ -0,0 +1,269 @@
+'''
+Cold archival of experiments.
+
+Experiments which are rarely opened still fill the buffer pool and the
+backups. `archive_experiment` exports all the rows of an experiment to
+compressed NumPy archives on local disk, one per table and primary key
+range of BATCH_SIZE rows, so neither end holds more than a chunk of a
+table in memory:
+
+    <CUFF_ARCHIVE_DIR>/exp<pk>/<db_table>.<chunk>.npz
+        <attname>           values of the column (unicode for text and
+                            dates)
+        <attname>__null     True where the value is NULL, only for the
+                            columns with NULLs
+
+and deletes the rows (see `cuff.purge`), or drops the partitions of the
+experiment if the data tables are partitioned (see `cuff.partitions`).
+The Experiment and its ExpStat (and TableStat) rows stay behind,
+flagged `archived`, so the experiment is still listed with its track
+counts. `restore_experiment` loads the rows back with the bulk loaders,
+keeping their primary keys. Restoring takes a while, so the track and
+plot views don't do it in the request: they leave a request in the
+archive directory of the experiment and answer "restoring" until
+`archive_exp --queued` (run from cron) has restored it. The expression
+matrices (see `cuff.matrices`) are files already and stay where they
+are.
+'''
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from django.db import connection as default_connection, transaction
+
+from cuff.loaders import get_loader, LoaderUnavailable
+from cuff.models import Experiment, ExpStat, TableStat
+from cuff.partitions import get_partition_manager
+
+# Rows stay in the database
+KEEP = (Experiment, ExpStat, TableStat,)
+
+# Number of rows fetched from (loaded into) the database at once
+BATCH_SIZE = 100000
+
+# File left in the archive directory of an experiment to be restored
+RESTORE_REQUEST = 'restore.requested'
+
+TEXT_TYPES = ('CharField', 'TextField', 'DateField', 'DateTimeField', 'TimeField',)
+
+
+def get_root():
+    return getattr(settings, 'CUFF_ARCHIVE_DIR', None)
+
+
+def _exp_pk(exp):
+    return getattr(exp, 'pk', exp)
+
+
+def get_path(exp):
+    return os.path.join(get_root(), 'exp{0}'.format(_exp_pk(exp)))
+
+
+def archived_models(connection=None):
+    '''
+    Returns (model, scope) pairs of the archived tables, tables
+    referencing others first (see `cuff.purge.purge_order`).
+    '''
+    from cuff.purge import purge_order
+    return [(m, s) for m, s in purge_order(connection) if m not in KEEP]
+
+
+def _encode(field, values):
+    '''
+    Returns (values, nulls) arrays for the `field` column.
+    '''
+    nulls = np.array([v is None for v in values], dtype=bool)
+    kind = field.get_internal_type()
+    if kind in TEXT_TYPES:
+        return np.array([u'' if v is None else unicode(v) for v in values],
+            dtype=np.unicode_), nulls
+    if kind == 'FloatField':
+        dtype, fill = np.float64, np.nan
+    elif kind == 'BooleanField':
+        dtype, fill = bool, False
+    else:
+        dtype, fill = np.int64, 0
+    return np.array([fill if v is None else v for v in values], dtype=dtype), nulls
+
+
+def chunk_path(model, path, chunk):
+    return os.path.join(path, '{table}.{chunk:06d}.npz'.format(
+        table=model._meta.db_table, chunk=chunk))
+
+
+def table_chunks(model, path):
+    '''
+    Returns the archive files of the `model` table in directory `path`
+    in primary key order.
+    '''
+    prefix = '{0}.'.format(model._meta.db_table)
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))
+        if name.startswith(prefix) and name.endswith('.npz')
+        and name[len(prefix):-len('.npz')].isdigit()]
+
+
+def write_table(model, scope, exp_pk, path, connection=None):
+    '''
+    Writes the `model` rows of experiment `exp_pk` selected by `scope`
+    to directory `path`, a file per BATCH_SIZE rows. Returns the number
+    of rows, nothing is written for none.
+    '''
+    connection = connection or default_connection
+    qn = connection.ops.quote_name
+    fields = model._meta.fields
+    pk = model._meta.pk
+    pk_index = fields.index(pk)
+    select = ('SELECT {columns} FROM {table} WHERE {scope} AND {pk} > %s '
+        'ORDER BY {pk} LIMIT %s').format(
+        columns=', '.join(qn(f.column) for f in fields),
+        table=qn(model._meta.db_table), scope=scope, pk=qn(pk.column))
+    written = chunk = 0
+    last_pk = 0
+    while True:
+        cursor = connection.cursor()
+        cursor.execute(select, [exp_pk, last_pk, BATCH_SIZE])
+        rows = cursor.fetchall()
+        if not rows:
+            return written
+        last_pk = rows[-1][pk_index]
+        arrays = {}
+        for field, values in zip(fields, zip(*rows)):
+            arrays[field.attname], nulls = _encode(field, values)
+            if nulls.any():
+                arrays['{0}__null'.format(field.attname)] = nulls
+        np.savez_compressed(chunk_path(model, path, chunk), **arrays)
+        written += len(rows)
+        chunk += 1
+
+
+def read_table(model, path):
+    '''
+    Returns the rows archived in file `path` as a DataFrame with `model`
+    attribute names as columns and None for NULLs.
+    '''
+    with np.load(path) as archive:
+        columns = [f.attname for f in model._meta.fields if f.attname in archive.files]
+        frame = pd.DataFrame(dict((c, archive[c]) for c in columns), columns=columns)
+        for column in columns:
+            nulls = '{0}__null'.format(column)
+            if nulls in archive.files:
+                frame[column] = frame[column].astype(object).where(~archive[nulls], None)
+    return frame
+
+
+def archive_experiment(exp, connection=None, batch_size=None, progress=None):
+    '''
+    Archives experiment `exp` (instance or pk): writes its rows to the
+    archive, flags it archived and deletes the rows. An experiment
+    flagged already only gets the rows left by an interrupted run
+    deleted. Returns {model: number of archived rows}.
+    '''
+    from cuff.purge import purge_table, BATCH_SIZE as PURGE_BATCH_SIZE
+    connection = connection or default_connection
+    exp = Experiment.objects.using(connection.alias).get(pk=_exp_pk(exp))
+    archived = {}
+    if not exp.archived:
+        path = get_path(exp)
+        tmp = '{0}.tmp{1}'.format(path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for model, scope in archived_models(connection):
+            archived[model] = write_table(model, scope, exp.pk, tmp, connection)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        Experiment.objects.using(connection.alias).filter(pk=exp.pk).update(archived=True)
+    partitions = get_partition_manager(connection)
+    if partitions is not None:
+        partitions.drop_partitions(exp.pk)
+    for model, scope in archived_models(connection):
+        purge_table(model, scope, exp.pk, connection, batch_size or PURGE_BATCH_SIZE, progress)
+    return archived
+
+
+def restore_experiment(exp, connection=None, loader='native'):
+    '''
+    Loads the rows of archived experiment `exp` (instance or pk) back
+    into the database in a single transaction and removes the archive.
+    Does nothing if the experiment is not archived. Returns {model:
+    number of restored rows}.
+    '''
+    from cuff.purge import purge_table
+    connection = connection or default_connection
+    exp_pk = _exp_pk(exp)
+    partitions = get_partition_manager(connection)
+    if partitions is not None:
+        # DDL, MySQL would commit the transaction below
+        partitions.create_partitions(exp_pk)
+    restored = {}
+    with transaction.atomic(using=connection.alias):
+        # Concurrent restores wait for the first one
+        exp = Experiment.objects.using(connection.alias).select_for_update().get(pk=exp_pk)
+        if not exp.archived:
+            return restored
+        if not os.path.isdir(get_path(exp)):
+            raise IOError('Archive of experiment {pk} is missing: {path}'.format(
+                pk=exp.pk, path=get_path(exp)))
+        writer = get_loader(loader, connection)
+        models = archived_models(connection)
+        for model, scope in models:
+            # Rows left by an interrupted archive_experiment
+            purge_table(model, scope, exp.pk, connection)
+        for model, scope in reversed(models):
+            for path in table_chunks(model, get_path(exp)):
+                batch = read_table(model, path)
+                try:
+                    count = writer.load(model, batch)
+                except LoaderUnavailable:
+                    writer = get_loader('orm', connection)
+                    count = writer.load(model, batch)
+                restored[model] = restored.get(model, 0) + count
+        Experiment.objects.using(connection.alias).filter(pk=exp.pk).update(archived=False)
+    delete_archive(exp)
+    return restored
+
+
+def request_restore(exp):
+    '''
+    Queues archived experiment `exp` for `restore_queued`. Returns False
+    if its archive is missing.
+    '''
+    path = get_path(exp)
+    if not os.path.isdir(path):
+        return False
+    open(os.path.join(path, RESTORE_REQUEST), 'a').close()
+    return True
+
+
+def restore_queued(connection=None, loader='native'):
+    '''
+    Restores the experiments queued by `request_restore`, oldest request
+    first. Returns {exp_pk: {model: number of restored rows}}.
+    '''
+    root = get_root()
+    if not root or not os.path.isdir(root):
+        return {}
+    requests = []
+    for name in os.listdir(root):
+        request = os.path.join(root, name, RESTORE_REQUEST)
+        if name.startswith('exp') and name[3:].isdigit() and os.path.exists(request):
+            requests.append((os.path.getmtime(request), int(name[3:])))
+    restored = {}
+    for mtime, exp_pk in sorted(requests):
+        restored[exp_pk] = restore_experiment(exp_pk, connection, loader)
+    return restored
+
+
+def delete_archive(exp):
+    '''
+    Removes the archive of experiment `exp`.
+    '''
+    if not get_root():
+        return
+    path = get_path(exp)
+    if os.path.exists(path):
+        shutil.rmtree(path)
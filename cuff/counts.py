@@ -0,0 +1,167 @@
+'''
+Row counts of the track views.
+
+An exact COUNT(*) of a filtered data table (`icontains` filters can't
+use an index) often costs more than reading the page itself. The track
+views get their counts here instead, cheapest first:
+
+    no filters          the total of the table in the experiment,
+                        counted once and kept in TableStat
+    filters, cached     the count of the same filters within
+                        CUFF_COUNT_CACHE_TTL seconds (Django cache)
+    up to `threshold`   COUNT(*), cheap for small result sets
+    more rows           the query planner estimate ("about 1.2M") on
+                        MySQL and PostgreSQL, "more than <threshold>"
+                        elsewhere
+
+CUFF_TRACK_COUNTS = False (see `ngs/settings.py`) skips counting
+altogether, the views then only link to the next and previous pages.
+'''
+import hashlib, json
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from cuff.loaders import insert_ignore
+from cuff.models import TableStat
+
+# Default CUFF_COUNT_CACHE_TTL, seconds
+CACHE_TTL = 600
+
+
+class RowCount(object):
+    '''
+    Number of rows, `exact` or an estimate (a lower bound if
+    `at_least`).
+    '''
+    def __init__(self, value, exact=True, at_least=False):
+        self.value = value
+        self.exact = exact
+        self.at_least = at_least
+
+    def __unicode__(self):
+        if self.exact:
+            return '{0:,}'.format(self.value)
+        if self.at_least:
+            return 'more than {0:,}'.format(self.value)
+        return 'about {0}'.format(_round(self.value))
+
+
+def _round(value):
+    '''
+    Formats `value` to about two significant digits, e.g. 1.2M.
+    '''
+    for limit, suffix in ((10 ** 9, 'G'), (10 ** 6, 'M'), (10 ** 3, 'k'), (1, '')):
+        if value >= limit:
+            value = float(value) / limit
+            return ('{0:.0f}' if value >= 10 else '{0:.1f}').format(value) + suffix
+    return '0'
+
+
+def counts_enabled():
+    return getattr(settings, 'CUFF_TRACK_COUNTS', True)
+
+
+def get_total(model, exp):
+    '''
+    Returns the number of `model` rows of the experiment `exp`, counted
+    on the first call.
+    '''
+    table = model._meta.db_table
+    rows = TableStat.objects.filter(experiment=exp, table=table).order_by().values_list(
+        'rows', flat=True)
+    if rows:
+        return rows[0]
+    total = model._default_manager.for_exp(exp).count()
+    # Views counting the same table at the same time
+    insert_ignore(TableStat, ('experiment_id', 'table', 'rows'), [(exp.pk, table, total)])
+    return total
+
+
+def _estimate_mysql(cursor, sql, params):
+    cursor.execute('EXPLAIN ' + sql, params)
+    columns = [c[0] for c in cursor.description]
+    estimate = 1.0
+    for row in cursor.fetchall():
+        row = dict(zip(columns, row))
+        estimate *= (row.get('rows') or 1) * (row.get('filtered') or 100) / 100.0
+    return int(estimate)
+
+
+def _estimate_postgresql(cursor, sql, params):
+    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+    plan = cursor.fetchone()[0]
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+ESTIMATORS = {
+    'mysql': _estimate_mysql,
+    'postgresql': _estimate_postgresql,
+    }
+
+
+def estimate(queryset):
+    '''
+    Returns the query planner estimate of the number of rows of
+    `queryset`, None if the database doesn't have one.
+    '''
+    connection = connections[queryset.db]
+    estimator = ESTIMATORS.get(connection.vendor)
+    if estimator is None:
+        return None
+    sql, params = queryset.order_by().query.get_compiler(using=queryset.db).as_sql()
+    return estimator(connection.cursor(), sql, params)
+
+
+def _cache_key(model, exp, filters, region):
+    digest = hashlib.md5(json.dumps([sorted((k, v) for k, v in filters.items()), region],
+        default=unicode)).hexdigest()
+    return 'cuff.count.{exp}.{table}.{digest}'.format(exp=exp.pk,
+        table=model._meta.db_table, digest=digest)
+
+
+def count_rows(queryset, exp, filters, region='', threshold=10000):
+    '''
+    Returns the RowCount of `queryset`, the rows of experiment `exp`
+    matching `filters` (lookup: value) and `region`.
+    '''
+    model = queryset.model
+    if not filters and not region:
+        return RowCount(get_total(model, exp))
+    key = _cache_key(model, exp, filters, region)
+    count = cache.get(key)
+    if count is None:
+        if queryset.order_by().values_list('pk')[threshold:threshold + 1].exists():
+            rows = estimate(queryset)
+            count = RowCount(threshold, exact=False, at_least=True) if rows is None else \
+                RowCount(max(rows, threshold), exact=False)
+        else:
+            count = RowCount(queryset.count())
+        cache.set(key, count, getattr(settings, 'CUFF_COUNT_CACHE_TTL', CACHE_TTL))
+    return count
+
+
+class CountedQuerySet(object):
+    '''
+    Queryset with a known number of rows, so that the paginator doesn't
+    count them again.
+    '''
+    def __init__(self, queryset, count):
+        self.queryset = queryset
+        self.model = queryset.model
+        self._count = count
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(self.queryset)
+
+    def __getitem__(self, k):
+        return self.queryset[k]
@@ -1,6 +1,6 @@
 from django import forms
 
-from cuff.models import Sample
+from cuff.models import Sample, Comparison
 
 # Form field names are directly used to filter queryset in the view
 # Ugly but works for now.
@@ -46,6 +46,12 @@ class BaseReplicateDataFilterForm(forms.Form):
 
 
 class BaseExpDiffDataFilterForm(forms.Form):
+    # Limited to the comparisons of the experiment by the view
+    comparison__exact = forms.ModelChoiceField(required=False,
+        queryset=Comparison.objects.select_related('sample_1', 'sample_2'),
+        empty_label='comparison ...',
+        widget=forms.Select(attrs={
+            'class': 'input-medium',}))
     p_value__lte = forms.DecimalField(required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
@@ -54,14 +60,21 @@ class BaseExpDiffDataFilterForm(forms.Form):
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'q value max...'}))
-    significant = forms.CharField(required=False,
+    significant = forms.ChoiceField(required=False,
+        choices=(('', 'sig ...'), ('yes', 'yes'), ('no', 'no'),),
+        widget=forms.Select(attrs={
+            'class': 'input-mini',}))
+
+
+class RegionFilterMixin(forms.Form):
+    region = forms.CharField(max_length=100, required=False,
         widget=forms.TextInput(attrs={
-            'class': 'input-mini',
-            'placeholder': 'sig ...',}))
+            'class': 'input-medium',
+            'placeholder': 'chr:start-end...'}))
 
 
-class GeneTrackMixin(forms.Form):
-    gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class GeneTrackMixin(RegionFilterMixin):
+    gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -71,8 +84,8 @@ class GeneTrackMixin(forms.Form):
             'placeholder': 'gene id (XLOC)...'}))
 
 
-class TSSTrackMixin(forms.Form):
-    tss_group__gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class TSSTrackMixin(RegionFilterMixin):
+    tss_group__gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -82,8 +95,8 @@ class TSSTrackMixin(forms.Form):
             'placeholder': 'gene id (XLOC)...'}))
 
 
-class IsoformTrackMixin(forms.Form):
-    isoform__gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class IsoformTrackMixin(RegionFilterMixin):
+    isoform__gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -93,8 +106,8 @@ class IsoformTrackMixin(forms.Form):
             'placeholder': 'gene id (XLOC)...'}))
             
             
-class CDSTrackMixin(forms.Form):
-    cds__gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class CDSTrackMixin(RegionFilterMixin):
+    cds__gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -107,8 +120,8 @@ class CDSTrackMixin(forms.Form):
 #
 # Gene track forms
 #
-class GeneFilterForm(forms.Form):
-    gene_short_name = forms.CharField(max_length=45, required=False,
+class GeneFilterForm(RegionFilterMixin):
+    annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -145,8 +158,8 @@ class GeneExpDiffDataFilterForm(BaseExpDiffDataFilterForm, GeneTrackMixin):
 #
 # TSS track forms
 #
-class TSSFilterForm(forms.Form):
-    gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class TSSFilterForm(RegionFilterMixin):
+    gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -186,8 +199,8 @@ class TSSExpDiffDataFilterForm(BaseExpDiffDataFilterForm, TSSTrackMixin):
 #
 # Isoform track forms
 #
-class IsoformFilterForm(forms.Form):
-    gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class IsoformFilterForm(RegionFilterMixin):
+    gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -227,8 +240,8 @@ class IsoformExpDiffDataFilterForm(BaseExpDiffDataFilterForm, IsoformTrackMixin)
 #
 # CDS track forms
 #
-class CDSFilterForm(forms.Form):
-    gene__gene_short_name = forms.CharField(max_length=45, required=False,
+class CDSFilterForm(RegionFilterMixin):
+    gene__annotation__gene_short_name = forms.CharField(max_length=45, required=False,
         widget=forms.TextInput(attrs={
             'class': 'input-medium',
             'placeholder': 'gene short name...',}))
@@ -0,0 +1,177 @@
+'''
+Deferred index build for `import_exp --defer-indexes`.
+
+Maintaining the secondary indexes of the track and data tables row by
+row is what makes large imports slow. The index managers read the
+definitions of the secondary (non-unique) indexes from the database
+catalog so that they can be dropped before the import and rebuilt in
+one go at the end:
+
+    MySQLIndexes        -- indexes needed by foreign key constraints
+                           can't be dropped and are kept. Foreign key
+                           checks are switched off for the import
+                           connections instead; all indexes of a table
+                           are rebuilt with a single ALTER TABLE.
+    PostgreSQLIndexes   -- foreign keys are DEFERRABLE INITIALLY
+                           DEFERRED already, so only indexes are dropped
+    SQLiteIndexes
+
+Unique indexes (primary keys, (experiment, gene_id), ...) are never
+dropped, they are referenced by the foreign keys or keep the tracks of
+an experiment unique. `check_references` finds the rows referencing
+missing rows, which the database doesn't catch while the checks are off.
+'''
+import abc
+from collections import OrderedDict
+
+from django.db import connection as default_connection
+
+
+class IndexManager(object):
+    '''
+    Subclasses implement `get_indexes` for their database catalog.
+    '''
+    __metaclass__ = abc.ABCMeta
+    vendor = None
+
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def _execute(self, sql, params=()):
+        self.connection.cursor().execute(sql, params)
+
+    @abc.abstractmethod
+    def get_indexes(self, table):
+        '''
+        Returns (name, definition) pairs for the secondary indexes of
+        `table` which can be dropped.
+        '''
+
+    def drop_indexes(self, table, names):
+        qn = self.connection.ops.quote_name
+        for name in names:
+            self._execute('DROP INDEX {name}'.format(name=qn(name)))
+
+    def create_indexes(self, table, definitions):
+        for definition in definitions:
+            self._execute(definition)
+
+    def disable_constraints(self):
+        '''
+        Switches off foreign key checks for the current connection
+        where the database allows it.
+        '''
+        pass
+
+    def check_references(self, model, exp_pk=None):
+        '''
+        Returns (field name, number of rows) for every foreign key of
+        `model` with rows referencing missing rows. Only the rows of
+        experiment `exp_pk` are checked if the table has an
+        `experiment` column.
+        '''
+        qn = self.connection.ops.quote_name
+        fields = dict((f.name, f) for f in model._meta.fields)
+        where, params = '', []
+        if exp_pk is not None and 'experiment' in fields:
+            where = ' AND c.{0} = %s'.format(qn(fields['experiment'].column))
+            params = [exp_pk]
+        broken = []
+        for field in model._meta.fields:
+            if not field.rel:
+                continue
+            sql = ('SELECT COUNT(*) FROM {child} c WHERE c.{column} IS NOT NULL{where} '
+                'AND NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.{to} = c.{column})').format(
+                child=qn(model._meta.db_table),
+                column=qn(field.column),
+                where=where,
+                parent=qn(field.rel.to._meta.db_table),
+                to=qn(field.rel.get_related_field().column))
+            count = self._fetch(sql, params)[0][0]
+            if count:
+                broken.append((field.name, count))
+        return broken
+
+
+class MySQLIndexes(IndexManager):
+    vendor = 'mysql'
+
+    def get_indexes(self, table):
+        rows = self._fetch(
+            'SELECT INDEX_NAME, COLUMN_NAME FROM information_schema.STATISTICS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND NON_UNIQUE = 1 '
+            'ORDER BY INDEX_NAME, SEQ_IN_INDEX', [table])
+        fk_columns = set(c for c, in self._fetch(
+            'SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s '
+            'AND REFERENCED_TABLE_NAME IS NOT NULL', [table]))
+        indexes = OrderedDict()
+        for name, column in rows:
+            indexes.setdefault(name, []).append(column)
+        qn = self.connection.ops.quote_name
+        return [(name, 'INDEX {name} ({columns})'.format(name=qn(name),
+                columns=', '.join(qn(c) for c in columns)))
+            for name, columns in indexes.items() if columns[0] not in fk_columns]
+
+    def drop_indexes(self, table, names):
+        if names:
+            qn = self.connection.ops.quote_name
+            self._execute('ALTER TABLE {table} {drop}'.format(table=qn(table),
+                drop=', '.join('DROP INDEX {0}'.format(qn(n)) for n in names)))
+
+    def create_indexes(self, table, definitions):
+        # One pass over the table for all the indexes
+        if definitions:
+            self._execute('ALTER TABLE {table} {add}'.format(
+                table=self.connection.ops.quote_name(table),
+                add=', '.join('ADD {0}'.format(d) for d in definitions)))
+
+    def disable_constraints(self):
+        self._execute('SET foreign_key_checks = 0')
+
+
+class PostgreSQLIndexes(IndexManager):
+    vendor = 'postgresql'
+
+    def get_indexes(self, table):
+        return self._fetch(
+            'SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_index x '
+            'JOIN pg_class i ON i.oid = x.indexrelid '
+            'JOIN pg_class t ON t.oid = x.indrelid '
+            'WHERE t.relname = %s AND pg_table_is_visible(t.oid) '
+            'AND NOT x.indisunique AND NOT x.indisprimary '
+            'ORDER BY i.relname', [table])
+
+
+class SQLiteIndexes(IndexManager):
+    vendor = 'sqlite'
+
+    def get_indexes(self, table):
+        # Indexes backing UNIQUE constraints have no sql
+        return self._fetch(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+            "AND tbl_name = %s AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%%' "
+            "ORDER BY name", [table])
+
+
+INDEX_MANAGERS = {
+    'mysql': MySQLIndexes,
+    'postgresql': PostgreSQLIndexes,
+    'sqlite': SQLiteIndexes,
+    }
+
+
+def get_index_manager(connection=None):
+    '''
+    Returns the index manager for the database engine, None if there
+    is none.
+    '''
+    connection = connection or default_connection
+    if connection.vendor not in INDEX_MANAGERS:
+        return None
+    return INDEX_MANAGERS[connection.vendor](connection)
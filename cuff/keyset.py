@@ -0,0 +1,198 @@
+'''
+Keyset (seek) pagination of the track views.
+
+OFFSET paging makes the database read and throw away all the rows of
+the previous pages, so the late pages of the large data tables take
+longer and longer. Keyset pagination remembers the sort key of the last
+(or first) row shown instead and asks for the rows after (or before)
+it:
+
+    ORDER BY fpkm DESC, id DESC
+    WHERE fpkm < 12.5 OR (fpkm = 12.5 AND id < 31337)
+
+which is a single index range scan whatever the page. The sort key is
+the current `o=` ordering (or the default ordering of the model) with
+the primary key as the tie-breaker, and is passed around as an opaque
+cursor. Foreign keys are sorted by their key column rather than by the
+ordering of the related model, so the tables aren't joined. NULLs sort
+differently on every database, so nullable fields are sorted by an
+explicit `IS NULL` key first, which puts the NULLs last (first in
+descending order):
+
+    ORDER BY coverage IS NULL, coverage, id
+    WHERE coverage > 3.5 OR coverage IS NULL OR (coverage = 3.5 AND id > 42)
+
+Only orderings by related fields (`gene__gene_id`) can't be paged by
+keyset.
+'''
+import base64, json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+# Cursor directions
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class KeysetPage(object):
+    '''
+    Page of rows with the cursors of the adjacent pages (None if there
+    is no such page).
+    '''
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def get_sort_key(model, ordering):
+    '''
+    Returns the sort key for the `ordering` (order_by arguments) of the
+    `model` rows as a list of (field, descending) with the primary key
+    last, or None if it can't be used for keyset pagination (fields of
+    the related models).
+    '''
+    opts = model._meta
+    key = []
+    for name in ordering or opts.ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+        key.append((field, descending))
+        if field == opts.pk:
+            return key
+    # The direction of the last field, so that the whole key can be
+    # read off an index backwards
+    key.append((opts.pk, key[-1][1] if key else False))
+    return key
+
+
+def encode_cursor(direction, ordering, values):
+    return base64.urlsafe_b64encode(json.dumps([direction, list(ordering), values],
+        cls=DjangoJSONEncoder, separators=(',', ':'))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Returns (direction, ordering, values) of the `cursor`. Raises
+    ValueError if it is not a cursor.
+    '''
+    try:
+        direction, ordering, values = json.loads(base64.urlsafe_b64decode(
+            str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor {0!r}'.format(cursor))
+    if direction not in (NEXT, PREVIOUS) or not isinstance(values, list):
+        raise ValueError('Invalid cursor {0!r}'.format(cursor))
+    return direction, ordering, values
+
+
+def _order_by(queryset, key, reverse):
+    qn = connections[queryset.db].ops.quote_name
+    table = queryset.model._meta.db_table
+    select, order_by = {}, []
+    for field, descending in key:
+        column = '{0}.{1}'.format(table, qn(field.column))
+        sign = '-' if descending != reverse else ''
+        if field.null:
+            alias = 'keyset_null_{0}'.format(field.column)
+            select[alias] = '{0} IS NULL'.format(column)
+            order_by.append(sign + alias)
+        order_by.append(sign + column)
+    return queryset.extra(select=select, order_by=order_by)
+
+
+def _beyond(field, value, lookup):
+    '''
+    Returns the Q of the rows whose `field` is greater (`lookup` 'gt')
+    or less ('lt') than `value`, NULL being the greatest, or None if
+    there are no such rows.
+    '''
+    if value is None:
+        return Q(**{'{0}__isnull'.format(field.name): False}) if lookup == 'lt' else None
+    q = Q(**{'{0}__{1}'.format(field.name, lookup): value})
+    if field.null and lookup == 'gt':
+        q |= Q(**{'{0}__isnull'.format(field.name): True})
+    return q
+
+
+def _equal(field, value):
+    if value is None:
+        return Q(**{'{0}__isnull'.format(field.name): True})
+    return Q(**{field.name: value})
+
+
+def _seek(key, values, reverse):
+    '''
+    Returns the Q of the rows after `values` of the `key` (before them
+    if `reverse`).
+    '''
+    q = Q()
+    for i, (field, descending) in enumerate(key):
+        row = _beyond(field, values[i], 'lt' if descending != reverse else 'gt')
+        if row is None:
+            continue
+        for prev, value in zip(key[:i], values[:i]):
+            row &= _equal(prev[0], value)
+        q |= row
+    return q
+
+
+def paginate(queryset, ordering, cursor=None, per_page=100):
+    '''
+    Returns the KeysetPage of `queryset` (model instances or values()
+    of all the fields) sorted by `ordering` at `cursor` (the first page
+    if None), or None if the ordering can't be used for keyset
+    pagination. Raises ValueError if the cursor is invalid or was made
+    for another ordering.
+    '''
+    key = get_sort_key(queryset.model, ordering)
+    if key is None:
+        return None
+    direction, values = NEXT, None
+    if cursor:
+        direction, cursor_ordering, values = decode_cursor(cursor)
+        if cursor_ordering != list(ordering) or len(values) != len(key):
+            raise ValueError('Cursor {0!r} is for another ordering'.format(cursor))
+    reverse = direction == PREVIOUS
+    qs = _order_by(queryset, key, reverse)
+    if values is not None:
+        qs = qs.filter(_seek(key, values, reverse))
+    rows = list(qs[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows)
+
+    def cursor_at(row, direction):
+        if isinstance(row, dict):
+            # values() rows
+            values = [row[field.attname] for field, descending in key]
+        else:
+            values = [getattr(row, field.attname) for field, descending in key]
+        return encode_cursor(direction, ordering, values)
+
+    has_next = more if not reverse else True
+    has_previous = more if reverse else values is not None
+    return KeysetPage(rows,
+        next_cursor=cursor_at(rows[-1], NEXT) if has_next else None,
+        previous_cursor=cursor_at(rows[0], PREVIOUS) if has_previous else None)
@@ -0,0 +1,235 @@
+'''
+Bulk loaders used by `import_exp` to write reshaped DataFrames
+(see `cuff.reshape`) to the database.
+
+    OrmLoader           -- `bulk_create` through the Django ORM. Works
+                           everywhere but is the slowest.
+    MySQLLoader         -- LOAD DATA LOCAL INFILE from a staging .tsv
+    PostgreSQLLoader    -- COPY FROM STDIN from a staging .tsv
+    SQLiteLoader        -- executemany on the raw cursor
+
+`get_loader` picks the native loader for the configured database
+engine. Native loaders raise `LoaderUnavailable` if the database or its
+driver can't bulk load (MySQL server or client without `local_infile`
+support, PostgreSQL driver without COPY) so that the caller can fall
+back to the ORM. Any other error is raised as it is.
+
+`insert_ignore` adds rows to tables shared by the import steps (and
+imports), skipping the rows violating a unique constraint.
+`immediate_transactions` prepares a connection for writing alongside
+other processes (import_exp --jobs).
+'''
+import abc, csv, tempfile
+
+from django.db import connection as default_connection, DatabaseError
+
+
+# Escape sequences understood by both LOAD DATA and COPY text format.
+# Backslash has to go first.
+ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+# MySQL errors of a refused LOAD DATA LOCAL INFILE: not allowed by the
+# server (1148), rejected (2068) or disabled (3948) by the client
+LOAD_DATA_REFUSED = (1148, 2068, 3948)
+
+# Number of rows passed to executemany at once by `insert_ignore`
+INSERT_BATCH_SIZE = 10000
+
+INSERT_IGNORE = {
+    'mysql': 'INSERT IGNORE INTO {table} ({columns}) VALUES ({values})',
+    'postgresql': 'INSERT INTO {table} ({columns}) VALUES ({values}) ON CONFLICT DO NOTHING',
+    'sqlite': 'INSERT OR IGNORE INTO {table} ({columns}) VALUES ({values})',
+    }
+
+
+class LoaderUnavailable(Exception):
+    pass
+
+
+def _null_to_none(frame):
+    return frame.astype(object).where(frame.notnull(), None)
+
+
+class OrmLoader(object):
+    name = 'orm'
+
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+
+    def load(self, model, frame):
+        '''
+        Writes `frame` (DataFrame with model attribute names as
+        columns) to the `model` table and returns the number of rows.
+        '''
+        records = _null_to_none(frame).to_dict('records')
+        return len(model._default_manager.bulk_create([model(**rec) for rec in records]))
+
+
+class NativeLoader(OrmLoader):
+    '''
+    Base class for the loaders that bypass the ORM.
+    '''
+
+    def get_columns(self, model, frame):
+        '''
+        Returns (attname, db column) pairs for the columns of `frame`.
+        '''
+        columns = dict((f.attname, f.column) for f in model._meta.fields)
+        return [(c, columns[c]) for c in frame.columns]
+
+
+class StagingLoader(NativeLoader):
+    '''
+    Base class for the loaders reading the rows from a staging file.
+    Descendants implement `load_file`.
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def write_staging(self, frame, file):
+        '''
+        Writes `frame` to `file` as tab separated, backslash escaped
+        text with NULL as \\N.
+        '''
+        frame = frame.copy()
+        for column in frame.columns:
+            if frame[column].dtype == bool:
+                # MySQL doesn't take True/False for booleans
+                frame[column] = frame[column].astype(int)
+            elif frame[column].dtype == object:
+                for char, escaped in ESCAPES:
+                    frame[column] = frame[column].str.replace(char, escaped, regex=False)
+        # Nothing is left to quote after escaping, but csv insists on
+        # having a quotechar. Use one that can't occur anymore.
+        frame.to_csv(file, sep='\t', header=False, index=False,
+            na_rep='\\N', quoting=csv.QUOTE_NONE, quotechar='\n',
+            float_format='%r')
+        file.flush()
+        file.seek(0)
+
+    @abc.abstractmethod
+    def load_file(self, model, columns, file):
+        '''
+        Loads the staging `file` into the `columns` (db column names)
+        of the `model` table. Raises LoaderUnavailable if the database
+        can't load files.
+        '''
+
+    def load(self, model, frame):
+        if frame.empty:
+            return 0
+        columns = self.get_columns(model, frame)
+        with tempfile.NamedTemporaryFile(prefix='cuff-', suffix='.tsv') as staging:
+            self.write_staging(frame[[c for c, col in columns]], staging)
+            self.load_file(model, [col for c, col in columns], staging)
+        return len(frame)
+
+
+class MySQLLoader(StagingLoader):
+    '''
+    Requires `local_infile` to be enabled on the server and
+    `'OPTIONS': {'local_infile': 1}` in the database settings.
+    '''
+    name = 'mysql'
+
+    def load_file(self, model, columns, file):
+        qn = self.connection.ops.quote_name
+        sql = ("LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8 "
+            "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' ({columns})").format(
+            table=qn(model._meta.db_table),
+            columns=', '.join(qn(c) for c in columns))
+        try:
+            self.connection.cursor().execute(sql, [file.name])
+        except DatabaseError as e:
+            if e.args and e.args[0] in LOAD_DATA_REFUSED:
+                raise LoaderUnavailable('mysql loader is not available: {0}'.format(e))
+            raise
+
+
+class PostgreSQLLoader(StagingLoader):
+    name = 'postgresql'
+
+    def load_file(self, model, columns, file):
+        qn = self.connection.ops.quote_name
+        sql = 'COPY {table} ({columns}) FROM STDIN'.format(
+            table=qn(model._meta.db_table),
+            columns=', '.join(qn(c) for c in columns))
+        cursor = self.connection.cursor()
+        if not hasattr(cursor, 'copy_expert'):
+            raise LoaderUnavailable('postgresql loader is not available: '
+                'the database driver has no COPY support')
+        cursor.copy_expert(sql, file)
+
+
+class SQLiteLoader(NativeLoader):
+    '''
+    SQLite has no bulk loader, so rows are passed straight to
+    `executemany` without a staging file.
+    '''
+    name = 'sqlite'
+
+    def load(self, model, frame):
+        if frame.empty:
+            return 0
+        qn = self.connection.ops.quote_name
+        columns = self.get_columns(model, frame)
+        sql = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+            table=qn(model._meta.db_table),
+            columns=', '.join(qn(col) for c, col in columns),
+            values=', '.join(['%s'] * len(columns)))
+        rows = _null_to_none(frame[[c for c, col in columns]]).values.tolist()
+        self.connection.cursor().executemany(sql, rows)
+        return len(rows)
+
+
+def insert_ignore(model, columns, rows, connection=None):
+    '''
+    Inserts `rows` (tuples of values for the `columns` attribute names)
+    into the `model` table, skipping the ones which would violate a
+    unique constraint, e.g. rows inserted by a concurrent import.
+    '''
+    connection = connection or default_connection
+    qn = connection.ops.quote_name
+    fields = dict((f.attname, f.column) for f in model._meta.fields)
+    sql = INSERT_IGNORE.get(connection.vendor, INSERT_IGNORE['sqlite']).format(
+        table=qn(model._meta.db_table),
+        columns=', '.join(qn(fields[c]) for c in columns),
+        values=', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        cursor.executemany(sql, rows[start:start + INSERT_BATCH_SIZE])
+
+
+def immediate_transactions(connection=None):
+    '''
+    Makes the transactions of `connection` take the write lock as soon
+    as they begin. A SQLite transaction that has read can't start
+    writing while another process writes: SQLite fails it with
+    "database is locked" at once rather than waiting for the lock. The
+    other databases lock rows and are left alone.
+    '''
+    connection = connection or default_connection
+    if connection.vendor == 'sqlite':
+        # Django begins them with a plain (deferred) BEGIN
+        connection._start_transaction_under_autocommit = (
+            lambda: connection.cursor().execute('BEGIN IMMEDIATE'))
+
+
+NATIVE_LOADERS = {
+    'mysql': MySQLLoader,
+    'postgresql': PostgreSQLLoader,
+    'sqlite': SQLiteLoader,
+    }
+
+
+def get_loader(name='orm', connection=None):
+    '''
+    Returns a loader instance. `name` is either 'orm' or 'native'; the
+    latter picks the native loader matching the database engine and
+    falls back to the ORM for the engines without one.
+    '''
+    connection = connection or default_connection
+    if name == 'native':
+        return NATIVE_LOADERS.get(connection.vendor, OrmLoader)(connection)
+    return OrmLoader(connection)
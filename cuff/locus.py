@@ -0,0 +1,148 @@
+'''
+Genomic coordinates of the tracks.
+
+cuffdiff reports track loci as 'chr:start-end' strings. They are parsed
+at import into `chrom`, `chrom_start` and `chrom_end` columns together
+with the UCSC bin of the interval, so that tracks overlapping a region
+are found with a few index range scans:
+
+    chrom = 'chr2L' AND bin IN (<bins overlapping the region>)
+        AND chrom_start <= 2000000 AND chrom_end >= 1000000
+
+Bins are the UCSC binning scheme: 5 levels of 128kb, 1Mb, 8Mb, 64Mb and
+512Mb bins for positions up to 512Mb, the extended scheme (one more
+level, offset by 4681) beyond. Coordinates are kept as cuffdiff reports
+them; the intervals are treated as closed on both ends.
+'''
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from django.db.models import Q
+
+from cuff.models import TrackBase
+
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+# First bin of every level, smallest bins first
+BIN_OFFSETS = (512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0)
+BIN_OFFSETS_EXTENDED = (4096 + 512 + 64 + 8 + 1, 512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0)
+# Bins of the extended scheme come after all the standard ones
+BIN_OFFSET_EXTENDED = 4681
+MAX_STANDARD_END = 1 << 29
+
+# 'chr2L:1,000,000-2,000,000', the end is optional for single positions
+REGION = re.compile(r'^\s*(?P<chrom>[^:\s]+):(?P<start>[\d,]+)(?:-(?P<end>[\d,]+))?\s*$')
+LOCUS = r'^(?P<chrom>[^:]+):(?P<start>\d+)-(?P<end>\d+)$'
+
+
+def _levels(end):
+    if end <= MAX_STANDARD_END:
+        return BIN_OFFSETS, 0
+    return BIN_OFFSETS_EXTENDED, BIN_OFFSET_EXTENDED
+
+
+def bin_from_range(start, end):
+    '''
+    Returns the smallest bin containing the closed interval
+    [`start`, `end`].
+    '''
+    offsets, base = _levels(end + 1)
+    start_bin, end_bin = start >> BIN_FIRST_SHIFT, end >> BIN_FIRST_SHIFT
+    for offset in offsets:
+        if start_bin == end_bin:
+            return base + offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    raise ValueError('Interval {0}-{1} is out of the binning range'.format(start, end))
+
+
+def bin_ranges(start, end):
+    '''
+    Returns (first, last) ranges of the bins which may hold intervals
+    overlapping the closed interval [`start`, `end`].
+    '''
+    schemes = [(BIN_OFFSETS, 0)]
+    if end + 1 > MAX_STANDARD_END:
+        schemes.append((BIN_OFFSETS_EXTENDED, BIN_OFFSET_EXTENDED))
+    ranges = []
+    for offsets, base in schemes:
+        start_bin, end_bin = start >> BIN_FIRST_SHIFT, end >> BIN_FIRST_SHIFT
+        for offset in offsets:
+            ranges.append((base + offset + start_bin, base + offset + end_bin))
+            start_bin >>= BIN_NEXT_SHIFT
+            end_bin >>= BIN_NEXT_SHIFT
+    return ranges
+
+
+def parse_region(region):
+    '''
+    Parses a 'chr:start-end' region (thousands separators allowed)
+    into a (chrom, start, end) tuple. Raises ValueError if `region`
+    is not a region.
+    '''
+    match = REGION.match(region)
+    if match is None:
+        raise ValueError('Not a region: {0}'.format(region))
+    start = int(match.group('start').replace(',', ''))
+    end = match.group('end')
+    end = int(end.replace(',', '')) if end else start
+    if end < start:
+        raise ValueError('Region ends before it starts: {0}'.format(region))
+    return match.group('chrom'), start, end
+
+
+def parse_loci(loci):
+    '''
+    Parses a Series of cuffdiff loci into a DataFrame with `chrom`,
+    `chrom_start`, `chrom_end` and `bin` columns, nulls where the locus
+    is missing or malformed.
+    '''
+    parsed = loci.fillna('').astype(str).str.extract(LOCUS, expand=True)
+    frame = pd.DataFrame({'chrom': parsed['chrom']}, index=loci.index)
+    start = pd.to_numeric(parsed['start'])
+    end = pd.to_numeric(parsed['end'])
+    frame['chrom_start'] = start.astype('Int64')
+    frame['chrom_end'] = end.astype('Int64')
+    # Vectorized bin_from_range
+    valid = (start.notnull() & end.notnull()).values
+    starts = start.fillna(0).values.astype(np.int64)
+    ends = end.fillna(0).values.astype(np.int64)
+    extended = ends + 1 > MAX_STANDARD_END
+    bins = np.full(len(frame), -1, dtype=np.int64)
+    for offsets, base, scheme in ((BIN_OFFSETS, 0, ~extended),
+            (BIN_OFFSETS_EXTENDED, BIN_OFFSET_EXTENDED, extended)):
+        start_bin, end_bin = starts >> BIN_FIRST_SHIFT, ends >> BIN_FIRST_SHIFT
+        for offset in offsets:
+            found = scheme & (bins < 0) & (start_bin == end_bin)
+            bins[found] = base + offset + start_bin[found]
+            start_bin = start_bin >> BIN_NEXT_SHIFT
+            end_bin = end_bin >> BIN_NEXT_SHIFT
+    frame['bin'] = pd.Series(bins, index=frame.index).where(valid & (bins >= 0)).astype('Int64')
+    return frame
+
+
+def region_filter(model, region):
+    '''
+    Returns Q object selecting the rows of `model` -- a track or track
+    data model -- of the tracks overlapping `region` ('chr:start-end').
+    Raises ValueError if `region` is not a region.
+    '''
+    chrom, start, end = parse_region(region)
+    prefix = ''
+    if not issubclass(model, TrackBase):
+        for field in model._meta.fields:
+            if field.rel and issubclass(field.rel.to, TrackBase):
+                prefix = '{0}__'.format(field.name)
+                break
+        else:
+            raise ValueError('{0} rows have no locus'.format(model._meta.object_name))
+    bins = reduce(operator.or_, [Q(**{prefix + 'bin__range': (first, last)})
+        for first, last in bin_ranges(start, end)])
+    return bins & Q(**{
+        prefix + 'chrom': chrom,
+        prefix + 'chrom_start__lte': end,
+        prefix + 'chrom_end__gte': start,
+        })
@@ -0,0 +1,100 @@
+from optparse import make_option
+
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from cuff import archive
+from cuff.models import Experiment
+from cuff.purge import BATCH_SIZE
+
+
+class Command(BaseCommand):
+    '''
+    Moves the rows of experiments to the archive (see `cuff.archive`),
+    or back with --restore. The Experiment and ExpStat rows stay in the
+    database. The track and plot views of an archived experiment queue
+    it for restore; --queued restores the queued experiments and is
+    meant to be run from cron.
+
+    Databases created before experiments could be archived get the
+    `archived` column added first. Without experiment pks the archived
+    experiments are listed.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--restore', action='store_true', default=False, dest='restore',
+            help='Load the rows of archived experiments back into the database'),
+        make_option('--queued', action='store_true', default=False, dest='queued',
+            help='Restore the experiments queued by the views'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows deleted at once (default: %d)' % BATCH_SIZE),
+        )
+    args = '[EXP_PK ...]'
+    help = 'Archives experiments to compressed files and deletes their rows.'
+
+    def add_column(self):
+        '''
+        Adds the `archived` column to the experiment table if it is
+        missing. Returns True if it was added.
+        '''
+        table = Experiment._meta.db_table
+        field = Experiment._meta.get_field('archived')
+        columns = [c[0] for c in connection.introspection.get_table_description(
+            connection.cursor(), table)]
+        if field.column in columns:
+            return False
+        qn = connection.ops.quote_name
+        connection.cursor().execute(
+            "ALTER TABLE {table} ADD COLUMN {column} {type} NOT NULL DEFAULT '0'".format(
+            table=qn(table), column=qn(field.column), type=field.db_type(connection=connection)))
+        return True
+
+    def progress(self, model, deleted):
+        if deleted and self.verbosity > 1:
+            self.stdout.write('\t... {model}: {num} rows deleted ...'.format(
+                model=model._meta.object_name, num=deleted))
+
+    def write_counts(self, counts, done):
+        for model, num in sorted(counts.items(), key=lambda x: x[0]._meta.object_name):
+            if num:
+                self.stdout.write('\t{model}: {num} rows {done}'.format(
+                    model=model._meta.object_name, num=num, done=done))
+
+    def handle(self, *args, **options):
+        if not archive.get_root():
+            raise CommandError('CUFF_ARCHIVE_DIR is not set.')
+        self.verbosity = int(options['verbosity'])
+        if self.add_column():
+            self.stdout.write('Added {table}.archived'.format(
+                table=Experiment._meta.db_table))
+        if options['queued']:
+            for exp_pk, counts in sorted(archive.restore_queued().items()):
+                self.stdout.write('Restored experiment {pk}'.format(pk=exp_pk))
+                self.write_counts(counts, 'restored')
+            self.stdout.write('DONE.')
+            return
+        if not args:
+            for exp in Experiment.objects.filter(archived=True).order_by('pk'):
+                self.stdout.write('{pk}: {title} ({path})'.format(pk=exp.pk,
+                    title=exp.title, path=archive.get_path(exp)))
+            return
+        exps = []
+        for pk in args:
+            try:
+                exps.append(Experiment.objects.get(pk=int(pk)))
+            except (ValueError, Experiment.DoesNotExist):
+                raise CommandError('Experiment %s does not exist.' % pk)
+        for exp in exps:
+            if options['restore']:
+                self.stdout.write('Restoring experiment {pk} ({title}) ...'.format(
+                    pk=exp.pk, title=exp.title))
+                counts = archive.restore_experiment(exp)
+                done = 'restored'
+            else:
+                self.stdout.write('Archiving experiment {pk} ({title}) ...'.format(
+                    pk=exp.pk, title=exp.title))
+                counts = archive.archive_experiment(exp, batch_size=options['batch_size'],
+                    progress=self.progress)
+                done = 'archived'
+            self.write_counts(counts, done)
+        self.stdout.write('DONE.')
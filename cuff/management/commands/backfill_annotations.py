@@ -0,0 +1,161 @@
+from optparse import make_option
+
+import pandas as pd
+
+from django.db import connections, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.annotations import AnnotationDictionary, COLUMNS
+from cuff.indexes import get_index_manager
+from cuff.models import Annotation
+from cuff.management.commands.backfill_loci import track_models, table_columns
+
+# Number of tracks updated at once
+BATCH_SIZE = 50000
+
+
+class Command(BaseCommand):
+    '''
+    Links the tracks imported before the shared annotation dictionary
+    (see `cuff.annotations`) existed to their annotations.
+
+    Databases created before get the Annotation table and the
+    `annotation_id` columns of the track tables (with their indexes)
+    first. Tracks are updated in primary key ranges of --batch-size
+    rows, each range in its own transaction, so the command can be
+    interrupted and run again. Once all the tracks of a table are
+    linked, its nearest_ref_id, gene_short_name and locus columns are
+    dropped.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to backfill (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of tracks updated at once (default: %d)' % BATCH_SIZE),
+        )
+    help = 'Backfills the shared annotation dictionary from the tracks.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def create_table(self):
+        '''
+        Creates the Annotation table if it is missing. Returns True if
+        it was created.
+        '''
+        tables = self.connection.introspection.table_names()
+        if Annotation._meta.db_table in tables:
+            return False
+        creation = self.connection.creation
+        statements, pending = creation.sql_create_model(Annotation, no_style(), set())
+        statements += creation.sql_indexes_for_model(Annotation, no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return True
+
+    def add_column(self, model):
+        '''
+        Adds the `annotation_id` column and its index to the `model`
+        table if it is missing. Returns True if it was added.
+        '''
+        table = model._meta.db_table
+        field = model._meta.get_field('annotation')
+        if field.column in table_columns(self.connection, table):
+            return False
+        qn = self.connection.ops.quote_name
+        statements = ['ALTER TABLE {table} ADD COLUMN {column} {type} NULL'.format(
+            table=qn(table), column=qn(field.column),
+            type=field.db_type(connection=self.connection))]
+        statements += self.connection.creation.sql_indexes_for_field(model, field, no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return True
+
+    def backfill(self, model):
+        '''
+        Links the `model` tracks without an annotation. Returns the
+        number of updated tracks.
+        '''
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        # The columns are no fields of the model any more
+        select = ('SELECT {pk}, {columns} FROM {table} WHERE {annotation} IS NULL '
+            'AND {pk} > %s AND {pk} <= %s').format(
+            pk=pk, table=table,
+            columns=', '.join(qn(c) for c in COLUMNS),
+            annotation=qn(model._meta.get_field('annotation').column))
+        update = 'UPDATE {table} SET {annotation} = %s WHERE {pk} = %s'.format(
+            table=table, pk=pk, annotation=qn(model._meta.get_field('annotation').column))
+        low, high = self._fetch('SELECT MIN({pk}), MAX({pk}) FROM {table}'.format(
+            pk=pk, table=table))[0]
+        if low is None:
+            return 0
+        updated = 0
+        for start in range(low - 1, high, self.batch_size):
+            with transaction.atomic(using=self.connection.alias):
+                rows = self._fetch(select, [start, start + self.batch_size])
+                if not rows:
+                    continue
+                tracks = pd.DataFrame.from_records(rows, columns=('pk',) + COLUMNS)
+                ids = self.annotations.upsert(tracks)
+                values = [(int(id_), int(pk_)) for id_, pk_ in zip(ids, tracks['pk'])
+                    if pd.notnull(id_)]
+                self.connection.cursor().executemany(update, values)
+                updated += len(values)
+        return updated
+
+    def drop_columns(self, model):
+        '''
+        Drops the annotation columns of the `model` table. Their indexes
+        go first, SQLite won't drop an indexed column. Returns False if
+        there are tracks left without an annotation.
+        '''
+        qn = self.connection.ops.quote_name
+        table = model._meta.db_table
+        unlinked = self._fetch('SELECT COUNT(*) FROM {table} WHERE {annotation} IS NULL'.format(
+            table=qn(table), annotation=qn(model._meta.get_field('annotation').column)))[0][0]
+        if unlinked:
+            return False
+        cursor = self.connection.cursor()
+        indexes = get_index_manager(self.connection)
+        if indexes is not None:
+            indexes.drop_indexes(table, [name for name, definition in indexes.get_indexes(table)
+                if any(qn(c) in definition for c in COLUMNS)])
+        for column in COLUMNS:
+            cursor.execute('ALTER TABLE {table} DROP COLUMN {column}'.format(
+                table=qn(table), column=qn(column)))
+        return True
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        self.annotations = AnnotationDictionary(self.connection)
+        if self.create_table():
+            self.stdout.write('Created {table}'.format(table=Annotation._meta.db_table))
+        for model in track_models():
+            name = model._meta.object_name
+            if self.add_column(model):
+                self.stdout.write('{model}: added annotation column'.format(model=name))
+            if not set(COLUMNS) <= set(table_columns(self.connection, model._meta.db_table)):
+                self.stdout.write('{model}: already backfilled'.format(model=name))
+                continue
+            updated = self.backfill(model)
+            self.stdout.write('{model}: {num} tracks linked'.format(model=name, num=updated))
+            if self.drop_columns(model):
+                self.stdout.write('{model}: dropped {columns} columns'.format(model=name,
+                    columns=', '.join(COLUMNS)))
+            else:
+                self.stdout.write('{model}: tracks without an annotation left, '
+                    'columns kept'.format(model=name))
+        self.stdout.write('{num} annotations'.format(
+            num=Annotation.objects.using(self.connection.alias).count()))
+        self.stdout.write('DONE.')
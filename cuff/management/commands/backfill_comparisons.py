@@ -0,0 +1,147 @@
+from optparse import make_option
+
+from django.db import connections, transaction
+from django.db.models.loading import get_models, get_app
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.loaders import insert_ignore
+from cuff.models import Comparison, DiffData
+
+# Number of diff rows updated at once
+BATCH_SIZE = 50000
+
+# Fields identifying a comparison
+FIELDS = ('experiment', 'sample_1', 'sample_2',)
+
+
+def diff_models():
+    '''
+    Returns the diff models.
+    '''
+    return [m for m in get_models(get_app('cuff')) if issubclass(m, DiffData)]
+
+
+class Command(BaseCommand):
+    '''
+    Links the diff rows imported before the comparisons (sample pairs)
+    were stored to their comparisons.
+
+    Databases created before get the Comparison table and the
+    `comparison_id` columns of the diff tables (with their indexes)
+    first. Rows are updated in primary key ranges of --batch-size rows,
+    each range in its own transaction, so the command can be
+    interrupted and run again.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to backfill (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of diff rows updated at once (default: %d)' % BATCH_SIZE),
+        )
+    help = 'Backfills the comparisons of the diff tables.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def create_table(self):
+        '''
+        Creates the Comparison table if it is missing. Returns True if
+        it was created.
+        '''
+        if Comparison._meta.db_table in self.connection.introspection.table_names():
+            return False
+        creation = self.connection.creation
+        statements, pending = creation.sql_create_model(Comparison, no_style(),
+            set(get_models(get_app('cuff'))))
+        statements += creation.sql_indexes_for_model(Comparison, no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return True
+
+    def add_column(self, model):
+        '''
+        Adds the `comparison_id` column and the indexes starting with
+        it to the `model` table if it is missing. Returns True if it
+        was added.
+        '''
+        table = model._meta.db_table
+        field = model._meta.get_field('comparison')
+        columns = [c[0] for c in self.connection.introspection.get_table_description(
+            self.connection.cursor(), table)]
+        if field.column in columns:
+            return False
+        qn = self.connection.ops.quote_name
+        statements = ['ALTER TABLE {table} ADD COLUMN {column} {type} NULL'.format(
+            table=qn(table), column=qn(field.column),
+            type=field.db_type(connection=self.connection))]
+        for index in model._meta.index_together:
+            if 'comparison' in index:
+                statements += self.connection.creation.sql_indexes_for_fields(model,
+                    [model._meta.get_field(f) for f in index], no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return True
+
+    def add_comparisons(self, model):
+        '''
+        Adds the comparisons of the `model` rows which don't exist yet.
+        '''
+        qn = self.connection.ops.quote_name
+        pairs = self._fetch('SELECT DISTINCT {columns} FROM {table}'.format(
+            columns=', '.join(qn(model._meta.get_field(f).column) for f in FIELDS),
+            table=qn(model._meta.db_table)))
+        insert_ignore(Comparison, [Comparison._meta.get_field(f).attname for f in FIELDS],
+            pairs, self.connection)
+
+    def backfill(self, model):
+        '''
+        Links the `model` rows without a comparison. Returns the number
+        of updated rows.
+        '''
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        comparisons = qn(Comparison._meta.db_table)
+        update = ('UPDATE {table} SET {comparison} = (SELECT c.{id} FROM {comparisons} c '
+            'WHERE {match}) WHERE {comparison} IS NULL AND {pk} > %s AND {pk} <= %s').format(
+            table=table, pk=pk, comparisons=comparisons,
+            id=qn(Comparison._meta.pk.column),
+            comparison=qn(model._meta.get_field('comparison').column),
+            match=' AND '.join('c.{0} = {1}.{2}'.format(
+                qn(Comparison._meta.get_field(f).column), table,
+                qn(model._meta.get_field(f).column)) for f in FIELDS))
+        low, high = self._fetch('SELECT MIN({pk}), MAX({pk}) FROM {table}'.format(
+            pk=pk, table=table))[0]
+        if low is None:
+            return 0
+        updated = 0
+        for start in range(low - 1, high, self.batch_size):
+            with transaction.atomic(using=self.connection.alias):
+                cursor = self.connection.cursor()
+                cursor.execute(update, [start, start + self.batch_size])
+                updated += max(cursor.rowcount, 0)
+        return updated
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        if self.create_table():
+            self.stdout.write('Created {table}'.format(table=Comparison._meta.db_table))
+        for model in diff_models():
+            name = model._meta.object_name
+            if self.add_column(model):
+                self.stdout.write('{model}: added comparison column'.format(model=name))
+            self.add_comparisons(model)
+            updated = self.backfill(model)
+            self.stdout.write('{model}: {num} rows linked'.format(model=name, num=updated))
+        self.stdout.write('{num} comparisons'.format(
+            num=Comparison.objects.using(self.connection.alias).count()))
+        self.stdout.write('DONE.')
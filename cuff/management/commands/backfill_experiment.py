@@ -0,0 +1,124 @@
+from optparse import make_option
+
+from django.db import connections, transaction
+from django.db.models.loading import get_models, get_app
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.models import TrackBase, Data, CountData, ReplicateData, DiffData
+
+# Number of rows updated at once
+BATCH_SIZE = 50000
+
+
+def data_models():
+    '''
+    Returns the track data models with the denormalized `experiment`
+    column.
+    '''
+    return [m for m in get_models(get_app('cuff'))
+        if issubclass(m, (Data, CountData, ReplicateData, DiffData))]
+
+
+def track_field(model):
+    '''
+    Returns the foreign key of data `model` to its track.
+    '''
+    for field in model._meta.fields:
+        if field.rel and issubclass(field.rel.to, TrackBase):
+            return field
+
+
+class Command(BaseCommand):
+    '''
+    Fills the `experiment` column of the track data tables from the
+    tracks for the rows imported before the column existed.
+
+    Databases created before the column was added get it added (as a
+    nullable column) together with its indexes first. Rows are updated
+    in primary key ranges of --batch-size rows, each range in its own
+    transaction, so the command can be interrupted and run again.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to backfill (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows updated at once (default: %d)' % BATCH_SIZE),
+        )
+    help = 'Backfills the experiment column of the track data tables.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def add_column(self, model):
+        '''
+        Adds the experiment column and its indexes to the `model` table
+        if it is missing. Returns True if the column was added.
+        '''
+        table = model._meta.db_table
+        field = model._meta.get_field('experiment')
+        columns = [c[0] for c in self.connection.introspection.get_table_description(
+            self.connection.cursor(), table)]
+        if field.column in columns:
+            return False
+        qn = self.connection.ops.quote_name
+        creation = self.connection.creation
+        statements = ['ALTER TABLE {table} ADD COLUMN {column} {type} NULL'.format(
+            table=qn(table), column=qn(field.column),
+            type=field.db_type(connection=self.connection))]
+        statements += creation.sql_indexes_for_field(model, field, no_style())
+        for fields in model._meta.index_together:
+            if 'experiment' in fields:
+                statements += creation.sql_indexes_for_fields(model,
+                    [model._meta.get_field(f) for f in fields], no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return True
+
+    def backfill(self, model):
+        '''
+        Sets the experiment of the `model` rows without one to the
+        experiment of their track. Returns the number of updated rows.
+        '''
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        track = track_field(model)
+        sql = ('UPDATE {table} SET {column} = (SELECT t.{track_exp} FROM {tracks} t '
+            'WHERE t.{track_pk} = {table}.{track}) '
+            'WHERE {column} IS NULL AND {pk} > %s AND {pk} <= %s').format(
+            table=table,
+            column=qn(model._meta.get_field('experiment').column),
+            track_exp=qn(track.rel.to._meta.get_field('experiment').column),
+            tracks=qn(track.rel.to._meta.db_table),
+            track_pk=qn(track.rel.to._meta.pk.column),
+            track=qn(track.column),
+            pk=pk)
+        low, high = self._fetch('SELECT MIN({pk}), MAX({pk}) FROM {table}'.format(
+            pk=pk, table=table))[0]
+        if low is None:
+            return 0
+        updated = 0
+        for start in range(low - 1, high, self.batch_size):
+            with transaction.atomic(using=self.connection.alias):
+                cursor = self.connection.cursor()
+                cursor.execute(sql, [start, start + self.batch_size])
+                updated += max(cursor.rowcount, 0)
+        return updated
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        for model in data_models():
+            name = model._meta.object_name
+            if self.add_column(model):
+                self.stdout.write('{model}: added experiment column'.format(model=name))
+            updated = self.backfill(model)
+            self.stdout.write('{model}: {num} rows backfilled'.format(model=name, num=updated))
+        self.stdout.write('DONE.')
@@ -0,0 +1,145 @@
+from optparse import make_option
+
+import pandas as pd
+
+from django.db import connections, transaction
+from django.db.models.loading import get_models, get_app
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.loaders import _null_to_none
+from cuff.locus import parse_loci
+from cuff.models import TrackBase, Annotation
+
+# Number of tracks updated at once
+BATCH_SIZE = 50000
+
+# Columns parsed from the locus
+LOCUS_FIELDS = ('chrom', 'chrom_start', 'chrom_end', 'bin',)
+
+
+def track_models():
+    '''
+    Returns the track models.
+    '''
+    return [m for m in get_models(get_app('cuff')) if issubclass(m, TrackBase)]
+
+
+def table_columns(connection, table):
+    '''
+    Returns the names of the columns of `table` in the database.
+    '''
+    return [c[0] for c in connection.introspection.get_table_description(
+        connection.cursor(), table)]
+
+
+class Command(BaseCommand):
+    '''
+    Parses the loci of the tracks imported before the coordinates
+    (chrom, chrom_start, chrom_end and bin) were stored.
+
+    Databases created before the columns were added get them added (as
+    nullable columns) together with their indexes first. Tracks are
+    updated in primary key ranges of --batch-size rows, each range in
+    its own transaction, so the command can be interrupted and run
+    again.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to backfill (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of tracks updated at once (default: %d)' % BATCH_SIZE),
+        )
+    help = 'Backfills the coordinates of the tracks from their loci.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def add_columns(self, model):
+        '''
+        Adds the missing coordinate columns and their indexes to the
+        `model` table. Returns the names of the added columns.
+        '''
+        table = model._meta.db_table
+        columns = table_columns(self.connection, table)
+        fields = [model._meta.get_field(f) for f in LOCUS_FIELDS]
+        fields = [f for f in fields if f.column not in columns]
+        if not fields:
+            return []
+        qn = self.connection.ops.quote_name
+        creation = self.connection.creation
+        statements = ['ALTER TABLE {table} ADD COLUMN {column} {type} NULL'.format(
+            table=qn(table), column=qn(f.column),
+            type=f.db_type(connection=self.connection)) for f in fields]
+        names = [f.name for f in fields]
+        for index in model._meta.index_together:
+            if set(index) & set(names):
+                statements += creation.sql_indexes_for_fields(model,
+                    [model._meta.get_field(f) for f in index], no_style())
+        cursor = self.connection.cursor()
+        for sql in statements:
+            cursor.execute(sql)
+        return names
+
+    def backfill(self, model):
+        '''
+        Parses the loci of the `model` tracks without coordinates.
+        Returns the number of updated tracks.
+        '''
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        fields = [model._meta.get_field(f) for f in LOCUS_FIELDS]
+        # The locus column of the tracks is dropped once their
+        # annotations are backfilled, see backfill_annotations
+        if 'locus' in table_columns(self.connection, model._meta.db_table):
+            source, locus = '{table} t'.format(table=table), 't.{0}'.format(qn('locus'))
+        else:
+            source = '{table} t JOIN {annotation} a ON a.{annotation_pk} = t.{fk}'.format(
+                table=table, annotation=qn(Annotation._meta.db_table),
+                annotation_pk=qn(Annotation._meta.pk.column),
+                fk=qn(model._meta.get_field('annotation').column))
+            locus = 'a.{0}'.format(qn(Annotation._meta.get_field('locus').column))
+        select = ('SELECT t.{pk}, {locus} FROM {source} WHERE t.{chrom} IS NULL '
+            'AND {locus} IS NOT NULL AND t.{pk} > %s AND t.{pk} <= %s').format(
+            pk=pk, source=source, locus=locus,
+            chrom=qn(model._meta.get_field('chrom').column))
+        update = 'UPDATE {table} SET {columns} WHERE {pk} = %s'.format(
+            table=table, pk=pk,
+            columns=', '.join('{0} = %s'.format(qn(f.column)) for f in fields))
+        low, high = self._fetch('SELECT MIN({pk}), MAX({pk}) FROM {table}'.format(
+            pk=pk, table=table))[0]
+        if low is None:
+            return 0
+        updated = 0
+        for start in range(low - 1, high, self.batch_size):
+            with transaction.atomic(using=self.connection.alias):
+                rows = self._fetch(select, [start, start + self.batch_size])
+                if not rows:
+                    continue
+                pks, loci = zip(*rows)
+                parsed = parse_loci(pd.Series(loci, index=pks))
+                parsed = parsed[parsed['chrom'].notnull()]
+                values = _null_to_none(parsed[list(LOCUS_FIELDS)]).values.tolist()
+                self.connection.cursor().executemany(update,
+                    [row + [int(pk_)] for row, pk_ in zip(values, parsed.index)])
+                updated += len(values)
+        return updated
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        for model in track_models():
+            name = model._meta.object_name
+            added = self.add_columns(model)
+            if added:
+                self.stdout.write('{model}: added {columns} columns'.format(model=name,
+                    columns=', '.join(added)))
+            updated = self.backfill(model)
+            self.stdout.write('{model}: {num} tracks backfilled'.format(model=name, num=updated))
+        self.stdout.write('DONE.')
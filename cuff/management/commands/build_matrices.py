@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cuff import matrices
+from cuff.models import Experiment
+
+
+class Command(BaseCommand):
+    '''
+    Writes the expression matrix store (see `cuff.matrices`) of the
+    given experiments, or of all of them. Existing matrices are
+    replaced, e.g. after the data were changed outside `import_exp`.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--track', action='append', default=[], dest='tracks',
+            type='choice', choices=list(matrices.TRACKS),
+            help='Track to write the matrices for, may be repeated (default: all)'),
+        make_option('--missing', action='store_true', default=False, dest='missing',
+            help='Only write the matrices which don\'t exist yet'),
+        )
+    args = '[EXP_PK ...]'
+    help = 'Writes the expression matrix store of the experiments.'
+
+    def handle(self, *args, **options):
+        if not matrices.get_root():
+            raise CommandError('CUFF_MATRIX_DIR is not set.')
+        exps = Experiment.objects.order_by('pk')
+        if args:
+            exps = exps.filter(pk__in=[int(pk) for pk in args])
+        tracks = options['tracks'] or matrices.TRACKS
+        for exp in exps:
+            todo = [t for t in tracks
+                if not (options['missing'] and matrices.get_store(exp, t))]
+            self.stdout.write('Experiment {pk}: {tracks} ...'.format(pk=exp.pk,
+                tracks=', '.join(todo) or 'nothing to do'))
+            for store in matrices.write_matrices(exp, todo):
+                self.stdout.write('\t... {path}'.format(path=store.path))
+        self.stdout.write('DONE.')
@@ -0,0 +1,201 @@
+from optparse import make_option
+
+from django.db import connections, transaction
+from django.db.models.loading import get_models, get_app
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.models import TrackBase, Data, CountData, ReplicateData, DiffData
+
+# Number of rows updated at once
+BATCH_SIZE = 50000
+
+# Fields which used to hold cuffdiff labels as text
+CODED_FIELDS = ('status', 'significant',)
+
+
+def coded_fields():
+    '''
+    Yields (model, field) for the fields storing cuffdiff labels as
+    codes and the track class codes.
+    '''
+    for model in get_models(get_app('cuff')):
+        if issubclass(model, (Data, CountData, ReplicateData, DiffData)):
+            for name in CODED_FIELDS:
+                if name in model._meta.get_all_field_names():
+                    yield model, model._meta.get_field(name)
+        elif issubclass(model, TrackBase):
+            yield model, model._meta.get_field('class_code')
+
+
+class Command(BaseCommand):
+    '''
+    Converts the status and significant columns of databases created
+    when they were stored as text to the integer/boolean codes and
+    shrinks class_code to a single character.
+
+    MySQL     -- labels are replaced by their codes in batches of
+                 primary key ranges, then the column type is changed
+    PostgreSQL-- one ALTER TABLE ... USING per column
+    SQLite    -- columns can't be altered, tables are recreated and
+                 the rows copied over
+    Columns already converted are skipped. Nothing is converted if
+    any column holds a value which is not one of its labels.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to convert (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows updated at once (MySQL, default: %d)' % BATCH_SIZE),
+        )
+    help = 'Converts status/significant columns stored as text to codes.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def _execute(self, sql, params=()):
+        self.connection.cursor().execute(sql, params)
+
+    def _is_text(self, model, field):
+        '''
+        Checks whether `field` of `model` is still stored as text with
+        the old length.
+        '''
+        introspection = self.connection.introspection
+        for column in introspection.get_table_description(
+                self.connection.cursor(), model._meta.db_table):
+            if column[0] == field.column:
+                field_type = introspection.get_field_type(column[1], column)
+                if isinstance(field_type, tuple):
+                    field_type = field_type[0]
+                if field.choices:
+                    return field_type in ('CharField', 'TextField')
+                return column[3] is None or column[3] > field.max_length
+        return False
+
+    def _case(self, field):
+        '''
+        Returns SQL expression mapping the old labels of `field` to its
+        codes.
+        '''
+        qn = self.connection.ops.quote_name
+        return 'CASE {column} {whens} END'.format(column=qn(field.column),
+            whens=' '.join("WHEN '{label}' THEN {code}".format(label=label, code=int(code))
+                for code, label in field.choices))
+
+    def unknown_labels(self, model, field):
+        '''
+        Returns the values of `field` in the `model` table which are
+        none of its labels and would not convert to a code.
+        '''
+        qn = self.connection.ops.quote_name
+        labels = [label for code, label in field.choices]
+        return [value for value, in self._fetch(
+            'SELECT DISTINCT {column} FROM {table} WHERE {column} NOT IN ({labels})'.format(
+                column=qn(field.column),
+                table=qn(model._meta.db_table),
+                labels=', '.join(['%s'] * len(labels))), labels)]
+
+    def convert_mysql(self, model, field):
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        pk = qn(model._meta.pk.column)
+        if field.choices:
+            sql = ('UPDATE {table} SET {column} = {case} '
+                'WHERE {pk} > %s AND {pk} <= %s').format(
+                table=table, column=qn(field.column), case=self._case(field), pk=pk)
+            low, high = self._fetch('SELECT MIN({pk}), MAX({pk}) FROM {table}'.format(
+                pk=pk, table=table))[0]
+            for start in range(low - 1 if low else 0, high or 0, self.batch_size):
+                with transaction.atomic(using=self.connection.alias):
+                    self._execute(sql, [start, start + self.batch_size])
+        self._execute('ALTER TABLE {table} MODIFY {column} {type} {null}'.format(
+            table=table, column=qn(field.column),
+            type=field.db_type(connection=self.connection),
+            null='NULL' if field.null else 'NOT NULL'))
+
+    def convert_postgresql(self, model, field):
+        qn = self.connection.ops.quote_name
+        using = ''
+        if field.choices:
+            using = ' USING {case}'.format(case=self._case(field))
+            if field.get_internal_type() == 'BooleanField':
+                using = ' USING {column} = {true}'.format(column=qn(field.column),
+                    true="'{0}'".format(dict((c, l) for c, l in field.choices)[True]))
+        self._execute('ALTER TABLE {table} ALTER COLUMN {column} TYPE {type}{using}'.format(
+            table=qn(model._meta.db_table), column=qn(field.column),
+            type=field.db_type(connection=self.connection), using=using))
+
+    def convert_sqlite(self, model, fields):
+        '''
+        Recreates the `model` table with the current definition and
+        copies the rows over converting all the `fields` at once.
+        '''
+        qn = self.connection.ops.quote_name
+        table = model._meta.db_table
+        old = '{0}__old'.format(table)
+        creation = self.connection.creation
+        # Keep the foreign keys of the other tables pointing at `table`
+        self._execute('PRAGMA legacy_alter_table = ON')
+        self._execute('ALTER TABLE {table} RENAME TO {old}'.format(table=qn(table), old=qn(old)))
+        # Indexes follow the renamed table, their names have to be free
+        for name, in self._fetch("SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND tbl_name = %s AND sql IS NOT NULL", [old]):
+            self._execute('DROP INDEX {name}'.format(name=qn(name)))
+        create, references = creation.sql_create_model(model, no_style(),
+            set(get_models(get_app('cuff'))))
+        for sql in create:
+            self._execute(sql)
+        converted = dict((f.column, f) for f in fields)
+        # Columns added later (backfill_loci, ...) are left empty
+        existing = set(c[0] for c in self.connection.introspection.get_table_description(
+            self.connection.cursor(), old))
+        columns = [f.column for f in model._meta.fields if f.column in existing]
+        self._execute('INSERT INTO {table} ({columns}) SELECT {values} FROM {old}'.format(
+            table=qn(table),
+            columns=', '.join(qn(c) for c in columns),
+            values=', '.join(self._case(converted[c]) if c in converted and converted[c].choices
+                else qn(c) for c in columns),
+            old=qn(old)))
+        self._execute('DROP TABLE {old}'.format(old=qn(old)))
+        for sql in creation.sql_indexes_for_model(model, no_style()):
+            self._execute(sql)
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.batch_size = options['batch_size']
+        vendor = self.connection.vendor
+        if vendor not in ('mysql', 'postgresql', 'sqlite'):
+            raise CommandError('%s databases are not supported.' % vendor)
+        pending = {}
+        for model, field in coded_fields():
+            if self._is_text(model, field):
+                pending.setdefault(model, []).append(field)
+        # Unknown labels would fail the conversion half way (MySQL
+        # commits batch by batch), check all of them first
+        unknown = []
+        for model, fields in pending.items():
+            for field in fields:
+                labels = self.unknown_labels(model, field) if field.choices else []
+                if labels:
+                    unknown.append('{model}.{field}: {labels}'.format(
+                        model=model._meta.object_name, field=field.name,
+                        labels=', '.join(labels)))
+        if unknown:
+            raise CommandError('Unknown labels, nothing was converted:\n' + '\n'.join(unknown))
+        for model, fields in pending.items():
+            name = model._meta.object_name
+            self.stdout.write('{model}: converting {fields} ...'.format(model=name,
+                fields=', '.join(f.name for f in fields)))
+            if vendor == 'sqlite':
+                with transaction.atomic(using=self.connection.alias):
+                    self.convert_sqlite(model, fields)
+                continue
+            for field in fields:
+                getattr(self, 'convert_{0}'.format(vendor))(model, field)
+        self.stdout.write('DONE.')
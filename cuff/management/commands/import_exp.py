@@ -1,11 +1,24 @@
-import os, csv
+import os, sys, csv, time, socket, platform, multiprocessing
 from optparse import make_option
 
+from django.db import connection
 from django.db.models.loading import get_model
-from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.core.management.base import BaseCommand, CommandError, OutputWrapper
 
+import django, pandas
+
+from cuff import reshape, matrices
+from cuff.annotations import AnnotationDictionary
+from cuff.profiling import NULL_PROFILER, StageProfiler, STAGES, peak_rss, reset_peak_rss
+from cuff.loaders import get_loader, immediate_transactions, insert_ignore, LoaderUnavailable
+from cuff.indexes import get_index_manager
+from cuff.partitions import get_partition_manager
+from cuff.scheduler import Scheduler, StepFailed
+from cuff.sources import get_location, file_source, open_source
 from cuff.models import (Experiment, Sample, Replicate, RunInfo,
-    Gene, TSS, ExpStat, PromoterDiffData, SplicingDiffData, CDSDiffData)
+    Comparison, Gene, TSS, CDS, Isoform, Feature, Attribute, ExpStat, TableStat,
+    ImportStep, ImportProfile, DeferredIndex, PromoterDiffData, SplicingDiffData, CDSDiffData)
 
 # The filenames from cuffdiff output
 RUNINFO_FILE = 'run.info'
@@ -30,7 +43,38 @@ CDS_DIFF_FILE = 'cds.diff'
 CDS_COUNT_FILE = 'cds.count_tracking'
 CDS_REPLICATE_FILE = 'cds.read_group_tracking'
 
-# This whole mess should be refactored using pandas or such...
+# Data tracks: (track, --exclude name, parent tracks, fpkm, diff, count,
+# replicate files). Parents are the tracks referenced by foreign keys
+# and have to be imported first.
+TRACKS = (
+    ('gene', 'gene', (), GENE_FPKM_FILE, GENEEXP_DIFF_FILE,
+        GENE_COUNT_FILE, GENE_REPLICATE_FILE),
+    ('tss', 'TSS', ('gene',), TSS_FPKM_FILE, TSSEXP_DIFF_FILE,
+        TSS_COUNT_FILE, TSS_REPLICATE_FILE),
+    ('cds', 'CDS', ('gene', 'tss'), CDS_FPKM_FILE, CDSEXP_DIFF_FILE,
+        CDS_COUNT_FILE, CDS_REPLICATE_FILE),
+    ('isoform', 'isoform', ('gene', 'tss', 'cds'), ISOFORM_FPKM_FILE,
+        ISOFORMEXP_DIFF_FILE, ISOFORM_COUNT_FILE, ISOFORM_REPLICATE_FILE),
+    )
+
+# Distribution level diff data: (name, track, file, referenced track)
+DIST_TRACKS = (
+    ('promoter', 'gene', PROMOTER_FILE, 'gene'),
+    ('splicing', 'tss', SPLICING_FILE, 'tss'),
+    ('relcds', 'cds', CDS_DIFF_FILE, 'gene'),
+    )
+
+# Fields holding the cuffdiff ids of the tracks, unique within an
+# experiment
+TRACK_KEYS = {
+    Gene: 'gene_id',
+    TSS: 'tss_group_id',
+    CDS: 'cds_id',
+    Isoform: 'isoform_id',
+    }
+
+# Number of rows to accumulate before flushing them to the database
+BATCH_SIZE = 10000
 
 class Command(BaseCommand):
     '''
@@ -41,9 +85,11 @@ class Command(BaseCommand):
         - RunInfo
         - RepTable (also populates Sample)
         - Genes
-        - Isoforms
         - TSS
         - CDS
+        - Isoforms
+    With --jobs > 1 the track files are imported in parallel as soon
+    as the tracks they reference are in place.
     '''
     option_list = BaseCommand.option_list + (
         make_option('--exclude', default='', dest='exclude',
@@ -58,19 +104,75 @@ class Command(BaseCommand):
             help='.gtf file with annotations'),
         make_option('--genome-build', default=None, dest='gbuild',
             help='genome build information'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows written to the database at once (default: %d)' % BATCH_SIZE),
+        make_option('--loader', default='orm', dest='loader',
+            type='choice', choices=['orm', 'native'],
+            help='Write tables through the ORM (default) or with the native '
+                'bulk loader of the database (LOAD DATA, COPY) if available'),
+        make_option('--jobs', default=1, dest='jobs', type='int',
+            help='Number of files imported in parallel (default: 1)'),
+        make_option('--resume', default=None, dest='resume', type='int',
+            metavar='EXP_PK',
+            help='Resume an interrupted import of experiment EXP_PK. '
+                'Completed steps are skipped, unfinished ones rolled back and redone.'),
+        make_option('--update', default=None, dest='update', type='int',
+            metavar='EXP_PK',
+            help='Reload only the tables of experiment EXP_PK fed by the files '
+                'which changed since the last import.'),
+        make_option('--profile', action='store_true', default=False, dest='profile',
+            help='Time parsing, reshaping and writing of every file and record '
+                'throughput and peak memory with the experiment'),
+        make_option('--profile-dir', default=None, dest='profile_dir',
+            metavar='DIR',
+            help='Also run every stage under cProfile and dump the stats to '
+                'DIR as <step>.<stage>.pstats (implies --profile)'),
+        make_option('--defer-indexes', action='store_true', default=False,
+            dest='defer_indexes',
+            help='Drop secondary indexes (and switch off foreign key checks on MySQL) '
+                'for the import, check references and rebuild the indexes at the end. '
+                'Only allowed while there are no other experiments'),
+        make_option('--no-matrices', action='store_false', default=True,
+            dest='matrices',
+            help='Don\'t write the expression matrix store (see CUFF_MATRIX_DIR)'),
         )
-    args = '<cuffdiff out directory>'
+    args = '<cuffdiff output directory or .tar(.gz|.bz2|.xz)/.zip archive>'
     
     def _get_reader(self, file, header=None):
         return csv.DictReader(file, delimiter='\t', fieldnames=header)
     
-    def _get_track_fields(self, model):
+    def _write_batch(self, model, frame):
         '''
-        returns all fields except for `id` for a given model
+        Writes a single batch of rows and reports the throughput.
+        `frame` is a DataFrame with model attribute names as columns.
         '''
-        raw_fields = model._meta.get_all_field_names()
-        return filter(lambda x: x != 'id', raw_fields)
-        
+        start = time.time()
+        with self.profiler.stage('write'):
+            try:
+                count = self.loader.load(model, frame)
+            except LoaderUnavailable as e:
+                self.stdout.write('\t...\t{err}. Falling back to the ORM ...'.format(err=e))
+                self.loader = get_loader('orm')
+                count = self.loader.load(model, frame)
+        self.written += count
+        elapsed = max(time.time() - start, 1e-6)
+        self.stdout.write('\t...\t wrote {count} {model} rows ({rate:.0f} rows/sec)'.format(
+            count=count,
+            model=model._meta.object_name,
+            rate=count / elapsed))
+        return count
+    
+    def _bulk_write(self, model, frames):
+        '''
+        Streams `frames` (an iterable of DataFrames produced by the
+        `cuff.reshape` readers) to the database one batch at a time.
+        '''
+        count = 0
+        for frame in frames:
+            count += self._write_batch(model, frame)
+        return count
+    
     def _get_track(self, model_track, data_track):
         '''
         model_track is Gene, TSS, CDS, Isoform etc
@@ -97,183 +199,127 @@ class Command(BaseCommand):
                 )
         return track_model, data_model, track_field
     
-    def _track_melt(self, model, track_id_field, data):
+    def _sample_ids(self):
         '''
-        Processes a record from <track>.fpkm_tracking file to populate <TrackBase> table.
-        (Gene, TSS, Isoform, CDS)
+        Returns primary keys of the experiment samples by sample name.
         '''
-
-        def is_foreign_key(model, field):
-            field, m, direct, m2m = model._meta.get_field_by_name(field)
-            return field.rel and direct
-
-        fields = model._meta.get_all_field_names()
-        kwargs = {'experiment': self.exp,}
-        for k,v in data.items():
-            if k.endswith('_id'):
-                # Handle foreign keys and primary keys here
-                key_base, dummy = k.split('_id')
-                if key_base == 'tss':
-                    key_base = 'tss_group'
-                if k == 'tracking_id':
-                    # k is tracking id -- compute track_pk and set track_id field
-                    track_key = '{track}_id'.format(track=track_id_field)
-                    kwargs.update({
-                        track_key: v,
-                        # This is an ugly way of getting composite pk.
-                        'track_pk': '{base_id}-exp-{exp_id}'.format(base_id=v,exp_id=self.exp.pk),
-                        })
-                elif key_base in fields and is_foreign_key(model, key_base):
-                    # k is a foreign key to either gene or tss_group
-                    kwargs.update({
-                        '{0}_id'.format(key_base): '{base_id}-exp-{exp_id}'.format(
-                            base_id=v,exp_id=self.exp.pk),
-                        })
-            # '-' denotes NA value
-            elif k in fields and v != '-':
-                # k is just a regular field
-                kwargs.update({k: v,})
-        return model(**kwargs)
-    
-    def _data_melt(self, model, track_id_field, sample_names, data):
-        '''
-        Processes a record from <track>.fpkm_tracking file to populate <Track>Data table.
-        (GeneData, TSSData, CDSData, IsoformData)
-        
-        Kinda sorta analogous to dataframe.melt function in R.
-        '''
-        fields = self._get_track_fields(model)
-        track_key = '{track}_id'.format(track=track_id_field)
-        melts = [{'sample_id': name, track_key: '{base_id}-exp-{exp_id}'.format(base_id=data['tracking_id'], exp_id=self.exp.pk), } 
-            for name in sample_names]
-        for k,v in data.items():
-            sample_name = k.split('_')[0]
-            for m in melts:
-                if sample_name == m['sample_id']:
-                    kwargs = m
-                    break
-            for field in fields:
-                if k.lower().endswith(field) and v != '-':
-                    kwargs.update({field: v,})
-        for m in melts:
-            m['sample_id'] += '-exp-{exp_pk}'.format(exp_pk=self.exp.pk)
-        return [model(**kwargs) for kwargs in melts]
-        
+        return dict(Sample.objects.filter(experiment=self.exp).values_list('sample_name', 'pk'))
+    
+    def _rep_ids(self):
+        '''
+        Returns primary keys of the experiment replicates by rep_name.
+        '''
+        return dict(Replicate.objects.filter(sample__experiment=self.exp
+            ).values_list('rep_name', 'pk'))
+    
+    def _track_ids(self, model, **filters):
+        '''
+        Returns primary keys of the experiment `model` tracks by their
+        cuffdiff id.
+        '''
+        return dict(model.objects.filter(experiment=self.exp, **filters
+            ).values_list(TRACK_KEYS[model], 'pk'))
+    
+    def _ref_track_ids(self, model, track_field):
+        '''
+        Returns the primary keys lookup for the track referenced by
+        `track_field` of data `model`.
+        '''
+        return self._track_ids(model._meta.get_field(track_field).rel.to)
+    
     def _process_fpkm(self, track, file):
         # Get track model, data model, track_id field and related lookup
         track_model, data_model, track_id = self._get_track(track, 'data')
-        track_records = []
-        data_records = []
-        sample_names = Sample.objects.filter(experiment=self.exp).values_list('sample_name', flat=True)
-        with open(file) as fpkm_file:
-            reader = self._get_reader(fpkm_file)
-            self.stdout.write('\t...\treshaping data...')
-            for rec in reader:
-                track_records.append(self._track_melt(track_model, track_id, rec))
-                data_records.extend(self._data_melt(data_model, track_id, 
-                    sample_names, rec))
-        self.stdout.write('\t...\twriting tables...')
-        track_count = len(track_model._default_manager.bulk_create(track_records))
-        data_count = len(data_model._default_manager.bulk_create(data_records))
+        track_key = TRACK_KEYS[track_model]
+        parent_ids = dict((f.attname, self._track_ids(f.rel.to))
+            for f in track_model._meta.fields if f.rel and f.rel.to in TRACK_KEYS)
+        track_count = data_count = 0
+        last_pk = 0
+        self.stdout.write('\t... processing {file} ...'.format(file=file.name))
+        # Track rows of a batch go in first so that data rows
+        # always reference existing tracks.
+        for tracks, data in reshape.read_fpkm(file, track_model, data_model,
+                track_id, self.exp.pk, self._sample_ids(), parent_ids, self.batch_size,
+                profiler=self.profiler):
+            with self.profiler.stage('write'):
+                tracks = self.annotations.annotate(tracks)
+            track_count += self._write_batch(track_model, tracks)
+            # Only this step writes the tracks of the experiment, so
+            # the new ones are those after the last batch
+            track_ids = self._track_ids(track_model, pk__gt=last_pk)
+            if len(track_ids) != len(tracks):
+                raise CommandError('Expected {0} new {1} rows, found {2}'.format(
+                    len(tracks), track_model._meta.object_name, len(track_ids)))
+            if track_ids:
+                last_pk = max(track_ids.values())
+            data[track_key] = reshape.map_ids(data[track_key], track_ids)
+            data_count += self._write_batch(data_model, data)
         self.stdout.write('\t...\t {tcount} {track} and {dcount} {track}data records ...'.format( 
                 tcount=track_count,
                 track=track,
                 dcount=data_count))
         return track_count, data_count
     
+    def _comparison_ids(self):
+        '''
+        Returns primary keys of the experiment comparisons by
+        (sample_1_id, sample_2_id).
+        '''
+        return dict(((s1, s2), pk) for pk, s1, s2 in Comparison.objects.filter(
+            experiment=self.exp).values_list('pk', 'sample_1', 'sample_2'))
+    
+    def _add_comparisons(self, frames):
+        '''
+        Sets `comparison_id` of the diff `frames`, adding the missing
+        comparisons. The diff steps run in parallel, so comparisons
+        added concurrently are skipped.
+        '''
+        ids = {}
+        for frame in frames:
+            pairs = list(zip(frame['sample_1_id'], frame['sample_2_id']))
+            if any(pair not in ids for pair in pairs):
+                ids = self._comparison_ids()
+                missing = set(pair for pair in pairs if pair not in ids)
+                if missing:
+                    insert_ignore(Comparison, ('experiment_id', 'sample_1_id', 'sample_2_id'),
+                        [(self.exp.pk, int(s1), int(s2)) for s1, s2 in missing])
+                    ids = self._comparison_ids()
+            frame['comparison_id'] = [ids[pair] for pair in pairs]
+            yield frame
+    
     def _process_diff(self, track, file, diff='expdiffdata'):
         '''
         This can probably be used for all track bases.
         Just needs to be passed the track or model.
         '''
         track_model, diff_model, track_id_field = self._get_track(track, diff)
-        track_key = '{track}_id'.format(track=track_id_field)
-        fields = diff_model._meta.get_all_field_names()
-        imported = []
-        with open(file) as diff_file:
-            reader = self._get_reader(diff_file)
-            self.stdout.write('\t...\tparsing data...')
-            for rec in reader:
-                kwargs = {track_key: '{base_id}-exp-{exp_id}'.format(base_id=rec['test_id'], exp_id=self.exp.pk),}
-                for k,v in rec.items():
-                    if k in fields:
-                        if k.startswith('sample'):
-                            # FIXME: Sample pk!
-                            sample_key = '{sample}_id'.format(sample=k)
-                            kwargs.update({sample_key: '{name}-exp-{exp_pk}'.format(name=v, exp_pk=self.exp.pk),})
-                        elif k != track_id_field:
-                            kwargs.update({k: v,})
-                    elif k.startswith('sqrt'):
-                        kwargs.update({'js_dist': v,})
-                    elif k.startswith('log2'):
-                        kwargs.update({'log2_fold_change': v,})
-                imported.append(diff_model(**kwargs))
-        self.stdout.write('\t...\twriting tables...')
-        diff_count = len(diff_model._default_manager.bulk_create(imported))
-        self.stdout.write('\t...\t {count} records processed'.format(count=diff_count))
+        self.stdout.write('\t... processing {file} ...'.format(file=file.name))
+        diff_count = self._bulk_write(diff_model, self._add_comparisons(reshape.read_diff(file,
+            diff_model, track_id_field, self.exp.pk,
+            self._ref_track_ids(diff_model, track_id_field), self._sample_ids(), self.batch_size, profiler=self.profiler)))
+        self.stdout.write('\t...\t {count} {model} records processed'.format(
+            count=diff_count, model=diff_model._meta.object_name))
         return diff_count
     
     def _process_count(self, track, count):
-        # FIXME: Broken. This one misses uncertainty_var!
         track_model, count_model, track_id_field = self._get_track(track, 'count')
-        fields = self._get_track_fields(count_model)
-        track_key = '{track}_id'.format(track=track_id_field)
-        sample_names = Sample.objects.filter(experiment=self.exp).values_list('sample_name', flat=True)
-        imported = []
-        with open(count) as count_file:
-            reader = self._get_reader(count_file)
-            # Handle stupid tss naming convention
-            for rec in reader:
-                # Set up list of kwargs for every sample
-                tracking_id = rec.pop('tracking_id')
-                melts = [{'sample_id': name, track_key: '{base_id}-exp-{exp_id}'.format(base_id=tracking_id, exp_id=self.exp.pk),}
-                        for name in sample_names]
-                for k,v in rec.items():
-                    bits = k.split('_')
-                    sample_name = bits.pop(0)
-                    for m in melts:
-                        if sample_name == m['sample_id']:
-                            kwargs = m
-                            break
-                    for f in bits:
-                        # This will break if field name contains 
-                        # underscore
-                        if f in fields and not f in kwargs:
-                            kwargs.update({f: v,})
-                for m in melts:
-                    m['sample_id'] += '-exp-{exp_pk}'.format(exp_pk=self.exp.pk)
-                imported.extend([count_model(**melt) for melt in melts])
-        cnt_count = len(count_model._default_manager.bulk_create(imported))
-        self.stdout.write('\t...\t {count} records processed'.format(count=cnt_count))
+        self.stdout.write('\t... processing {file} ...'.format(file=count.name))
+        cnt_count = self._bulk_write(count_model, reshape.read_count(count,
+            count_model, track_id_field, self.exp.pk,
+            self._ref_track_ids(count_model, track_id_field), self._sample_ids(), self.batch_size, profiler=self.profiler))
+        self.stdout.write('\t...\t {count} {model} records processed'.format(
+            count=cnt_count, model=count_model._meta.object_name))
         return cnt_count
     
     def _process_replicate(self, track, replicate):
         track_model, rep_model, track_id_field = self._get_track(track, 'replicatedata')
-        fields = self._get_track_fields(rep_model)
-        track_key = '{track}_id'.format(track=track_id_field)
-        imported = []
-        with open(replicate) as rep_file:
-            reader = self._get_reader(rep_file)
-            for rec in reader:
-                kwargs = {track_key: '{base_id}-exp-{exp_id}'.format(base_id=rec['tracking_id'], exp_id=self.exp.pk),}
-                for k,v in rec.items():
-                    f = k.lower()
-                    if f in fields and v != '-':
-                        kwargs.update({f: v,})
-                    elif f == 'condition':
-                        # sample = v
-                        kwargs.update({'sample_id': '{sample}-exp-{exp_pk}'.format(
-                            sample=v,
-                            exp_pk=self.exp.pk),}
-                            )
-                kwargs.update({'rep_name_id': '{sample}_{rep}-exp-{exp_pk}'.format(
-                    sample=rec['condition'],
-                    rep=rec['replicate'],
-                    exp_pk=self.exp.pk),}
-                    )
-                imported.append(rep_model(**kwargs))
-        rep_count = len(rep_model._default_manager.bulk_create(imported))
-        self.stdout.write('\t...\t {count} records processed'.format(count=rep_count))
+        self.stdout.write('\t... processing {file} ...'.format(file=replicate.name))
+        rep_count = self._bulk_write(rep_model, reshape.read_replicate(replicate,
+            rep_model, track_id_field, self.exp.pk,
+            self._ref_track_ids(rep_model, track_id_field), self._sample_ids(),
+            self._rep_ids(), self.batch_size, profiler=self.profiler))
+        self.stdout.write('\t...\t {count} {model} records processed'.format(
+            count=rep_count, model=rep_model._meta.object_name))
         return rep_count
     
     def set_options(self, dir, **options):
@@ -283,15 +329,54 @@ class Command(BaseCommand):
         from datetime import datetime as dt
         gtf_file = options['gtf']
         if gtf_file and os.path.exists(gtf_file):
-            self.gtf = gtf_file
+            self.gtf = file_source(gtf_file)
         else:
             self.gtf = None
         self.genome_build = options['gbuild']
+        self.batch_size = options['batch_size']
+        self.loader_name = options['loader']
+        self.loader = get_loader(self.loader_name)
+        self.jobs = options['jobs']
+        if self.jobs > 1 and connection.vendor == 'sqlite' and (
+                connection.settings_dict['NAME'] in ('', ':memory:')):
+            # Every process would get a database of its own
+            self.stdout.write('WARNING: --jobs needs an SQLite database file, importing with 1 job')
+            self.jobs = 1
+        self.profile_dir = options['profile_dir']
+        self.profile = options['profile'] or bool(self.profile_dir)
+        if self.profile_dir and not os.path.isdir(self.profile_dir):
+            raise CommandError('Directory %s does not exist.' % self.profile_dir)
+        self.profiler = NULL_PROFILER
+        self.written = 0
+        self.indexes = get_index_manager()
+        self.annotations = AnnotationDictionary()
+        self.defer_indexes = options['defer_indexes'] and self.indexes is not None
+        if options['defer_indexes'] and not self.defer_indexes:
+            self.stdout.write('WARNING: --defer-indexes is not supported for this database')
         self.exclude = options['exclude'].split()
+        self.matrices = options['matrices'] and bool(matrices.get_root())
+        try:
+            self.location = get_location(dir)
+        except ValueError as e:
+            raise CommandError(str(e))
+        exp_pk = options['resume'] or options['update']
+        if options['resume'] and options['update']:
+            raise CommandError('--resume and --update are mutually exclusive.')
+        if exp_pk:
+            try:
+                self.exp = Experiment.objects.get(pk=exp_pk)
+            except Experiment.DoesNotExist:
+                raise CommandError('Experiment %s does not exist.' % exp_pk)
+            # Features reference the tracks and have to be reloaded
+            # together with them
+            gtf_step = ImportStep.objects.filter(experiment=self.exp, name='gtf').first()
+            if self.gtf is None and gtf_step and os.path.exists(gtf_step.path):
+                self.gtf = file_source(gtf_step.path)
+            return
         info = os.stat(dir)
         created = dt.fromtimestamp(info.st_mtime)
         self.exp = Experiment.objects.create(
-            title=options['title'] or os.path.basename(dir).replace('_', ' '),
+            title=options['title'] or self.location.name.replace('_', ' '),
             species=options['species'],
             library=options['lib'],
             analysis_date=created,
@@ -309,8 +394,9 @@ class Command(BaseCommand):
             - boost_version:    version of boost libraries
         '''
         # fields = RunInfo._meta.get_all_field_names()
+        self.stdout.write('Reading Runinfo file ...')
         imported = []
-        with open(file) as runinfo_file:
+        with open_source(file) as runinfo_file:
             reader = self._get_reader(runinfo_file)
             for rec in reader:
                 imported.append(RunInfo(
@@ -324,30 +410,27 @@ class Command(BaseCommand):
                 key='genome',
                 value=self.genome_build
                 ))
-        return RunInfo.objects.bulk_create(imported)
+        return len(RunInfo.objects.bulk_create(imported))
         
     def import_reptable(self, file):
         '''
         Imports replicates data (read_groups.info file)
         Populates Sample table.
         '''
+        self.stdout.write('Importing replicates and populating Samples table ...')
         imported = []
         fields = Replicate._meta.get_all_field_names()
-        with open(file) as rep_file:
+        with open_source(file) as rep_file:
             reader = self._get_reader(rep_file)
             for rec in reader:
                 sample, created = Sample.objects.get_or_create(
                     experiment=self.exp,
                     sample_name=rec['condition'],
-                    sample_pk='{sample}-exp-{exp}'.format(
-                        sample=rec['condition'],
-                        exp=self.exp.pk)
                     )
                 kwargs = {
                     'sample': sample,
                     'file_name': rec['file'],
                     'replicate': int(rec['replicate_num']),
-                    'rep_pk': '%s_%s-exp-%s' % (rec['condition'], rec['replicate_num'], self.exp.pk),
                     'rep_name': '%s_%s' % (rec['condition'], rec['replicate_num'])
                     }
                 for k,v in rec.items():
@@ -355,126 +438,521 @@ class Command(BaseCommand):
                     if f in fields:
                         kwargs.update({f: v,})
                 imported.append(Replicate(**kwargs))
-        return Replicate.objects.bulk_create(imported)
+        return len(Replicate.objects.bulk_create(imported))
+    
+    def get_state(self):
+        '''
+        Returns what a fresh Command instance in a worker process needs
+        to run import steps for the current experiment.
+        '''
+        return {
+            'exp': self.exp,
+            'genome_build': self.genome_build,
+            'batch_size': self.batch_size,
+            'loader': self.loader_name,
+            'profile': self.profile,
+            'profile_dir': self.profile_dir,
+            'defer_indexes': self.defer_indexes,
+            'jobs': self.jobs,
+            }
+    
+    def set_state(self, state):
+        self.stdout = OutputWrapper(sys.stdout)
+        self.exp = state['exp']
+        self.genome_build = state['genome_build']
+        self.batch_size = state['batch_size']
+        self.loader_name = state['loader']
+        self.loader = get_loader(self.loader_name)
+        self.profile = state['profile']
+        self.profile_dir = state['profile_dir']
+        self.profiler = NULL_PROFILER
+        self.jobs = state['jobs']
+        self.written = 0
+        self.indexes = get_index_manager()
+        self.annotations = AnnotationDictionary()
+        self.defer_indexes = state['defer_indexes']
+    
+    def _step_models(self, method, args):
+        '''
+        Returns the models written by an import step, referencing
+        tables first.
+        '''
+        if method == 'import_runinfo':
+            return [RunInfo]
+        if method == 'import_reptable':
+            # Comparisons are added by the diff steps, but go with
+            # the samples they reference
+            return [Comparison, Replicate, Sample]
+        if method == 'import_gtf':
+            return [Attribute, Feature]
+        track = args[0]
+        if method == '_process_fpkm':
+            track_model, data_model, track_id = self._get_track(track, 'data')
+            return [data_model, track_model]
+        data_track = {
+            '_process_diff': args[2] if len(args) > 2 else 'expdiffdata',
+            '_process_count': 'count',
+            '_process_replicate': 'replicatedata',
+            }[method]
+        return [self._get_track(track, data_track)[1]]
+    
+    def _exp_rows(self, model):
+        '''
+        Returns a queryset of `model` rows for the current experiment.
+        '''
+        manager = model._default_manager
+        if hasattr(manager, 'for_exp'):
+            return manager.for_exp(self.exp)
+        elif model is Replicate:
+            return manager.filter(sample__experiment=self.exp)
+        elif model is Attribute:
+            return manager.filter(feature__experiment=self.exp)
+        return manager.filter(experiment=self.exp)
+    
+    def rollback_step(self, method, args):
+        '''
+        Deletes everything the step has written for the experiment.
+        Steps depending on it must be rolled back first.
+        '''
+        for model in self._step_models(method, args):
+            self._exp_rows(model)._raw_delete(using=self._exp_rows(model).db)
     
-    def import_track(self, track, fpkm, diff, **kwargs):
+    def run_checkpointed(self, name, source, method, args):
         '''
-        Imports data track
-            - Track
-            - TrackData
+        Runs the import step `name`, i.e. `self.<method>(*args)` reading
+        `source`, unless it is already completed for the experiment.
+        Anything an unfinished previous run of the step has written is
+        rolled back first.
+        Returns the number of records imported by the step (track rows
+        for .fpkm_tracking files).
+        '''
+        size, mtime = source.stat()
+        step, created = ImportStep.objects.get_or_create(
+            experiment=self.exp, name=name, defaults={'path': source.path,})
+        if step.status == ImportStep.DONE:
+            if (step.size, step.mtime) != (size, mtime):
+                self.stdout.write('\t... WARNING: {path} changed since it was imported'.format(
+                    path=source.path))
+            self.stdout.write('\t... {name} is already imported, skipping ...'.format(name=name))
+            return step.rows
+        # Stale steps have been rolled back by `invalidate_changed`
+        if not created and step.status != ImportStep.STALE:
+            self.stdout.write('\t... rolling back unfinished {name} step ...'.format(name=name))
+            self.rollback_step(method, args)
+        step.path = source.path
+        step.size = size
+        step.mtime = mtime
+        step.checksum = None
+        step.rows = 0
+        step.status = ImportStep.RUNNING
+        step.started = timezone.now()
+        step.finished = None
+        step.save()
+        if self.defer_indexes:
+            self.indexes.disable_constraints()
+        if self.profile:
+            self.profiler = StageProfiler(use_cprofile=bool(self.profile_dir))
+            # With --jobs the worker runs nothing but the step
+            self.measure_rss = reset_peak_rss() or self.jobs > 1
+        self.written = 0
+        start = time.time()
+        try:
+            result = getattr(self, method)(*args)
+        except:
+            step.status = ImportStep.FAILED
+            step.save()
+            raise
+        # _process_fpkm returns both track and data counts
+        step.rows = result[0] if isinstance(result, tuple) else result
+        # Computed as the step read the file; a step which stopped short
+        # of the end of the file costs one more read.
+        step.checksum = source.read_checksum() or source.checksum()
+        step.status = ImportStep.DONE
+        step.finished = timezone.now()
+        if self.profiler.enabled:
+            self.record_profile(step, time.time() - start)
+        step.save()
+        return step.rows
+    
+    def record_profile(self, step, wall_time):
+        '''
+        Stores the stage timings of the just finished `step` and dumps
+        its cProfile stats if --profile-dir is given.
+        '''
+        times = self.profiler.times
+        step.wall_time = wall_time
+        step.parse_time = times['parse']
+        step.reshape_time = times['reshape']
+        step.write_time = times['write']
+        # run.info and read_groups.info are written without _write_batch
+        step.written = self.written or step.rows
+        step.peak_rss = peak_rss() if self.measure_rss else None
+        if self.profile_dir:
+            self.profiler.dump(self.profile_dir,
+                'exp{pk}.{name}'.format(pk=self.exp.pk, name=step.name))
+        self.profiler = NULL_PROFILER
+    
+    def report_profile(self, since, wall_time):
+        '''
+        Prints the timings of the steps run since `since` and saves the
+        ImportProfile summary for the experiment.
+        '''
+        steps = ImportStep.objects.filter(experiment=self.exp,
+            started__gte=since, wall_time__gt=0).order_by('started')
+        self.stdout.write('Profile (seconds):')
+        self.stdout.write('\t{0:<20}{1:>9}{2:>9}{3:>9}{4:>9}{5:>11}{6:>10}'.format(
+            'step', 'wall', *(STAGES + ('rows/sec', 'peak MB'))))
+        for step in steps:
+            self.stdout.write('\t{0:<20}{1:>9.2f}{2:>9.2f}{3:>9.2f}{4:>9.2f}{5:>11.0f}{6:>10}'.format(
+                step.name, step.wall_time, step.parse_time, step.reshape_time,
+                step.write_time, step.rate or 0, '-' if step.peak_rss is None else
+                '{0:.1f}'.format(step.peak_rss / 2.0 ** 20)))
+        if self.jobs > 1:
+            # The workers have exited by now, RUSAGE_CHILDREN has the
+            # peak of the largest of them
+            peak = peak_rss() + peak_rss(children=True)
+        else:
+            # The peak is reset for every step
+            peak = max([peak_rss()] + [step.peak_rss for step in steps if step.peak_rss])
+        profile = ImportProfile.objects.create(
+            experiment=self.exp,
+            created=timezone.now(),
+            host=socket.gethostname(),
+            environment='Python {python}, Django {django}, pandas {pandas}, '
+                '{cpus} CPUs, {db}'.format(
+                    python=platform.python_version(),
+                    django=django.get_version(),
+                    pandas=pandas.__version__,
+                    cpus=multiprocessing.cpu_count(),
+                    db=connection.vendor),
+            options='--jobs={jobs} --loader={loader} --batch-size={batch}'.format(
+                jobs=self.jobs, loader=self.loader_name, batch=self.batch_size),
+            wall_time=wall_time,
+            rows=sum(step.written for step in steps),
+            peak_rss=peak,
+            )
+        self.stdout.write('\t{total:<20}{time:>9.2f}{rate:>38.0f}{peak:>10.1f}'.format(
+            total='total', time=wall_time, rate=profile.rows / max(wall_time, 1e-6),
+            peak=peak / 2.0 ** 20))
+        if self.jobs > 1:
+            self.stdout.write('\t(total peak MB: main process + largest of the workers)')
+        if self.profile_dir:
+            self.stdout.write('\tcProfile stats written to {dir}'.format(dir=self.profile_dir))
+    
+    def _file_changed(self, step, source):
+        '''
+        Checks `source` against the fingerprint recorded in `step`. The
+        checksum is only computed if size or mtime differ.
+        '''
+        size, mtime = source.stat()
+        if (step.size, step.mtime) == (size, mtime):
+            return False
+        if step.checksum and step.checksum == source.checksum():
+            # Touched but not changed
+            step.size = size
+            step.mtime = mtime
+            step.save()
+            return False
+        return True
+    
+    def invalidate_changed(self, scheduler):
+        '''
+        Finds the steps fed by files that changed since the last import
+        of the experiment and rolls them back together with all the
+        steps depending on them, dependent steps first. The rolled back
+        steps are marked stale and get reloaded by `scheduler.run`.
+        '''
+        checkpoints = dict((step.name, step)
+            for step in ImportStep.objects.filter(experiment=self.exp))
+        changed = set()
+        for name, (func, (state, name, source, method, args), deps) in scheduler.steps.items():
+            step = checkpoints.get(name)
+            if step is None or step.status != ImportStep.DONE or self._file_changed(step, source):
+                changed.add(name)
+        stale = scheduler.dependents(changed)
+        for name in reversed(scheduler.order()):
+            if name not in stale:
+                continue
+            state, name, source, method, args = scheduler.steps[name][1]
+            self.stdout.write('\t... rolling back {name} ...'.format(name=name))
+            self.rollback_step(method, args)
+            ImportStep.objects.filter(experiment=self.exp, name=name).update(
+                status=ImportStep.STALE)
+        return stale
+    
+    def drop_indexes(self, scheduler):
+        '''
+        Drops the secondary indexes of the tables written by the
+        `scheduler` steps. The index definitions are saved as
+        DeferredIndex so that they survive a failed import.
+        '''
+        for name in scheduler.order():
+            state, name, source, method, args = scheduler.steps[name][1]
+            for model in self._step_models(method, args):
+                table = model._meta.db_table
+                indexes = self.indexes.get_indexes(table)
+                for index, definition in indexes:
+                    DeferredIndex.objects.get_or_create(table=table, name=index,
+                        defaults={'definition': definition})
+                self.indexes.drop_indexes(table, [index for index, definition in indexes])
+    
+    def rebuild_indexes(self):
+        '''
+        Rebuilds all the indexes dropped by --defer-indexes, one table
+        at a time.
+        '''
+        tables = {}
+        for index in DeferredIndex.objects.all():
+            tables.setdefault(index.table, []).append(index.definition)
+        for table, definitions in sorted(tables.items()):
+            self.stdout.write('\t... {table} ({num} indexes) ...'.format(
+                table=table, num=len(definitions)))
+            self.indexes.create_indexes(table, definitions)
+            DeferredIndex.objects.filter(table=table).delete()
+    
+    def check_references(self, scheduler):
+        '''
+        Checks that the rows written by the `scheduler` steps only
+        reference existing rows. Steps that wrote rows with broken
+        references are marked failed so that --resume reloads them.
+        Returns the list of problems found.
+        '''
+        broken = []
+        for name in scheduler.order():
+            state, name, source, method, args = scheduler.steps[name][1]
+            for model in self._step_models(method, args):
+                for field, count in self.indexes.check_references(model, self.exp.pk):
+                    broken.append('{count} {model}.{field} ({name})'.format(count=count,
+                        model=model._meta.object_name, field=field, name=name))
+                    ImportStep.objects.filter(experiment=self.exp, name=name).update(
+                        status=ImportStep.FAILED)
+        return broken
+    
+    def find_file(self, filename):
+        '''
+        Returns `cuff.sources.Source` for cuffdiff output file
+        `filename` (or its .gz, .bz2, .xz variant) in the output
+        directory or archive, None if there is no such file.
+        '''
+        try:
+            return self.location.find(filename)
+        except ValueError as e:
+            raise CommandError(str(e))
+    
+    def add_track_steps(self, scheduler, track, parents, fpkm, diff, count, replicate):
+        '''
+        Adds the steps importing data track to the `scheduler`:
+            - Track and TrackData (go first, everything else references
+              the track rows)
             - TrackExpDiffData
             - TrackCount
             - TrackReplicateData
-            - optional tables such as promoters, splicing, cdsdiff, etc
         '''
-        if os.path.exists(fpkm):
-            self.stdout.write('\t... processing .fpkm file ...')
-            track_count = self._process_fpkm(track, fpkm)[0]
-        else:
+        fpkm, diff, count, replicate = [self.find_file(f)
+            for f in (fpkm, diff, count, replicate)]
+        if fpkm is None:
             raise CommandError('%s .fpkm file is missing!' % track)
-        if os.path.exists(diff):
-            self.stdout.write('\t... processing .diff file ...')
-            self._process_diff(track, diff)
-        else:
+        if diff is None:
             raise CommandError('%s .diff file is missing!' % track)
+        state = self.get_state()
+        # Parent tracks may be excluded
+        deps = ['reptable'] + [p for p in parents if p in scheduler.steps]
+        scheduler.add(track, run_step,
+            (state, track, fpkm, '_process_fpkm', (track, fpkm)), deps)
+        name = '%s.diff' % track
+        scheduler.add(name, run_step,
+            (state, name, diff, '_process_diff', (track, diff)), (track,))
         # Optional
-        diff_count = 0
-        if 'promoter' in kwargs and track == 'gene':
-            promoter = kwargs.get('promoter')
-            if os.path.exists(promoter):
-                self.stdout.write('\t... processing promoters.diff ...')
-                diff_count = self._process_diff('gene', promoter, diff='diffdata')
-            else:
-                raise CommandError('Promoters .diff file is missing!')
-        if 'splicing' in kwargs and track == 'tss':
-            splicing = kwargs.get('splicing')
-            if os.path.exists(splicing):
-                self.stdout.write('\t... processing splicing.diff ...')
-                diff_count = self._process_diff('tss', splicing, 'diffdata')
-            else:
-                raise CommandError('Splicing .diff file is missing!')
-        if 'cds_diff' in kwargs and track == 'cds':
-            cds_diff = kwargs.get('cds_diff')
-            if os.path.exists(cds_diff):
-                self.stdout.write('\t... processing CDS .diff ...')
-                diff_count = self._process_diff('cds', cds_diff, 'diffdata')
-            else:
-                raise CommandError('CDS .diff file is missing!')
-                
-        if 'count' in kwargs:
-            count = kwargs.get('count')
-            if os.path.exists(count):
-                self.stdout.write('\t... processing .count_tracking file ...')
-                self._process_count(track, count)
-        if 'replicate' in kwargs:
-            replicate = kwargs.get('replicate')
-            if os.path.exists(replicate):
-                self.stdout.write('\t... processing .read_group_tracking file ...')
-                self._process_replicate(track, replicate)
-        self.stdout.write('Finished processing %s track.' % track)
-        return track_count, diff_count
-        
+        if count is not None:
+            name = '%s.count' % track
+            scheduler.add(name, run_step,
+                (state, name, count, '_process_count', (track, count)), (track,))
+        if replicate is not None:
+            name = '%s.replicate' % track
+            scheduler.add(name, run_step,
+                (state, name, replicate, '_process_replicate', (track, replicate)), (track,))
+    
+    def add_dist_step(self, scheduler, dist, track, file, parent):
+        '''
+        Adds the step importing distribution level diff data (promoters,
+        splicing, cdsdiff) for `track`. Rows reference the `parent` track.
+        '''
+        file = self.find_file(file)
+        if file is None:
+            raise CommandError('%s .diff file is missing!' % dist)
+        scheduler.add(dist, run_step,
+            (self.get_state(), dist, file, '_process_diff', (track, file, 'diffdata')),
+            sorted(set([track, parent])))
+    
+    def _feature_ids(self, lines):
+        '''
+        Returns primary keys of the experiment features by their line
+        in the .gtf file, for the `lines` range (first, last).
+        '''
+        return dict(Feature.objects.filter(experiment=self.exp, line__range=lines
+            ).values_list('line', 'pk'))
+    
     def import_gtf(self, file):
-        pass
+        '''
+        Imports features and their attributes from .gtf file. Features
+        are written batch by batch and read back by their lines to get
+        the ids for their Attribute rows.
+        '''
+        self.stdout.write('\t... processing {file} ...'.format(file=file.name))
+        track_ids = dict((f.attname, self._track_ids(f.rel.to))
+            for f in Feature._meta.fields if f.rel and f.rel.to in TRACK_KEYS)
+        feature_types = dict((label, code) for code, label in Feature.TYPE_CHOICES)
+        feature_count = attr_count = 0
+        for features, attributes in reshape.read_gtf(file, feature_types, track_ids,
+                self.exp.pk, self.batch_size, profiler=self.profiler):
+            feature_count += self._write_batch(Feature, features)
+            ids = self._feature_ids((features['line'].min(), features['line'].max()))
+            if len(ids) != len(features):
+                raise CommandError('Expected {0} new features, found {1}'.format(
+                    len(features), len(ids)))
+            attributes['feature_id'] = attributes['feature'].map(ids)
+            attr_count += self._write_batch(Attribute,
+                attributes[['feature_id', 'attribute', 'value']])
+        self.stdout.write('\t...\t {fcount} features and {acount} attributes ...'.format(
+            fcount=feature_count, acount=attr_count))
+        return feature_count
+    
+    def create_partitions(self):
+        '''
+        Creates the partitions of the experiment in the partitioned
+        data tables (see `cuff.partitions`), which can't take its rows
+        otherwise.
+        '''
+        partitions = get_partition_manager()
+        if partitions is None:
+            return
+        for table in partitions.create_partitions(self.exp.pk):
+            self.stdout.write('\t... partition of {table}'.format(table=table))
+    
+    def write_matrices(self, scheduler):
+        '''
+        Writes the expression matrix store of the imported tracks. The
+        store only speeds up the plots, so failing to write it doesn't
+        fail the import.
+        '''
+        tracks = [track[0] for track in TRACKS if track[0] in scheduler.steps]
+        try:
+            for store in matrices.write_matrices(self.exp, tracks):
+                self.stdout.write('\t... {path}'.format(path=store.path))
+        except (IOError, OSError) as e:
+            self.stdout.write('WARNING: matrices not written: {error}. Run build_matrices '
+                '{pk} to write them.'.format(error=e, pk=self.exp.pk))
     
     def handle(self, *args, **options):
         if len(args) != 1:
             raise CommandError('Invalid number of arguments.')
         dir = args[0]
         if not os.path.exists(dir):
-            raise CommandError('Directory %s does not exist.' % dir)
+            raise CommandError('%s does not exist.' % dir)
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        # The indexes are shared by all the experiments: dropping them
+        # would slow down browsing and imports of the others
+        if options['defer_indexes'] and Experiment.objects.exclude(
+                pk=options['resume'] or options['update']).exists():
+            raise CommandError('--defer-indexes can only be used for the first experiment '
+                'in the database.')
         self.set_options(dir, **options)
+        if options['resume']:
+            self.stdout.write('Resuming import of experiment {pk}'.format(pk=self.exp.pk))
+        elif options['update']:
+            self.stdout.write('Updating experiment {pk}'.format(pk=self.exp.pk))
         self.stdout.write('Importing experiment:\t{title}'.format(title=self.exp.title))
         self.stdout.write('\t... Species:\t{species}'.format(species=self.exp.species))
         self.stdout.write('\t... Library:\t{lib}'.format(lib=self.exp.library))
-        self.stdout.write('Reading Runinfo file ...')
-        self.import_runinfo(os.path.join(dir, RUNINFO_FILE))
-        self.stdout.write('Importing replicates and populating Samples table ...')
-        self.import_reptable(os.path.join(dir, REPLICATES_FILE))
-        if not 'gene' in self.exclude:
-            self.stdout.write('Importing genes ...')
-            gene_num, promoter_num = self.import_track('gene', os.path.join(dir, GENE_FPKM_FILE),
-                os.path.join(dir, GENEEXP_DIFF_FILE),
-                promoter=os.path.join(dir, PROMOTER_FILE),
-                count=os.path.join(dir, GENE_COUNT_FILE),
-                replicate=os.path.join(dir, GENE_REPLICATE_FILE)
-                )
-        if not 'TSS' in self.exclude:
-            self.stdout.write('Importing TSS groups ...')
-            tss_num, splicing_num = self.import_track('tss', os.path.join(dir, TSS_FPKM_FILE),
-                os.path.join(dir, TSSEXP_DIFF_FILE),
-                splicing=os.path.join(dir, SPLICING_FILE),
-                count=os.path.join(dir, TSS_COUNT_FILE),
-                replicate=os.path.join(dir, TSS_REPLICATE_FILE)
-                )
-        if not 'isoform' in self.exclude:
-            self.stdout.write('Importing isoforms ...')
-            isoform_num = self.import_track('isoform', os.path.join(dir, ISOFORM_FPKM_FILE),
-                os.path.join(dir, ISOFORMEXP_DIFF_FILE),
-                count=os.path.join(dir, ISOFORM_COUNT_FILE),
-                replicate=os.path.join(dir, ISOFORM_REPLICATE_FILE)
-                )[0] # Because there is no dist level data here
-        if not 'CDS' in self.exclude:
-            self.stdout.write('Importing CDS ...')
-            cds_num, relcds_num = self.import_track('cds', os.path.join(dir, CDS_FPKM_FILE),
-                os.path.join(dir, CDSEXP_DIFF_FILE),
-                cds_diff=os.path.join(dir, CDS_DIFF_FILE),
-                count=os.path.join(dir, CDS_COUNT_FILE),
-                replicate=os.path.join(dir, CDS_REPLICATE_FILE)
-                )
+        scheduler = Scheduler()
+        state = self.get_state()
+        runinfo = self.find_file(RUNINFO_FILE)
+        reptable = self.find_file(REPLICATES_FILE)
+        for file, filename in ((runinfo, RUNINFO_FILE), (reptable, REPLICATES_FILE)):
+            if file is None:
+                raise CommandError('%s file is missing!' % filename)
+        scheduler.add('runinfo', run_step,
+            (state, 'runinfo', runinfo, 'import_runinfo', (runinfo,)))
+        # Every track references Sample
+        scheduler.add('reptable', run_step,
+            (state, 'reptable', reptable, 'import_reptable', (reptable,)))
+        for track, name, parents, fpkm, diff, count, replicate in TRACKS:
+            if not name in self.exclude:
+                self.add_track_steps(scheduler, track, parents, fpkm, diff, count, replicate)
+        for dist, track, file, parent in DIST_TRACKS:
+            # Rows can't reference an excluded track
+            if track in scheduler.steps and parent in scheduler.steps:
+                self.add_dist_step(scheduler, dist, track, file, parent)
+        if self.gtf:
+            # Features reference the tracks but not their data, so
+            # the .gtf file is imported alongside the data files
+            scheduler.add('gtf', run_step,
+                (state, 'gtf', self.gtf, 'import_gtf', (self.gtf,)),
+                [track[0] for track in TRACKS if track[0] in scheduler.steps])
+        if options['update']:
+            stale = self.invalidate_changed(scheduler)
+            self.stdout.write('Reloading {num} of {total} steps ...'.format(
+                num=len(stale), total=len(scheduler.steps)))
+        if self.indexes and DeferredIndex.objects.exists() and not self.defer_indexes:
+            self.stdout.write('Rebuilding indexes left by a failed import ...')
+            self.rebuild_indexes()
+        if self.defer_indexes:
+            self.stdout.write('Dropping secondary indexes ...')
+            self.drop_indexes(scheduler)
+        self.create_partitions()
+        self.stdout.write('Importing ({jobs} jobs) ...'.format(jobs=self.jobs))
+        if self.jobs > 1:
+            # Worker processes must not share the connection of the parent
+            connection.close()
+            immediate_transactions(connection)
+        since = timezone.now()
+        start = time.time()
+        try:
+            results = scheduler.run(self.jobs)
+        except StepFailed as e:
+            if self.defer_indexes:
+                self.stdout.write('Indexes stay dropped until the next import_exp run')
+            raise CommandError(str(e))
+        if self.profile:
+            self.report_profile(since, time.time() - start)
+        if self.defer_indexes:
+            self.stdout.write('Checking references ...')
+            broken = self.check_references(scheduler)
+            self.stdout.write('Rebuilding indexes ...')
+            self.rebuild_indexes()
+            if broken:
+                raise CommandError('Rows referencing missing rows: {broken}. The steps '
+                    'are marked failed, run import_exp --resume={pk} to reload them.'.format(
+                    broken=', '.join(broken), pk=self.exp.pk))
         # Now dump all the stats into a separate table for an easy
         # access later
+        ExpStat.objects.filter(experiment=self.exp).delete()
         ExpStat.objects.create(
             experiment=self.exp,
-            gene_count=gene_num,
-            promoter_count=promoter_num,
-            tss_count=tss_num,
-            splicing_count=splicing_num,
-            isoform_count=isoform_num,
-            cds_count=cds_num,
-            relcds_count=relcds_num
+            gene_count=results.get('gene', 0),
+            promoter_count=results.get('promoter', 0),
+            tss_count=results.get('tss', 0),
+            splicing_count=results.get('splicing', 0),
+            isoform_count=results.get('isoform', 0),
+            cds_count=results.get('cds', 0),
+            relcds_count=results.get('relcds', 0)
         )
-        if self.gtf:
-            self.stdout.write('Importing .GTF file ...')
-            self.import_gtf(self.gtf)
+        # Row counts of the tables are taken again by the views
+        TableStat.objects.filter(experiment=self.exp).delete()
+        if self.matrices:
+            self.stdout.write('Writing expression matrices ...')
+            self.write_matrices(scheduler)
         self.stdout.write('DONE.')
+
+
+def run_step(state, name, source, method, args):
+    '''
+    Runs a single checkpointed import step (see
+    `Command.run_checkpointed`). Defined at module level so that it can
+    be sent to the worker processes.
+    '''
+    command = Command()
+    command.set_state(state)
+    return command.run_checkpointed(name, source, method, args)
+
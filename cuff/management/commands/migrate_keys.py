@@ -0,0 +1,294 @@
+from optparse import make_option
+
+import pandas as pd
+
+from django.db import connections, transaction
+from django.db.models.loading import get_models, get_app
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+
+from cuff.annotations import AnnotationDictionary, COLUMNS as ANNOTATION_COLUMNS, KEY
+from cuff.locus import parse_loci
+from cuff.models import Experiment, Sample, Replicate, TrackBase, Gene, TSS, CDS, Isoform
+from cuff.reshape import NA_VALUES
+
+# Columns holding the string composite keys ('<id>-exp-<exp_pk>') the
+# old schema used to reference these models
+OLD_KEYS = {
+    Gene: 'track_pk',
+    TSS: 'track_pk',
+    CDS: 'track_pk',
+    Isoform: 'track_pk',
+    Sample: 'sample_pk',
+    Replicate: 'rep_pk',
+    }
+
+# Track columns of the old schema replaced by the annotation and
+# coordinate fields
+LOCUS_FIELDS = ('chrom', 'chrom_start', 'chrom_end', 'bin',)
+
+# Number of rows copied at once
+BATCH_SIZE = 10000
+
+
+def sort_models(models):
+    '''
+    Returns `models` ordered so that every model comes after the
+    models it references.
+    '''
+    ordered = []
+    def visit(model):
+        if model in ordered:
+            return
+        for field in model._meta.fields:
+            if field.rel and field.rel.to is not model and field.rel.to in models:
+                visit(field.rel.to)
+        ordered.append(model)
+    for model in models:
+        visit(model)
+    return ordered
+
+
+class Command(BaseCommand):
+    '''
+    Copies experiments from a database with the old schema, which used
+    string composite keys (track_pk, sample_pk, rep_pk) in place of
+    foreign keys, to the current schema with integer foreign keys.
+
+    Run syncdb for the (new, empty) target database first and add the
+    old one to DATABASES, e.g. as 'old'. Experiments are copied one at
+    a time, every table in batches ordered by primary key. Primary keys
+    are kept, the string references are translated to them. Experiments
+    already present in the target database are skipped, so an
+    interrupted migration can simply be restarted.
+
+    The annotation columns of the old track tables (nearest_ref_id,
+    gene_short_name, locus) are linked to the shared annotation
+    dictionary (see `cuff.annotations`) and the loci parsed into the
+    coordinate columns (see `cuff.locus`), as `import_exp` does.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--from-database', default=None, dest='source',
+            help='Database (DATABASES key) with the old schema'),
+        make_option('--database', default='default', dest='target',
+            help='Database to copy the experiments to (default: default)'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows copied at once (default: %d)' % BATCH_SIZE),
+        )
+    args = '[EXP_PK ...]'
+    help = 'Migrates experiments from the string composite keys schema to integer keys.'
+
+    def _fetch(self, sql, params=()):
+        cursor = self.source.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def _old_table_columns(self, model):
+        return set(c[0] for c in self.source.introspection.get_table_description(
+            self.source.cursor(), model._meta.db_table))
+
+    def _old_columns(self, model):
+        '''
+        Returns fields of `model` with a column in the old table. Tables
+        of even older schemas may lack some of them.
+        '''
+        old = self._old_table_columns(model)
+        return [f for f in model._meta.fields if f.column in old]
+
+    def _old_annotations(self, model, fields):
+        '''
+        Returns the annotation columns (nearest_ref_id, gene_short_name,
+        locus) of the old `model` track table and the fields derived
+        from them: `annotation` and the coordinates of the locus.
+        '''
+        if not issubclass(model, TrackBase):
+            return [], []
+        old = self._old_table_columns(model)
+        columns = [c for c in ANNOTATION_COLUMNS if c in old]
+        names = []
+        if all(c in columns for c in KEY):
+            names.append('annotation')
+        if 'locus' in columns:
+            names.extend(LOCUS_FIELDS)
+        return columns, [model._meta.get_field(n) for n in names
+            if model._meta.get_field(n) not in fields]
+
+    def derive(self, frame, derived):
+        '''
+        Returns the values of the `derived` fields for the old
+        annotation columns in `frame`, a list per row.
+        '''
+        # Missing values as import_exp stores them
+        frame = frame.replace(NA_VALUES, '')
+        values = {}
+        names = [f.name for f in derived]
+        if 'annotation' in names:
+            values['annotation'] = self.annotations.upsert(frame)
+        if 'chrom' in names:
+            loci = parse_loci(frame['locus'])
+            values.update((n, loci[n]) for n in LOCUS_FIELDS)
+        columns = []
+        for name in names:
+            column = values[name]
+            convert = unicode if name == 'chrom' else int
+            columns.append([None if pd.isnull(v) else convert(v) for v in column])
+        return [list(row) for row in zip(*columns)]
+
+    def _scope(self, model):
+        '''
+        Returns SQL condition (with a single experiment pk parameter)
+        selecting the old `model` rows of an experiment, None if the
+        rows are not related to experiments.
+        '''
+        qn = self.source.ops.quote_name
+        if model is Experiment:
+            return '{pk} = %s'.format(pk=qn(model._meta.pk.column))
+        fields = self._old_columns(model)
+        for field in fields:
+            if field.name == 'experiment':
+                return '{column} = %s'.format(column=qn(field.column))
+        for field in fields:
+            parent = field.rel.to if field.rel else None
+            if parent is None or parent is model:
+                continue
+            scope = self._scope(parent)
+            if scope is not None:
+                return '{column} IN (SELECT {key} FROM {table} WHERE {scope})'.format(
+                    column=qn(field.column),
+                    key=qn(OLD_KEYS.get(parent, parent._meta.pk.column)),
+                    table=qn(parent._meta.db_table),
+                    scope=scope)
+        return None
+
+    def get_lookups(self, exp_pk):
+        '''
+        Returns {model: {string key: pk}} for the experiment rows of the
+        models referenced by string keys in the old schema.
+        '''
+        qn = self.source.ops.quote_name
+        lookups = {}
+        for model, key in OLD_KEYS.items():
+            scope = self._scope(model)
+            if scope is None:
+                # No such table in the old database
+                lookups[model] = {}
+                continue
+            lookups[model] = dict(self._fetch('SELECT {key}, {pk} FROM {table} WHERE {scope}'.format(
+                key=qn(key),
+                pk=qn(model._meta.pk.column),
+                table=qn(model._meta.db_table),
+                scope=scope), [exp_pk]))
+        return lookups
+
+    def copy_rows(self, model, exp_pk, lookups):
+        '''
+        Copies old `model` rows of experiment `exp_pk` batch by batch.
+        Returns the numbers of copied rows and of rows dropped because
+        a required reference is missing (e.g. tracks excluded from the
+        import).
+        '''
+        qn = self.source.ops.quote_name
+        fields = self._old_columns(model)
+        annotation, derived = self._old_annotations(model, fields)
+        pk = model._meta.pk.column
+        select = 'SELECT {columns} FROM {table} WHERE {scope} AND {pk} > %s ORDER BY {pk} LIMIT %s'.format(
+            columns=', '.join(qn(c) for c in [f.column for f in fields] + annotation),
+            table=qn(model._meta.db_table),
+            scope=self._scope(model),
+            pk=qn(pk))
+        # Track data rows of the old schema have no experiment column,
+        # required fields added since (Experiment.archived) take their
+        # defaults
+        extra = [f for f in model._meta.fields if f not in fields and
+            (f.name == 'experiment' or (not f.null and f.has_default()))]
+        defaults = [exp_pk if f.name == 'experiment' else f.get_db_prep_save(
+            f.get_default(), connection=self.target) for f in extra]
+        insert = 'INSERT INTO {table} ({columns}) VALUES ({values})'.format(
+            table=self.target.ops.quote_name(model._meta.db_table),
+            columns=', '.join(self.target.ops.quote_name(f.column)
+                for f in fields + derived + extra),
+            values=', '.join(['%s'] * len(fields + derived + extra)))
+        references = [(i, lookups[f.rel.to], f.null) for i, f in enumerate(fields)
+            if f.rel and f.rel.to in lookups]
+        # Old schema stored cuffdiff labels (status, significant) as text
+        codes = [(i, dict((label, code) for code, label in f.choices))
+            for i, f in enumerate(fields) if f.choices]
+        pk_index = [f.column for f in fields].index(pk)
+        copied = dropped = 0
+        last_pk = 0
+        while True:
+            rows = self._fetch(select, [exp_pk, last_pk, self.batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][pk_index]
+            batch = []
+            for row in rows:
+                row = list(row)
+                for i, choices in codes:
+                    row[i] = choices.get(row[i], row[i])
+                for i, lookup, null in references:
+                    if row[i] is None:
+                        continue
+                    row[i] = lookup.get(row[i])
+                    if row[i] is None and not null:
+                        break
+                else:
+                    batch.append(row)
+                    continue
+                dropped += 1
+            derived_values = [[]] * len(batch)
+            if derived and batch:
+                # Old annotation columns follow the fields
+                derived_values = self.derive(pd.DataFrame([row[len(fields):] for row in batch],
+                    columns=annotation), derived)
+            batch = [row[:len(fields)] + values + defaults
+                for row, values in zip(batch, derived_values)]
+            if batch:
+                self.target.cursor().executemany(insert, batch)
+            copied += len(batch)
+        return copied, dropped
+
+    def migrate_experiment(self, exp_pk, models):
+        lookups = self.get_lookups(exp_pk)
+        with transaction.atomic(using=self.target.alias):
+            for model in models:
+                copied, dropped = self.copy_rows(model, exp_pk, lookups)
+                if copied or dropped:
+                    self.stdout.write('\t... {model}: {copied} rows{dropped}'.format(
+                        model=model._meta.object_name,
+                        copied=copied,
+                        dropped=' ({0} dropped, missing references)'.format(dropped)
+                            if dropped else ''))
+
+    def handle(self, *args, **options):
+        if not options['source']:
+            raise CommandError('--from-database is required.')
+        for alias in (options['source'], options['target']):
+            if alias not in connections.databases:
+                raise CommandError('Database %s is not configured.' % alias)
+        self.source = connections[options['source']]
+        self.target = connections[options['target']]
+        self.batch_size = options['batch_size']
+        self.annotations = AnnotationDictionary(self.target)
+        models = sort_models([m for m in get_models(get_app('cuff'))
+            if self._scope(m) is not None])
+        if args:
+            exp_pks = [int(pk) for pk in args]
+        else:
+            exp_pks = [pk for pk, in self._fetch('SELECT {pk} FROM {table} ORDER BY {pk}'.format(
+                pk=self.source.ops.quote_name(Experiment._meta.pk.column),
+                table=self.source.ops.quote_name(Experiment._meta.db_table)))]
+        migrated = Experiment.objects.using(self.target.alias).filter(pk__in=exp_pks)
+        done = set(migrated.values_list('pk', flat=True))
+        for exp_pk in exp_pks:
+            if exp_pk in done:
+                self.stdout.write('Experiment {pk} is already migrated, skipping ...'.format(pk=exp_pk))
+                continue
+            self.stdout.write('Migrating experiment {pk} ...'.format(pk=exp_pk))
+            self.migrate_experiment(exp_pk, models)
+        # Rows were inserted with their primary keys
+        cursor = self.target.cursor()
+        for sql in self.target.ops.sequence_reset_sql(no_style(), models):
+            cursor.execute(sql)
+        self.stdout.write('DONE.')
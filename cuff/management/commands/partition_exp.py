@@ -0,0 +1,85 @@
+from optparse import make_option
+
+from django.db import connections, transaction
+from django.core.management.base import BaseCommand, CommandError
+
+from cuff.partitions import get_partition_manager, partitioned_models
+
+
+class Command(BaseCommand):
+    '''
+    Manages the partitioning of the track data tables by experiment (see
+    `cuff.partitions`), MySQL and PostgreSQL only.
+
+    --setup turns the data tables into partitioned tables, once per
+    database. Afterwards every experiment needs its partitions before
+    its rows can be written: `import_exp` creates them, --create does it
+    ahead of the import. --detach turns the partitions of an experiment
+    into standalone `<table>_exp<pk>` tables (e.g. to archive them),
+    --drop discards them. Without an action the partitions are listed.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--database', default='default', dest='database',
+            help='Database to partition (default: default)'),
+        make_option('--setup', action='store_const', const='setup', dest='action',
+            help='Partition the data tables by experiment'),
+        make_option('--create', action='store_const', const='create', dest='action',
+            help='Create the partitions of the experiments'),
+        make_option('--detach', action='store_const', const='detach', dest='action',
+            help='Detach the partitions of the experiments into standalone tables'),
+        make_option('--drop', action='store_const', const='drop', dest='action',
+            help='Drop the partitions of the experiments with their rows'),
+        )
+    args = '[EXP_PK ...]'
+    help = 'Partitions the data tables by experiment.'
+
+    def setup(self):
+        for model in partitioned_models():
+            table = model._meta.db_table
+            if self.partitions.is_partitioned(table):
+                self.stdout.write('{table}: already partitioned'.format(table=table))
+                continue
+            self.stdout.write('{table}: partitioning ...'.format(table=table))
+            with transaction.atomic(using=self.connection.alias):
+                self.partitions.setup(model)
+
+    def status(self):
+        tables = self.partitions.partitioned_tables()
+        if not tables:
+            self.stdout.write('The data tables are not partitioned, run --setup.')
+        for table in tables:
+            self.stdout.write('{table}: {pks}'.format(table=table,
+                pks=', '.join(str(pk) for pk in sorted(self.partitions.get_partitions(table)))))
+
+    def handle(self, *args, **options):
+        if options['database'] not in connections.databases:
+            raise CommandError('Database %s is not configured.' % options['database'])
+        self.connection = connections[options['database']]
+        self.partitions = get_partition_manager(self.connection)
+        if self.partitions is None:
+            raise CommandError('Partitioning is not supported for {vendor} databases.'.format(
+                vendor=self.connection.vendor))
+        action = options['action']
+        try:
+            exp_pks = [int(pk) for pk in args]
+        except ValueError:
+            raise CommandError('Experiment pks must be integers.')
+        if action == 'setup':
+            self.setup()
+        elif action is None:
+            self.status()
+        else:
+            if not exp_pks:
+                raise CommandError('Give the pks of the experiments.')
+            if not self.partitions.partitioned_tables():
+                raise CommandError('The data tables are not partitioned, run --setup first.')
+            method = getattr(self.partitions, '{0}_partitions'.format(action))
+            for exp_pk in exp_pks:
+                with transaction.atomic(using=self.connection.alias):
+                    tables = method(exp_pk)
+                self.stdout.write('Experiment {pk}: {num} partitions {done}'.format(
+                    pk=exp_pk, num=len(tables), done={'create': 'created',
+                    'detach': 'detached', 'drop': 'dropped'}[action]))
+                for table in tables:
+                    self.stdout.write('\t{table}'.format(table=table))
+        self.stdout.write('DONE.')
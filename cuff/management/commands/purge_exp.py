@@ -0,0 +1,56 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cuff.models import Experiment
+from cuff.purge import purge_experiment, BATCH_SIZE
+
+
+class Command(BaseCommand):
+    '''
+    Deletes experiments with all their tracks, data, features, import
+    checkpoints and expression matrices without going through the ORM
+    cascade collector, see `cuff.purge`.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+            help='Do NOT prompt the user for input of any kind.'),
+        make_option('--batch-size', default=BATCH_SIZE, dest='batch_size',
+            type='int',
+            help='Number of rows deleted at once (default: %d)' % BATCH_SIZE),
+        )
+    args = 'EXP_PK [EXP_PK ...]'
+    help = 'Deletes experiments in batches of set-based DELETE statements.'
+
+    def progress(self, model, deleted):
+        if deleted and self.verbosity > 1:
+            self.stdout.write('\t... {model}: {num} rows ...'.format(
+                model=model._meta.object_name, num=deleted))
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Give the pks of the experiments to delete.')
+        self.verbosity = int(options['verbosity'])
+        exps = []
+        for pk in args:
+            try:
+                exps.append(Experiment.objects.get(pk=int(pk)))
+            except (ValueError, Experiment.DoesNotExist):
+                raise CommandError('Experiment %s does not exist.' % pk)
+        if options['interactive']:
+            confirm = raw_input('This will permanently delete experiments:\n{exps}\n'
+                'Type \'yes\' to continue, or \'no\' to cancel: '.format(
+                exps='\n'.join('\t{0}: {1}'.format(exp.pk, exp.title) for exp in exps)))
+            if confirm != 'yes':
+                self.stdout.write('Purge cancelled.')
+                return
+        for exp in exps:
+            self.stdout.write('Purging experiment {pk} ({title}) ...'.format(
+                pk=exp.pk, title=exp.title))
+            deleted = purge_experiment(exp, batch_size=options['batch_size'],
+                progress=self.progress)
+            for model, num in sorted(deleted.items(), key=lambda x: x[0]._meta.object_name):
+                if num:
+                    self.stdout.write('\t{model}: {num} rows deleted'.format(
+                        model=model._meta.object_name, num=num))
+        self.stdout.write('DONE.')
@@ -0,0 +1,214 @@
+'''
+Per-experiment expression matrix store.
+
+Plots and analyses need track x sample matrices, which are expensive to
+rebuild from the molten <Track>Data rows. `import_exp` (and the
+`build_matrices` command for experiments imported before) writes them
+once per experiment and track as .npy files:
+
+    <CUFF_MATRIX_DIR>/exp<pk>/<track>/
+        pk.npy              primary keys of the tracks (rows), ascending
+        ids.npy             cuffdiff ids of the tracks (gene_id, ...)
+        samples.npy         primary keys of the samples (columns)
+        replicates.npy      primary keys of the replicates (columns of
+                            replicate_fpkm)
+        fpkm.npy            float32 tracks x samples
+        conf_lo.npy
+        conf_hi.npy
+        count.npy
+        dispersion.npy
+        replicate_fpkm.npy  float32 tracks x replicates
+
+Missing values are NaN. The files are memory-mapped when read, so
+loading a store costs nothing until the values are touched and the
+pages are shared between the processes serving the plots:
+
+    >>> store = get_store(exp, 'gene')
+    >>> store.frame('fpkm')         # DataFrame, track pks x sample pks
+    >>> store['fpkm'][store.rows([pk1, pk2])]
+
+The store is disabled if CUFF_MATRIX_DIR is not set.
+'''
+import os
+import shutil
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from django.db.models.loading import get_model
+
+from cuff.models import Sample, Replicate
+
+# Track names as used in the urls
+TRACKS = ('gene', 'tss', 'cds', 'isoform',)
+
+# Matrices: (data model suffix, columns, value fields)
+MATRICES = (
+    ('data', 'samples', ('fpkm', 'conf_lo', 'conf_hi',)),
+    ('count', 'samples', ('count', 'dispersion',)),
+    ('replicatedata', 'replicates', ('fpkm',)),
+    )
+
+# Number of rows fetched from the database at once
+BATCH_SIZE = 100000
+
+
+def get_root():
+    return getattr(settings, 'CUFF_MATRIX_DIR', None)
+
+
+def _exp_pk(exp):
+    return getattr(exp, 'pk', exp)
+
+
+def _track_field(model, track_model):
+    for field in model._meta.fields:
+        if field.rel and field.rel.to is track_model:
+            return field
+
+
+class MatrixStore(object):
+    '''
+    Matrices of experiment `exp` (instance or pk) for `track` ('gene',
+    'tss', 'cds' or 'isoform').
+    '''
+    def __init__(self, exp, track, root=None):
+        if track.lower() not in TRACKS:
+            raise ValueError('Unknown track: {0}'.format(track))
+        self.exp_pk = _exp_pk(exp)
+        self.track = track.lower()
+        self.root = root or get_root()
+        self.path = os.path.join(self.root, 'exp{0}'.format(self.exp_pk), self.track)
+        self._arrays = {}
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'pk.npy'))
+
+    def __contains__(self, name):
+        return os.path.exists(os.path.join(self.path, '{0}.npy'.format(name)))
+
+    def __getitem__(self, name):
+        '''
+        Returns the read-only memory-mapped array `name`.
+        '''
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, '{0}.npy'.format(name)),
+                mmap_mode='r')
+        return self._arrays[name]
+
+    def rows(self, pks):
+        '''
+        Returns the row indices of the tracks with primary keys `pks`.
+        Raises KeyError if some of them are not in the store.
+        '''
+        pks = np.asarray(pks, dtype=np.int64)
+        rows = np.searchsorted(self['pk'], pks)
+        rows[rows >= len(self['pk'])] = 0
+        if len(pks) and not (self['pk'][rows] == pks).all():
+            raise KeyError('Tracks missing from the store')
+        return rows
+
+    def column(self, sample_pk, columns='samples'):
+        '''
+        Returns the column index of sample (or replicate) `sample_pk`.
+        '''
+        index = np.searchsorted(self[columns], sample_pk)
+        if index >= len(self[columns]) or self[columns][index] != sample_pk:
+            raise KeyError(sample_pk)
+        return index
+
+    def frame(self, name):
+        '''
+        Returns matrix `name` as a DataFrame indexed by track pks with
+        sample (replicate) pks as columns. The values are not copied.
+        '''
+        columns = 'replicates' if name.startswith('replicate_') else 'samples'
+        return pd.DataFrame(self[name], index=self['pk'], columns=self[columns], copy=False)
+
+    def write(self):
+        '''
+        Builds the matrices from the database. The files are written
+        to a temporary directory which then replaces the store.
+        '''
+        track_model = get_model('cuff', self.track)
+        # (experiment, <cuffdiff id>)
+        key = track_model._meta.unique_together[0][1]
+        tracks = track_model._default_manager.for_exp(self.exp_pk).order_by('pk')
+        pks, ids = zip(*tracks.values_list('pk', key)) or ((), ())
+        arrays = {
+            'pk': np.array(pks, dtype=np.int64),
+            'ids': np.array(ids, dtype=str),
+            'samples': np.array(Sample.objects.filter(experiment=self.exp_pk).order_by(
+                'pk').values_list('pk', flat=True), dtype=np.int64),
+            'replicates': np.array(Replicate.objects.filter(
+                sample__experiment=self.exp_pk).order_by('pk').values_list('pk', flat=True),
+                dtype=np.int64),
+            }
+        for suffix, columns, fields in MATRICES:
+            model = get_model('cuff', '{0}{1}'.format(self.track, suffix))
+            column_field = 'rep_name_id' if columns == 'replicates' else 'sample_id'
+            names = [('replicate_' if columns == 'replicates' else '') + f for f in fields]
+            matrices = [np.full((len(arrays['pk']), len(arrays[columns])), np.nan,
+                dtype=np.float32) for f in fields]
+            rows = model._default_manager.for_exp(self.exp_pk).values_list(
+                _track_field(model, track_model).attname, column_field, *fields).iterator()
+            while True:
+                batch = np.array(list(islice(rows, BATCH_SIZE)), dtype=np.float64)
+                if not len(batch):
+                    break
+                i = np.searchsorted(arrays['pk'], batch[:, 0].astype(np.int64))
+                j = np.searchsorted(arrays[columns], batch[:, 1].astype(np.int64))
+                for k, matrix in enumerate(matrices):
+                    matrix[i, j] = batch[:, k + 2]
+            arrays.update(zip(names, matrices))
+        tmp = '{0}.tmp{1}'.format(self.path, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, '{0}.npy'.format(name)), array)
+        self.delete()
+        os.rename(tmp, self.path)
+        self._arrays = {}
+
+    def delete(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+
+def get_store(exp, track):
+    '''
+    Returns the MatrixStore of `exp` and `track`, None if the store is
+    disabled or the matrices are not written.
+    '''
+    if not get_root() or track.lower() not in TRACKS:
+        return None
+    store = MatrixStore(exp, track)
+    return store if store.exists() else None
+
+
+def write_matrices(exp, tracks=TRACKS):
+    '''
+    Writes the matrices of experiment `exp` for all the `tracks` with
+    rows in the database. Returns the written stores.
+    '''
+    stores = []
+    for track in tracks:
+        if get_model('cuff', track)._default_manager.for_exp(_exp_pk(exp)).exists():
+            store = MatrixStore(exp, track)
+            store.write()
+            stores.append(store)
+    return stores
+
+
+def delete_matrices(exp):
+    '''
+    Removes all the matrices of experiment `exp`.
+    '''
+    if not get_root():
+        return
+    path = os.path.join(get_root(), 'exp{0}'.format(_exp_pk(exp)))
+    if os.path.exists(path):
+        shutil.rmtree(path)
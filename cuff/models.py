@@ -48,16 +48,51 @@ Data file parsing order:
 from django.db import models
 from django.db.models import options
 
-# Allow models to define fields to be displayed in the list view
-options.DEFAULT_NAMES += ('list_display',)
+# Allow models to define fields to be displayed in the list view, and
+# the related fields their __unicode__ reads (selected along with them
+# by the list views)
+options.DEFAULT_NAMES += ('list_display', 'display_related',)
 
 # Common fields for different track views
-TRACK_BASE_FIELDS = ('locus', 'length', 'coverage',)
+TRACK_BASE_FIELDS = ('annotation', 'length', 'coverage',)
 TRACK_DATA_FIELDS = ('sample', 'fpkm', 'conf_hi', 'conf_lo', 'status',)
 TRACK_COUNT_FIELDS = ('sample', 'count', 'variance', 'uncertainty', 'dispersion', 'status',)
 TRACK_REPLICATE_FIELDS = ('sample', 'replicate', 'raw_frags', 'internal_scaled_frags', 'external_scaled_frags', 'fpkm', 'status',)
-TRACK_EXPDIFF_FIELDS = ('value_1', 'value_2', 'log2_fold_change', 'status', 'p_value', 'q_value', 'significant',)
-TRACK_DIFF_FIELDS = ('value_1', 'value_2', 'js_dist', 'status', 'p_value', 'q_value', 'significant',)
+TRACK_EXPDIFF_FIELDS = ('comparison', 'value_1', 'value_2', 'log2_fold_change', 'status', 'p_value', 'q_value', 'significant',)
+TRACK_DIFF_FIELDS = ('comparison', 'value_1', 'value_2', 'js_dist', 'status', 'p_value', 'q_value', 'significant',)
+
+# cuffdiff status values, stored as small integer codes
+STATUS_OK = 0
+STATUS_NOTEST = 1
+STATUS_LOWDATA = 2
+STATUS_HIDATA = 3
+STATUS_FAIL = 4
+STATUS_CHOICES = (
+    (STATUS_OK, 'OK'),
+    (STATUS_NOTEST, 'NOTEST'),
+    (STATUS_LOWDATA, 'LOWDATA'),
+    (STATUS_HIDATA, 'HIDATA'),
+    (STATUS_FAIL, 'FAIL'),
+    )
+# cuffdiff yes/no significant values
+SIGNIFICANT_CHOICES = (
+    (True, 'yes'),
+    (False, 'no'),
+    )
+
+# Composite indexes for the common filter and sort paths of the track
+# data views (rows are always filtered by experiment first)
+TRACK_DATA_INDEXES = (('experiment', 'sample', 'fpkm'),)
+TRACK_COUNT_INDEXES = (('experiment', 'sample', 'count'),)
+TRACK_REPLICATE_INDEXES = (('experiment', 'sample', 'replicate', 'fpkm'),)
+TRACK_DIFF_INDEXES = (('experiment', 'significant', 'q_value'), ('experiment', 'q_value'),
+    ('experiment', 'p_value'), ('comparison', 'significant', 'q_value'),
+    ('comparison', 'q_value'),)
+# Region queries of the tracks, see cuff.locus. The bin ranges bound
+# both ends of the overlapping tracks; an (experiment, chrom,
+# chrom_start) index could only bound chrom_start <= end and would scan
+# the chromosome from its start, so there is none
+TRACK_LOCUS_INDEXES = (('experiment', 'chrom', 'bin'),)
 
 #
 # Abstract classes
@@ -67,18 +102,38 @@ class TrackBaseManager(models.Manager):
     def for_exp(self, exp):
         return super(TrackBaseManager, self).get_query_set().filter(experiment=exp)
 
+    def for_gene_name(self, name):
+        '''
+        Tracks of all the experiments annotated with gene `name`.
+        '''
+        return super(TrackBaseManager, self).get_query_set().filter(
+            annotation__in=Annotation.objects.filter(gene_short_name=name))
+
+
+class TrackDataManager(models.Manager):
+    '''
+    Track data rows carry the experiment of their track, so that they
+    are filtered without joining the track table.
+    '''
+    def for_exp(self, exp):
+        return super(TrackDataManager, self).get_query_set().filter(experiment=exp)
+
 
 class TrackBase(models.Model):
-    # We need Char primary key that is computed from track_base_id 
-    # and experiment in order to work around the lack of composite
-    # primary key support.
-    track_pk = models.CharField(max_length=75, unique=True, db_index=True)
-    
+    # Tracks are identified by their cuffdiff id (gene_id, tss_group_id,
+    # ...) within the experiment, see unique_together of descendants.
+    # Everything else references them by the integer primary key.
     experiment = models.ForeignKey('Experiment')
-    class_code = models.CharField(max_length=45, db_index=True, null=True)
-    nearest_ref_id = models.CharField(max_length=45, db_index=True)
-    gene_short_name = models.CharField(max_length=250, db_index=True)
-    locus = models.CharField(max_length=45)
+    # nearest_ref_id, gene_short_name and locus, kept once for all the
+    # experiments, see cuff.annotations
+    annotation = models.ForeignKey('Annotation', null=True, blank=True)
+    # Single character cuffcompare class codes ('=', 'j', 'u', ...)
+    class_code = models.CharField(max_length=1, db_index=True, null=True)
+    # locus parsed at import, see cuff.locus
+    chrom = models.CharField(max_length=45, null=True)
+    chrom_start = models.PositiveIntegerField(null=True)
+    chrom_end = models.PositiveIntegerField(null=True)
+    bin = models.PositiveIntegerField(null=True)
     length = models.IntegerField(null=True)
     coverage = models.FloatField(null=True)
     
@@ -86,15 +141,36 @@ class TrackBase(models.Model):
     
     class Meta:
         abstract = True
+    
+    def _annotation_value(self, name):
+        if self.annotation_id is None:
+            return ''
+        return getattr(self.annotation, name)
+    
+    @property
+    def nearest_ref_id(self):
+        return self._annotation_value('nearest_ref_id')
+    
+    @property
+    def gene_short_name(self):
+        return self._annotation_value('gene_short_name')
+    
+    @property
+    def locus(self):
+        return self._annotation_value('locus')
         
 class DiffData(models.Model):
     '''
     Descendants from this model can not be arranged as ManyToMany with
     `through` table because they have two fks to the Sample table.
     '''
-    sample_1 = models.ForeignKey('Sample', to_field='sample_pk', related_name='+')
-    sample_2 = models.ForeignKey('Sample', to_field='sample_pk', related_name='+')
-    status = models.CharField(max_length=45, db_index=True)
+    # Denormalized from the track
+    experiment = models.ForeignKey('Experiment')
+    sample_1 = models.ForeignKey('Sample', related_name='+')
+    sample_2 = models.ForeignKey('Sample', related_name='+')
+    # (sample_1, sample_2), indexed by TRACK_DIFF_INDEXES
+    comparison = models.ForeignKey('Comparison', null=True, db_index=False)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, db_index=True)
     value_1 = models.FloatField()
     value_2 = models.FloatField()
     # log2_fold_change = models.FloatField() - This one will be defined
@@ -102,42 +178,49 @@ class DiffData(models.Model):
     test_stat = models.FloatField()
     p_value = models.FloatField()
     q_value = models.FloatField()
-    significant = models.CharField(max_length=45, db_index=True)
+    significant = models.BooleanField(default=False, choices=SIGNIFICANT_CHOICES,
+        db_index=True)
     
     class Meta:
         abstract = True
         
 class Data(models.Model):
-    sample = models.ForeignKey('Sample', to_field='sample_pk')
+    # Denormalized from the track
+    experiment = models.ForeignKey('Experiment')
+    sample = models.ForeignKey('Sample')
     fpkm = models.FloatField()
     conf_hi = models.FloatField()
     conf_lo = models.FloatField()
-    status = models.CharField(max_length=45)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES)
     
     class Meta:
         abstract = True
 
 class CountData(models.Model):
-    sample = models.ForeignKey('Sample', to_field='sample_pk')
+    # Denormalized from the track
+    experiment = models.ForeignKey('Experiment')
+    sample = models.ForeignKey('Sample')
     count = models.FloatField()
     variance = models.FloatField()
     uncertainty = models.FloatField()
     dispersion = models.FloatField()
-    status = models.CharField(max_length=45)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES)
     
     class Meta:
         abstract = True
 
 class ReplicateData(models.Model):
-    sample = models.ForeignKey('Sample', to_field='sample_pk')
-    rep_name = models.ForeignKey('Replicate', to_field='rep_pk')
+    # Denormalized from the track
+    experiment = models.ForeignKey('Experiment')
+    sample = models.ForeignKey('Sample')
+    rep_name = models.ForeignKey('Replicate')
     replicate = models.IntegerField()
     raw_frags = models.FloatField()
     internal_scaled_frags = models.FloatField()
     external_scaled_frags = models.FloatField()
     fpkm = models.FloatField()
     effective_length = models.FloatField(null=True)
-    status = models.CharField(max_length=45)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES)
     
     class Meta:
         abstract = True
@@ -155,6 +238,8 @@ class Experiment(models.Model):
     run_date = models.DateField('Date of the run')
     analysis_date = models.DateField('Date of analysis')
     description = models.TextField('Description of the experiment', null=True)
+    # The rows of the experiment are in the archive, see cuff.archive
+    archived = models.BooleanField(default=False)
     
     class Meta:
         ordering = ('analysis_date', 'run_date',)
@@ -177,8 +262,6 @@ class Sample(models.Model):
     experiment = models.ForeignKey(Experiment)
     sample_index = models.IntegerField('Sample index within one experiment')
     sample_name = models.CharField(max_length=45)
-    # A substitute for composite pk
-    sample_pk = models.CharField(max_length=75, unique=True, db_index=True)
     gene_data = models.ManyToManyField('Gene', through='GeneData',
         related_name='data')
     gene_count = models.ManyToManyField('Gene', through='GeneCount',
@@ -216,6 +299,25 @@ class Sample(models.Model):
         super(Sample, self).save(*args, **kwargs)
 
 
+class Comparison(models.Model):
+    '''
+    Pair of samples tested by cuffdiff. The diff tables reference it,
+    so that the rows of one comparison are a single range of the
+    (comparison, ...) indexes.
+    '''
+    experiment = models.ForeignKey(Experiment)
+    sample_1 = models.ForeignKey(Sample, related_name='+')
+    sample_2 = models.ForeignKey(Sample, related_name='+')
+    
+    class Meta:
+        unique_together = ('experiment', 'sample_1', 'sample_2',)
+        ordering = ('experiment', 'pk',)
+        display_related = ('sample_1', 'sample_2',)
+        
+    def __unicode__(self):
+        return '{0} vs {1}'.format(self.sample_1.sample_name, self.sample_2.sample_name)
+
+
 class PhenoData(models.Model):
     '''
     Apparently stores additional info about samples
@@ -233,16 +335,16 @@ class Replicate(models.Model):
         `replicate` is the (0-based) replicate number
     '''
     file_name = models.CharField(max_length=200) # Originally file, integer
-    sample = models.ForeignKey(Sample, to_field='sample_pk')
+    sample = models.ForeignKey(Sample)
     replicate = models.IntegerField()
-    # A substitute for composite pk
-    rep_pk = models.CharField(max_length=45, unique=True, db_index=True)
     rep_name = models.CharField(max_length=45)
     total_mass = models.FloatField()
     norm_mass = models.FloatField()
     internal_scale = models.FloatField()
     external_scale = models.FloatField()
     
+    class Meta:
+        unique_together = ('sample', 'rep_name',)
 
 
 class RunInfo(models.Model):
@@ -268,15 +370,11 @@ class RunInfo(models.Model):
 # Gene level data
 #
 
-class GeneTrackDataManager(models.Manager):
-    def for_exp(self, exp):
-        return super(GeneTrackDataManager, self).get_query_set().filter(gene__experiment=exp)
-
 class GeneTrackMixin(models.Model):
     '''
     A mixin providing custom manager for gene track data
     '''
-    objects = GeneTrackDataManager()
+    objects = TrackDataManager()
     
     class Meta:
         abstract = True
@@ -291,12 +389,17 @@ class Gene(TrackBase):
         - locus
         - length
         - coverage
+    nearest_ref_id, gene_short_name and locus go to the shared
+    Annotation table.
     '''
     gene_id = models.CharField(max_length=45, db_index=True)
     
     class Meta:
         ordering = ['gene_id',]
-        list_display = ('gene_short_name', 'gene_id',) + TRACK_BASE_FIELDS
+        unique_together = ('experiment', 'gene_id',)
+        list_display = ('gene_id',) + TRACK_BASE_FIELDS
+        display_related = ('annotation',)
+        index_together = TRACK_LOCUS_INDEXES
     
     def __unicode__(self):
         return '%s (%s)' % (self.gene_id, self.gene_short_name)
@@ -310,11 +413,12 @@ class GeneData(Data, GeneTrackMixin):
     
     Likewise, gene_id is converted to the ForeignKey to Gene table.
     '''
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_DATA_FIELDS
+        index_together = TRACK_DATA_INDEXES
         verbose_name_plural = 'gene data'
     
     def __unicode__(self):
@@ -326,12 +430,13 @@ class GeneExpDiffData(DiffData, GeneTrackMixin):
     sample_name(s) are extracted from column names and converted to the
     ForeignKey to Sample table.
     '''
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     log2_fold_change = models.FloatField()
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_EXPDIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name = 'gene differential expression data'
         verbose_name_plural = 'gene differential expression data'
     
@@ -341,7 +446,7 @@ class GeneExpDiffData(DiffData, GeneTrackMixin):
 # I am not sure this is needed actually or how it's joined with Feature
 # table
 class GeneFeature(models.Model):
-    gene = models.OneToOneField(Gene, to_field='track_pk')
+    gene = models.OneToOneField(Gene)
     
 class GeneCount(CountData, GeneTrackMixin):
     '''
@@ -351,11 +456,12 @@ class GeneCount(CountData, GeneTrackMixin):
     ForeignKey to Sample table.
     A ForeignKey to Gene table is added.
     '''
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_COUNT_FIELDS
+        index_together = TRACK_COUNT_INDEXES
         verbose_name_plural = 'gene count data'
     
     def __unicode__(self):
@@ -368,11 +474,12 @@ class GeneReplicateData(ReplicateData, GeneTrackMixin):
     creates a unique replicate name by combining condition and number
     then inserts all the data
     '''
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_REPLICATE_FIELDS
+        index_together = TRACK_REPLICATE_INDEXES
         verbose_name_plural = 'gene replicate data'
     
     def __unicode__(self):
@@ -389,39 +496,63 @@ class Feature(models.Model):
     Populated by parsing .gtf file.
     Following field conversions are made:
         transcript_id --> isoform_id
-        tss_id --> TSS_group_id
-        p_id --> CDS_id
-    The rest of the fields are kept as is (?)
-    '''
-    gene = models.ForeignKey(Gene, to_field='track_pk')
-    isoform = models.ForeignKey("Isoform", to_field='track_pk')
+        tss_id --> tss_group_id
+        p_id --> cds_id
+    The rest of the attributes (exon_number, class_code, ...) are kept
+    as is in Attribute. References to the tracks which are not imported
+    for the experiment are left empty. Features are identified within
+    the experiment by their line in the .gtf file.
+    '''
+    OTHER = 0
+    EXON = 1
+    CDS = 2
+    START_CODON = 3
+    STOP_CODON = 4
+    UTR = 5
+    TRANSCRIPT = 6
+    TYPE_CHOICES = (
+        (OTHER, 'other'),
+        (EXON, 'exon'),
+        (CDS, 'CDS'),
+        (START_CODON, 'start_codon'),
+        (STOP_CODON, 'stop_codon'),
+        (UTR, 'UTR'),
+        (TRANSCRIPT, 'transcript'),
+        )
+    experiment = models.ForeignKey(Experiment)
+    gene = models.ForeignKey(Gene, null=True)
+    isoform = models.ForeignKey("Isoform", null=True)
+    tss_group = models.ForeignKey("TSS", null=True)
+    cds = models.ForeignKey("CDS", null=True)
     seqnames = models.CharField(max_length=45, db_index=True)
     source = models.CharField(max_length=45)
-    type_id = models.IntegerField(db_index=True)
+    type_id = models.IntegerField(db_index=True, choices=TYPE_CHOICES)
     start = models.IntegerField(db_index=True)
     end = models.IntegerField(db_index=True)
-    score = models.FloatField()
+    score = models.FloatField(null=True)
     strand = models.CharField(max_length=45, db_index=True)
     frame = models.CharField(max_length=45)
+    # Number of the feature line, comments not counted
+    line = models.PositiveIntegerField(null=True)
+    
+    class Meta:
+        unique_together = ('experiment', 'line',)
     
 class Attribute(models.Model):
     feature = models.ForeignKey(Feature)
     attribute = models.CharField(max_length=45)
-    value = models.CharField(max_length=45)
+    # e.g. comma separated gene names of merged loci can be long
+    value = models.CharField(max_length=255)
     
 #
 # TSS Group level data
 #
 
-class TSSTrackDataManager(models.Manager):
-    def for_exp(self, exp):
-        return super(TSSTrackDataManager, self).get_query_set().filter(tss_group__experiment=exp)
-
 class TSSTrackMixin(models.Model):
     '''
     A mixin providing custom manager for TSS track data
     '''
-    objects = TSSTrackDataManager()
+    objects = TrackDataManager()
     
     class Meta:
         abstract = True
@@ -429,69 +560,73 @@ class TSSTrackMixin(models.Model):
 
 class TSS(TrackBase):
     tss_group_id = models.CharField(max_length=45, db_index=True)
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    # Parent tracks may be excluded from the import
+    gene = models.ForeignKey(Gene, null=True, blank=True)
     
     class Meta:
         ordering = ['tss_group_id',]
+        unique_together = ('experiment', 'tss_group_id',)
         list_display = ('tss_group_id', 'gene',) + TRACK_BASE_FIELDS
+        display_related = ('annotation',)
+        index_together = TRACK_LOCUS_INDEXES
         verbose_name = 'TSS group'
         verbose_name_plural = 'TSS groups'
     
     def __unicode__(self):
-        return '{tss} ({gene})'.format(tss=self.tss_group_id, gene=self.gene.gene_short_name)
+        return '{tss} ({gene})'.format(tss=self.tss_group_id, gene=self.gene_short_name)
 
 
 class TSSFeature(models.Model):
-    tss_group = models.OneToOneField(TSS, to_field='track_pk')
+    tss_group = models.OneToOneField(TSS)
     
     class Meta:
         ordering = ['tss_group',]
         
 class TSSData(Data, TSSTrackMixin):
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    tss_group = models.ForeignKey(TSS)
     
     class Meta:
         ordering = ['tss_group',]
         list_display = ('tss_group',) + TRACK_DATA_FIELDS
+        index_together = TRACK_DATA_INDEXES
         verbose_name_plural = 'TSS data'
     
 class TSSExpDiffData(DiffData, TSSTrackMixin):
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    tss_group = models.ForeignKey(TSS)
     log2_fold_change = models.FloatField()
     
     class Meta:
         ordering = ['tss_group',]
         list_display = ('tss_group',) + TRACK_EXPDIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'TSS differential expression data'
         
 class TSSCount(CountData, TSSTrackMixin):
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    tss_group = models.ForeignKey(TSS)
     
     class Meta:
         ordering = ['tss_group',]
         list_display = ('tss_group',) + TRACK_COUNT_FIELDS
+        index_together = TRACK_COUNT_INDEXES
         verbose_name_plural = 'TSS count data'
         
 class TSSReplicateData(ReplicateData, TSSTrackMixin):
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    tss_group = models.ForeignKey(TSS)
     
     class Meta:
         ordering = ['tss_group',]
         list_display = ('tss_group',) + TRACK_REPLICATE_FIELDS
+        index_together = TRACK_REPLICATE_INDEXES
         verbose_name_plural = 'TSS replicate data'
 #
 # CDS Group level data
 #
 
-class CDSTrackDataManager(models.Manager):
-    def for_exp(self, exp):
-        return super(CDSTrackDataManager, self).get_query_set().filter(cds__experiment=exp)
-
 class CDSTrackMixin(models.Model):
     '''
     A mixin providing custom manager for CDS track data
     '''
-    objects = CDSTrackDataManager()
+    objects = TrackDataManager()
     
     class Meta:
         abstract = True
@@ -499,71 +634,74 @@ class CDSTrackMixin(models.Model):
 
 class CDS(TrackBase):
     cds_id = models.CharField(max_length=45, db_index=True)
-    gene = models.ForeignKey(Gene, to_field='track_pk')
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    gene = models.ForeignKey(Gene, null=True, blank=True)
+    tss_group = models.ForeignKey(TSS, null=True, blank=True)
     
     class Meta:
         ordering = ['cds_id',]
+        unique_together = ('experiment', 'cds_id',)
         list_display = ('cds_id',) + TRACK_BASE_FIELDS
+        display_related = ('annotation',)
+        index_together = TRACK_LOCUS_INDEXES
         verbose_name = 'CDS'
         verbose_name_plural = 'CDS'
     
     def __unicode__(self):
-        return '{cds} ({gene})'.format(cds=self.cds_id, gene=self.gene.gene_short_name)
+        return '{cds} ({gene})'.format(cds=self.cds_id, gene=self.gene_short_name)
         
         
 class CDSData(Data, CDSTrackMixin):
-    cds = models.ForeignKey(CDS, to_field='track_pk')
+    cds = models.ForeignKey(CDS)
     
     class Meta:
         ordering = ['cds',]
         list_display = ('cds',) + TRACK_DATA_FIELDS
+        index_together = TRACK_DATA_INDEXES
         verbose_name_plural = 'CDS data'
     
 class CDSCount(CountData, CDSTrackMixin):
-    cds = models.ForeignKey(CDS, to_field='track_pk')
+    cds = models.ForeignKey(CDS)
     
     class Meta:
         ordering = ['cds',]
         list_display = ('cds',) + TRACK_COUNT_FIELDS
+        index_together = TRACK_COUNT_INDEXES
         verbose_name_plural = 'CDS count data'
     
 class CDSFeature(models.Model):
-    cds = models.ForeignKey(CDS, to_field='track_pk')
+    cds = models.ForeignKey(CDS)
     
     class Meta:
         ordering = ['cds',]
     
 class CDSExpDiffData(DiffData, CDSTrackMixin):
-    cds = models.ForeignKey(CDS, to_field='track_pk')
+    cds = models.ForeignKey(CDS)
     log2_fold_change = models.FloatField()
     
     class Meta:
         ordering = ['cds',]
         list_display = ('cds',) + TRACK_EXPDIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'CDS differential expression data'
     
 class CDSReplicateData(ReplicateData,CDSTrackMixin):
-    cds = models.ForeignKey(CDS, to_field='track_pk')
+    cds = models.ForeignKey(CDS)
     
     class Meta:
         ordering = ['cds',]
         list_display = ('cds',) + TRACK_REPLICATE_FIELDS
+        index_together = TRACK_REPLICATE_INDEXES
         verbose_name_plural = 'CDS replicate data'
     
 #
 # Isoform level data
 #
 
-class IsoformTrackDataManager(models.Manager):
-    def for_exp(self, exp):
-        return super(IsoformTrackDataManager, self).get_query_set().filter(isoform__experiment=exp)
-
 class IsoformTrackMixin(models.Model):
     '''
     A mixin providing custom manager for Isoform track data
     '''
-    objects = IsoformTrackDataManager()
+    objects = TrackDataManager()
     
     class Meta:
         abstract = True
@@ -571,56 +709,63 @@ class IsoformTrackMixin(models.Model):
 
 class Isoform(TrackBase):
     isoform_id = models.CharField(max_length=45, db_index=True)
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene, null=True, blank=True)
     # Currently there is no p_id in isoforms.fpkm_tracking file
-    cds = models.ForeignKey(CDS, to_field='track_pk', null=True, blank=True)
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    cds = models.ForeignKey(CDS, null=True, blank=True)
+    tss_group = models.ForeignKey(TSS, null=True, blank=True)
     
     class Meta:
         ordering = ['isoform_id',]
+        unique_together = ('experiment', 'isoform_id',)
         list_display = ('gene', 'tss_group', 'isoform_id',) + TRACK_BASE_FIELDS
+        display_related = ('annotation',)
+        index_together = TRACK_LOCUS_INDEXES
     
     def __unicode__(self):
-        return '{isoform} ({gene})'.format(isoform=self.isoform_id, gene=self.gene.gene_short_name)
+        return '{isoform} ({gene})'.format(isoform=self.isoform_id, gene=self.gene_short_name)
 
 
 class IsoformData(Data, IsoformTrackMixin):
-    isoform = models.ForeignKey(Isoform, to_field='track_pk')
+    isoform = models.ForeignKey(Isoform)
     
     class Meta:
         ordering = ['isoform',]
         list_display = ('isoform',) + TRACK_DATA_FIELDS
+        index_together = TRACK_DATA_INDEXES
         verbose_name_plural = 'Isoform data'
     
 class IsoformCount(CountData, IsoformTrackMixin):
-    isoform = models.ForeignKey(Isoform, to_field='track_pk')
+    isoform = models.ForeignKey(Isoform)
     
     class Meta:
         ordering = ['isoform',]
         list_display = ('isoform',) + TRACK_COUNT_FIELDS
+        index_together = TRACK_COUNT_INDEXES
         verbose_name_plural = 'Isoform count data'
     
 class IsoformFeature(models.Model):
-    isoform = models.OneToOneField(Isoform,to_field='track_pk')
+    isoform = models.OneToOneField(Isoform)
     
     class Meta:
         ordering = ['isoform',]
     
 class IsoformExpDiffData(DiffData, IsoformTrackMixin):
-    isoform = models.ForeignKey(Isoform, to_field='track_pk')
+    isoform = models.ForeignKey(Isoform)
     log2_fold_change = models.FloatField()
     
     class Meta:
         ordering = ['isoform',]
         list_display = ('isoform',) + TRACK_EXPDIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'Isoform differential expression data'
     
 class IsoformReplicateData(ReplicateData, IsoformTrackMixin):
-    isoform = models.ForeignKey(Isoform, to_field='track_pk')
+    isoform = models.ForeignKey(Isoform)
     
     class Meta:
         ordering = ['isoform',]
         list_display = ('isoform',) + TRACK_REPLICATE_FIELDS
+        index_together = TRACK_REPLICATE_INDEXES
         verbose_name_plural = 'Isoform replicate data'
     
 #
@@ -628,32 +773,62 @@ class IsoformReplicateData(ReplicateData, IsoformTrackMixin):
 #
 
 class CDSDiffData(DiffData, GeneTrackMixin):
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     js_dist = models.FloatField()
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_DIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'CDS differential usage data'
     
 class PromoterDiffData(DiffData, GeneTrackMixin):
-    gene = models.ForeignKey(Gene, to_field='track_pk')
+    gene = models.ForeignKey(Gene)
     js_dist = models.FloatField()
     
     class Meta:
         ordering = ['gene',]
         list_display = ('gene',) + TRACK_DIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'Promoter differential usage data'
     
 class SplicingDiffData(DiffData, TSSTrackMixin):
-    tss_group = models.ForeignKey(TSS, to_field='track_pk')
+    tss_group = models.ForeignKey(TSS)
     js_dist = models.FloatField()
     
     class Meta:
         ordering = ['tss_group',]
         list_display = ('tss_group',) + TRACK_DIFF_FIELDS
+        index_together = TRACK_DIFF_INDEXES
         verbose_name_plural = 'Splicing data'
 
+#
+# Reference annotation
+#
+
+class Annotation(models.Model):
+    '''
+    Reference annotation shared by the tracks of all the experiments,
+    one row per reference id and locus. Filled by `import_exp` (see
+    `cuff.annotations`), so the tracks of a gene are found across the
+    experiments through this small table:
+    
+        Gene.objects.for_gene_name('Adh')
+    
+    class_code and length describe the assembled transcripts and stay
+    with the tracks.
+    '''
+    nearest_ref_id = models.CharField(max_length=45)
+    locus = models.CharField(max_length=45)
+    gene_short_name = models.CharField(max_length=250, db_index=True)
+    
+    class Meta:
+        unique_together = ('nearest_ref_id', 'locus',)
+        ordering = ['gene_short_name',]
+        
+    def __unicode__(self):
+        return '{name} ({locus})'.format(name=self.gene_short_name, locus=self.locus)
+
 #
 # Experiment stats
 #
@@ -681,3 +856,123 @@ class ExpStat(models.Model):
         ordering = ['experiment',]
         verbose_name = 'Experiment details'
         verbose_name_plural = 'Experiment details'
+
+
+class TableStat(models.Model):
+    '''
+    Number of rows of a data table in an experiment, so that the track
+    views without filters don't count them (see cuff.counts). Stored on
+    the first view of the table and dropped when the experiment is
+    imported again.
+    '''
+    experiment = models.ForeignKey(Experiment)
+    table = models.CharField(max_length=100)
+    rows = models.BigIntegerField()
+    
+    class Meta:
+        unique_together = ('experiment', 'table',)
+        ordering = ['experiment', 'table',]
+        
+    def __unicode__(self):
+        return '{table}: {rows}'.format(table=self.table, rows=self.rows)
+
+#
+# Import bookkeeping
+#
+
+class ImportStep(models.Model):
+    '''
+    Checkpoint of a single `import_exp` step (one cuffdiff file) for an
+    experiment. Lets an interrupted import be resumed with --resume
+    instead of reimporting everything, and only changed files be
+    reloaded with --update.
+    '''
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STALE = 'stale'
+    STATUS_CHOICES = (
+        (RUNNING, 'running'),
+        (DONE, 'done'),
+        (FAILED, 'failed'),
+        (STALE, 'file changed'),
+        )
+    experiment = models.ForeignKey(Experiment)
+    name = models.CharField(max_length=45)
+    path = models.CharField(max_length=500)
+    size = models.BigIntegerField(null=True)
+    mtime = models.FloatField(null=True)
+    # sha1 of the file contents
+    checksum = models.CharField(max_length=40, null=True)
+    rows = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+        default=RUNNING, db_index=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    # Stage timings (seconds) recorded with import_exp --profile
+    wall_time = models.FloatField(null=True)
+    parse_time = models.FloatField(null=True)
+    reshape_time = models.FloatField(null=True)
+    write_time = models.FloatField(null=True)
+    # All rows written by the step, i.e. track and data rows
+    written = models.IntegerField(null=True)
+    # Peak RSS of the importing process in bytes
+    peak_rss = models.BigIntegerField(null=True)
+    
+    class Meta:
+        unique_together = ('experiment', 'name',)
+        ordering = ['experiment', 'started',]
+        
+    def __unicode__(self):
+        return '{name} ({status})'.format(name=self.name, status=self.status)
+    
+    @property
+    def rate(self):
+        '''
+        Rows written per second.
+        '''
+        if self.written is None or not self.wall_time:
+            return None
+        return self.written / self.wall_time
+
+class ImportProfile(models.Model):
+    '''
+    Summary of an `import_exp --profile` run. Per-file timings are kept
+    in ImportStep; this records the totals and where the import ran so
+    that runs can be compared across versions and hardware.
+    '''
+    experiment = models.ForeignKey(Experiment)
+    created = models.DateTimeField()
+    host = models.CharField(max_length=100)
+    # Python, Django, pandas versions, CPU count, database vendor
+    environment = models.TextField()
+    # jobs, loader and batch size used
+    options = models.CharField(max_length=200)
+    wall_time = models.FloatField()
+    rows = models.IntegerField(default=0)
+    peak_rss = models.BigIntegerField(null=True)
+    
+    class Meta:
+        ordering = ['experiment', 'created',]
+        
+    def __unicode__(self):
+        return '{exp} on {host} ({time:.1f}s)'.format(exp=self.experiment,
+            host=self.host, time=self.wall_time)
+
+class DeferredIndex(models.Model):
+    '''
+    Secondary index dropped by `import_exp --defer-indexes`. Rebuilt at
+    the end of the import, or by the next import_exp run if the import
+    failed.
+    '''
+    table = models.CharField(max_length=100)
+    name = models.CharField(max_length=100)
+    # Index definition as read from the database catalog
+    definition = models.TextField()
+    
+    class Meta:
+        unique_together = ('table', 'name',)
+        ordering = ['table', 'name',]
+        
+    def __unicode__(self):
+        return '{table}.{name}'.format(table=self.table, name=self.name)
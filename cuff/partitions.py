@@ -0,0 +1,297 @@
+'''
+Partitioning of the track data tables by experiment.
+
+The track data tables (<Track>Data, <Track>Count, <Track>ReplicateData,
+<Track>ExpDiffData and the distribution level diff tables) hold the rows
+of all the experiments. Partitioned by `experiment_id`, every experiment
+gets its own physical partition: scans of one experiment don't touch the
+pages of the others and an experiment is deleted (or set aside for
+archival) by dropping (detaching) its partitions instead of deleting
+millions of rows. Partitioning is optional and set up per database with
+`partition_exp --setup`; `import_exp` then creates the partitions of
+every new experiment, `purge_exp` drops them and `archive_exp` drops
+them once the rows are written to the archive (`restore_experiment`
+creates them again).
+
+    MySQLPartitions         -- LIST partitions `p<exp_pk>`. Partitioned
+                               InnoDB tables can't have foreign keys, so
+                               the foreign keys of the data tables are
+                               dropped (see `check_references` of
+                               cuff.indexes). The primary key becomes
+                               (id, experiment_id). Detached partitions
+                               are exchanged with `<table>_exp<exp_pk>`
+                               tables.
+    PostgreSQLPartitions    -- declarative LIST partitions (PostgreSQL 11
+                               or newer) `<table>_exp<exp_pk>`. The table
+                               is rebuilt as a partitioned table and the
+                               rows copied experiment by experiment;
+                               indexes and foreign keys are created on
+                               the partitioned table once the rows are in.
+
+Nothing references the data tables, which is what makes them the ones
+that can be partitioned.
+'''
+import abc
+
+from django.db import connection as default_connection
+from django.db.models.loading import get_models, get_app
+from django.core.management.color import no_style
+
+from cuff.models import Experiment, Data, CountData, ReplicateData, DiffData
+
+
+def partitioned_models():
+    '''
+    Returns the models of the tables which can be partitioned by
+    experiment.
+    '''
+    return [m for m in get_models(get_app('cuff'))
+        if issubclass(m, (Data, CountData, ReplicateData, DiffData))]
+
+
+class PartitionManager(object):
+    '''
+    Subclasses implement the catalog queries (`is_partitioned`,
+    `get_partitions`) and the statements (`*_sql`) of their database.
+    The statements are built without touching the database.
+    '''
+    __metaclass__ = abc.ABCMeta
+    vendor = None
+
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+
+    def _fetch(self, sql, params=()):
+        cursor = self.connection.cursor()
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def _execute(self, sql, params=()):
+        self.connection.cursor().execute(sql, params)
+
+    def partition_name(self, table, exp_pk):
+        return '{table}_exp{pk}'.format(table=table, pk=exp_pk)
+
+    @abc.abstractmethod
+    def is_partitioned(self, table):
+        pass
+
+    @abc.abstractmethod
+    def get_partitions(self, table):
+        '''
+        Returns the experiment pks `table` has partitions for.
+        '''
+
+    @abc.abstractmethod
+    def setup_sql(self, model, exp_pks):
+        '''
+        Returns the statements turning the `model` table into a table
+        partitioned by experiment with partitions for `exp_pks`.
+        '''
+
+    @abc.abstractmethod
+    def create_sql(self, table, exp_pk):
+        pass
+
+    @abc.abstractmethod
+    def detach_sql(self, table, exp_pk):
+        '''
+        Returns the statements turning the partition of experiment
+        `exp_pk` into the standalone table `partition_name`.
+        '''
+
+    @abc.abstractmethod
+    def drop_sql(self, table, exp_pk):
+        pass
+
+    def setup(self, model):
+        exp_pks = Experiment.objects.using(self.connection.alias).order_by(
+            'pk').values_list('pk', flat=True)
+        for sql in self.setup_sql(model, list(exp_pks)):
+            self._execute(sql)
+
+    def partitioned_tables(self):
+        return [m._meta.db_table for m in partitioned_models()
+            if self.is_partitioned(m._meta.db_table)]
+
+    def create_partitions(self, exp_pk):
+        '''
+        Creates the missing partitions of experiment `exp_pk` in all the
+        partitioned tables. Returns the tables.
+        '''
+        tables = [t for t in self.partitioned_tables() if exp_pk not in self.get_partitions(t)]
+        for table in tables:
+            for sql in self.create_sql(table, exp_pk):
+                self._execute(sql)
+        return tables
+
+    def drop_partitions(self, exp_pk):
+        '''
+        Drops the partitions of experiment `exp_pk`. Returns the tables.
+        '''
+        tables = [t for t in self.partitioned_tables() if exp_pk in self.get_partitions(t)]
+        for table in tables:
+            for sql in self.drop_sql(table, exp_pk):
+                self._execute(sql)
+        return tables
+
+    def detach_partitions(self, exp_pk):
+        '''
+        Detaches the partitions of experiment `exp_pk`. Returns the
+        names of the resulting tables.
+        '''
+        tables = [t for t in self.partitioned_tables() if exp_pk in self.get_partitions(t)]
+        for table in tables:
+            for sql in self.detach_sql(table, exp_pk):
+                self._execute(sql)
+        return [self.partition_name(t, exp_pk) for t in tables]
+
+
+class MySQLPartitions(PartitionManager):
+    vendor = 'mysql'
+
+    def partition(self, exp_pk):
+        return 'p{pk}'.format(pk=exp_pk)
+
+    def is_partitioned(self, table):
+        return bool(self.get_partitions(table))
+
+    def get_partitions(self, table):
+        return [int(name[1:]) for name, in self._fetch(
+            'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+            'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s '
+            'AND PARTITION_NAME IS NOT NULL', [table])]
+
+    def setup(self, model):
+        # Partitioned InnoDB tables can't have foreign keys
+        table = model._meta.db_table
+        foreign_keys = [name for name, in self._fetch(
+            'SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS '
+            'WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = %s', [table])]
+        for sql in self.drop_foreign_keys_sql(table, foreign_keys):
+            self._execute(sql)
+        super(MySQLPartitions, self).setup(model)
+
+    def drop_foreign_keys_sql(self, table, names):
+        if not names:
+            return []
+        qn = self.connection.ops.quote_name
+        return ['ALTER TABLE {table} {drop}'.format(table=qn(table),
+            drop=', '.join('DROP FOREIGN KEY {0}'.format(qn(name)) for name in names))]
+
+    def setup_sql(self, model, exp_pks):
+        qn = self.connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        exp = qn(model._meta.get_field('experiment').column)
+        # LIST partitioning has no default partition, a table needs at
+        # least one partition
+        exp_pks = exp_pks or [0]
+        return [
+            # Every unique key has to include the partitioning column
+            'ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY ({pk}, {exp})'.format(
+                table=table, pk=qn(model._meta.pk.column), exp=exp),
+            'ALTER TABLE {table} PARTITION BY LIST ({exp}) ({partitions})'.format(
+                table=table, exp=exp, partitions=', '.join(
+                    'PARTITION {0} VALUES IN ({1})'.format(qn(self.partition(pk)), int(pk))
+                    for pk in exp_pks)),
+            ]
+
+    def create_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        return ['ALTER TABLE {table} ADD PARTITION (PARTITION {name} VALUES IN ({pk}))'.format(
+            table=qn(table), name=qn(self.partition(exp_pk)), pk=int(exp_pk))]
+
+    def detach_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        detached = qn(self.partition_name(table, exp_pk))
+        return [
+            'CREATE TABLE {detached} LIKE {table}'.format(detached=detached, table=qn(table)),
+            'ALTER TABLE {detached} REMOVE PARTITIONING'.format(detached=detached),
+            'ALTER TABLE {table} EXCHANGE PARTITION {name} WITH TABLE {detached}'.format(
+                table=qn(table), name=qn(self.partition(exp_pk)), detached=detached),
+            ] + self.drop_sql(table, exp_pk)
+
+    def drop_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        return ['ALTER TABLE {table} DROP PARTITION {name}'.format(
+            table=qn(table), name=qn(self.partition(exp_pk)))]
+
+
+class PostgreSQLPartitions(PartitionManager):
+    vendor = 'postgresql'
+
+    def is_partitioned(self, table):
+        return bool(self._fetch(
+            'SELECT 1 FROM pg_partitioned_table p JOIN pg_class t ON t.oid = p.partrelid '
+            'WHERE t.relname = %s AND pg_table_is_visible(t.oid)', [table]))
+
+    def get_partitions(self, table):
+        prefix = self.partition_name(table, '')
+        return [int(name[len(prefix):]) for name, in self._fetch(
+            'SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class t ON t.oid = i.inhparent '
+            'WHERE t.relname = %s AND pg_table_is_visible(t.oid)', [table])
+            if name.startswith(prefix)]
+
+    def setup_sql(self, model, exp_pks):
+        qn = self.connection.ops.quote_name
+        creation = self.connection.creation
+        table = model._meta.db_table
+        old = '{0}_unpartitioned'.format(table)
+        pk = model._meta.pk.column
+        exp = model._meta.get_field('experiment').column
+        statements = [
+            'ALTER TABLE {table} RENAME TO {old}'.format(table=qn(table), old=qn(old)),
+            # The id column keeps using the sequence of the old table
+            # (serial columns get <table>_<column>_seq)
+            'CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS) '
+            'PARTITION BY LIST ({exp})'.format(table=qn(table), old=qn(old), exp=qn(exp)),
+            'ALTER SEQUENCE {sequence} OWNED BY {table}.{pk}'.format(
+                sequence=qn('{0}_{1}_seq'.format(table, pk)), table=qn(table), pk=qn(pk)),
+            ]
+        for exp_pk in sorted(exp_pks):
+            statements += self.create_sql(table, exp_pk)
+            statements.append('INSERT INTO {table} SELECT * FROM {old} WHERE {exp} = {pk}'.format(
+                table=qn(table), old=qn(old), exp=qn(exp), pk=int(exp_pk)))
+        statements.append('DROP TABLE {old}'.format(old=qn(old)))
+        # Built once for all the partitions, new partitions inherit them
+        statements.append('ALTER TABLE {table} ADD PRIMARY KEY ({pk}, {exp})'.format(
+            table=qn(table), pk=qn(pk), exp=qn(exp)))
+        statements += creation.sql_indexes_for_model(model, no_style())
+        for field in model._meta.fields:
+            if field.rel:
+                statements += creation.sql_for_pending_references(field.rel.to, no_style(),
+                    {field.rel.to: [(model, field)]})
+        return statements
+
+    def create_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        return ['CREATE TABLE {name} PARTITION OF {table} FOR VALUES IN ({pk})'.format(
+            name=qn(self.partition_name(table, exp_pk)), table=qn(table), pk=int(exp_pk))]
+
+    def detach_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        return ['ALTER TABLE {table} DETACH PARTITION {name}'.format(
+            table=qn(table), name=qn(self.partition_name(table, exp_pk)))]
+
+    def drop_sql(self, table, exp_pk):
+        qn = self.connection.ops.quote_name
+        return ['DROP TABLE {name}'.format(name=qn(self.partition_name(table, exp_pk)))]
+
+
+PARTITION_MANAGERS = {
+    'mysql': MySQLPartitions,
+    'postgresql': PostgreSQLPartitions,
+    }
+
+
+def get_partition_manager(connection=None):
+    '''
+    Returns the partition manager for the database engine, None if the
+    engine doesn't support partitioning.
+    '''
+    connection = connection or default_connection
+    if connection.vendor not in PARTITION_MANAGERS:
+        return None
+    return PARTITION_MANAGERS[connection.vendor](connection)
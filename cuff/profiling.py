@@ -0,0 +1,115 @@
+'''
+Stage timing for `import_exp --profile`.
+
+Import steps go through three stages which are timed separately:
+
+    parse   -- reading and tokenizing the cuffdiff file (pandas)
+    reshape -- melting and computing the keys (cuff.reshape)
+    write   -- loading the rows into the database (cuff.loaders)
+
+    profiler = StageProfiler()
+    for chunk in profiler.iterate('parse', reader):
+        with profiler.stage('reshape'):
+            ...
+Optionally every stage is also run under cProfile and the stats are
+dumped as one .pstats file per stage.
+
+The peak memory of a step is measured by resetting the peak of the
+process (`reset_peak_rss`, Linux only) before the step runs.
+'''
+import os, time, resource, cProfile
+from collections import defaultdict
+from contextlib import contextmanager
+
+STAGES = ('parse', 'reshape', 'write',)
+
+
+def peak_rss(children=False):
+    '''
+    Returns peak resident set size of the current process in bytes, or
+    with `children` the peak of its largest finished child process (e.g.
+    an import worker).
+    '''
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident set size of the current process to its
+    current size, so that `peak_rss` measures from now on. Returns False
+    if the system can't reset it (only Linux can).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+class NullProfiler(object):
+    '''
+    Does nothing. Used when profiling is off.
+    '''
+    enabled = False
+
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def iterate(self, name, iterable):
+        return iterable
+
+    def dump(self, directory, prefix):
+        pass
+
+
+class StageProfiler(NullProfiler):
+    enabled = True
+
+    def __init__(self, use_cprofile=False):
+        self.times = defaultdict(float)
+        self.profiles = {}
+        self.use_cprofile = use_cprofile
+
+    @contextmanager
+    def stage(self, name):
+        profile = None
+        if self.use_cprofile:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] += time.time() - start
+            if profile is not None:
+                profile.disable()
+
+    def iterate(self, name, iterable):
+        '''
+        Yields items from `iterable` timing the time spent producing
+        them as stage `name`.
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def dump(self, directory, prefix):
+        '''
+        Dumps collected cProfile stats as <prefix>.<stage>.pstats files
+        in `directory`.
+        '''
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory,
+                '{prefix}.{stage}.pstats'.format(prefix=prefix, stage=name)))
+
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,124 @@
+'''
+Fast deletion of experiments.
+
+`Experiment.delete()` runs Django's cascade collector, which loads every
+related row into memory before deleting it -- hours (or an out of memory
+error) for an experiment with millions of data rows. `purge_experiment`
+deletes the rows with plain SQL instead, one table at a time, tables
+referencing others first:
+
+    DELETE FROM cuff_genedata WHERE experiment_id = %s AND id <= %s
+    DELETE FROM cuff_attribute WHERE feature_id IN
+        (SELECT id FROM cuff_feature WHERE experiment_id = %s) AND id <= %s
+
+Every statement deletes at most `batch_size` rows (the upper primary
+key of the chunk is looked up first) in its own transaction, so locks
+are held briefly and an interrupted purge can simply be run again. The
+experiment row goes last, followed by the files derived from the
+experiment (expression matrices, archive). If the data tables are
+partitioned by experiment (see `cuff.partitions`), the partitions of
+the experiment are dropped first and the data rows don't have to be
+deleted at all.
+'''
+from django.db import connection as default_connection, transaction
+from django.db.models.loading import get_models, get_app
+
+from cuff import archive, matrices
+from cuff.partitions import get_partition_manager
+from cuff.models import Experiment
+
+# Number of rows deleted at once
+BATCH_SIZE = 10000
+
+
+def _scope(model, qn):
+    '''
+    Returns SQL condition (with a single experiment pk parameter)
+    selecting the `model` rows of an experiment, None if the rows are
+    not related to experiments.
+    '''
+    if model is Experiment:
+        return '{pk} = %s'.format(pk=qn(model._meta.pk.column))
+    fields = [f for f in model._meta.fields if f.rel and f.rel.to is not model]
+    for field in fields:
+        if field.rel.to is Experiment:
+            return '{column} = %s'.format(column=qn(field.column))
+    for field in fields:
+        scope = _scope(field.rel.to, qn)
+        if scope is not None:
+            return '{column} IN (SELECT {pk} FROM {table} WHERE {scope})'.format(
+                column=qn(field.column),
+                pk=qn(field.rel.to._meta.pk.column),
+                table=qn(field.rel.to._meta.db_table),
+                scope=scope)
+    return None
+
+
+def purge_order(connection=None):
+    '''
+    Returns (model, scope) pairs for the models related to experiments
+    ordered so that every model comes before the models it references.
+    '''
+    qn = (connection or default_connection).ops.quote_name
+    scopes = dict((m, _scope(m, qn)) for m in get_models(get_app('cuff')))
+    scopes = dict((m, s) for m, s in scopes.items() if s is not None)
+    ordered = []
+    def visit(model):
+        if model in ordered:
+            return
+        for field in model._meta.fields:
+            if field.rel and field.rel.to is not model and field.rel.to in scopes:
+                visit(field.rel.to)
+        ordered.append(model)
+    for model in sorted(scopes, key=lambda m: m._meta.db_table):
+        visit(model)
+    return [(m, scopes[m]) for m in reversed(ordered)]
+
+
+def purge_table(model, scope, exp_pk, connection=None, batch_size=BATCH_SIZE, progress=None):
+    '''
+    Deletes the `model` rows of experiment `exp_pk` selected by `scope`
+    chunk by chunk. `progress(model, deleted)` is called after every
+    chunk with the number of rows deleted so far. Returns the number of
+    deleted rows.
+    '''
+    connection = connection or default_connection
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    pk = qn(model._meta.pk.column)
+    bound = 'SELECT {pk} FROM {table} WHERE {scope} ORDER BY {pk} LIMIT 1 OFFSET %s'.format(
+        pk=pk, table=table, scope=scope)
+    delete = 'DELETE FROM {table} WHERE {scope}'.format(table=table, scope=scope)
+    deleted = 0
+    while True:
+        with transaction.atomic(using=connection.alias):
+            cursor = connection.cursor()
+            cursor.execute(bound, [exp_pk, batch_size - 1])
+            row = cursor.fetchone()
+            if row is None:
+                # Last chunk
+                cursor.execute(delete, [exp_pk])
+            else:
+                cursor.execute('{0} AND {1} <= %s'.format(delete, pk), [exp_pk, row[0]])
+            deleted += max(cursor.rowcount, 0)
+        if progress is not None:
+            progress(model, deleted)
+        if row is None:
+            return deleted
+
+
+def purge_experiment(exp, connection=None, batch_size=BATCH_SIZE, progress=None):
+    '''
+    Deletes experiment `exp` (instance or pk) with all its rows and
+    derived files. Returns {model: number of deleted rows}.
+    '''
+    exp_pk = getattr(exp, 'pk', exp)
+    deleted = {}
+    partitions = get_partition_manager(connection)
+    if partitions is not None:
+        partitions.drop_partitions(exp_pk)
+    for model, scope in purge_order(connection):
+        deleted[model] = purge_table(model, scope, exp_pk, connection, batch_size, progress)
+    matrices.delete_matrices(exp_pk)
+    archive.delete_archive(exp_pk)
+    return deleted
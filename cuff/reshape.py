@@ -0,0 +1,382 @@
+'''
+Vectorized reshaping of cuffdiff output files.
+
+Every reader parses a tab-delimited cuffdiff file with pandas, chunk by
+chunk, and yields DataFrames whose columns are the attribute names of
+the target model (`gene_id`, `sample_id`, `fpkm`, ...). The mapping from
+the file header to the model columns is worked out once per file, wide
+per-sample columns are melted to the long form with a single `stack`
+and the cuffdiff ids (tracking ids, sample names, ...) are mapped to
+the integer primary keys of the referenced rows with vectorized dict
+lookups, as are the status and significant labels to their codes.
+Track loci are parsed into coordinates and bins (see `cuff.locus`).
+Files are given as paths or `cuff.sources.Source` objects (compressed
+files and archive members).
+
+    <track>.fpkm_tracking       -->     read_fpkm
+    <track>_exp.diff, *.diff    -->     read_diff
+    <track>.count_tracking      -->     read_count
+    <track>.read_group_tracking -->     read_replicate
+    merged.gtf                  -->     read_gtf
+'''
+import csv
+
+import pandas as pd
+
+from cuff.annotations import COLUMNS as ANNOTATION_COLUMNS
+from cuff.locus import parse_loci
+from cuff.profiling import NULL_PROFILER
+from cuff.sources import open_source
+
+# '-' denotes NA value in cuffdiff output. Char columns which can't be
+# null get '' instead, see `_blank_strings`.
+NA_VALUES = ['-']
+
+# Columns referencing other tracks in the .fpkm_tracking files
+TRACK_FK_COLUMNS = {
+    'gene_id': 'gene',
+    'tss_id': 'tss_group',
+    'p_id': 'cds',
+    }
+
+# Per-sample column suffixes in .fpkm_tracking and .count_tracking files
+DATA_SUFFIXES = {
+    'fpkm': 'fpkm',
+    'conf_lo': 'conf_lo',
+    'conf_hi': 'conf_hi',
+    'status': 'status',
+    }
+COUNT_SUFFIXES = {
+    'count': 'count',
+    'count_variance': 'variance',
+    'count_uncertainty_var': 'uncertainty',
+    'count_dispersion_var': 'dispersion',
+    'status': 'status',
+    }
+
+# Diff file columns with names that can't be used as field names
+DIFF_COLUMNS = {
+    'log2(fold_change)': 'log2_fold_change',
+    'sqrt(JS)': 'js_dist',
+    }
+
+
+# GTF columns
+GTF_COLUMNS = ['seqnames', 'source', 'type', 'start', 'end', 'score',
+    'strand', 'frame', 'attributes']
+
+# GTF attributes referencing tracks and the Feature fields they map to
+GTF_TRACK_ATTRIBUTES = (
+    ('gene_id', 'gene_id'),
+    ('transcript_id', 'isoform_id'),
+    ('tss_id', 'tss_group_id'),
+    ('p_id', 'cds_id'),
+    )
+
+# key "value"; pairs of the GTF attributes column. Values of some
+# GTFs are not quoted.
+GTF_ATTRIBUTE = r'(?P<attribute>[^\s;]+) +"?(?P<value>[^";]*)"?'
+
+
+def map_ids(series, ids):
+    '''
+    Maps cuffdiff ids in `series` to primary keys with the `ids` dict.
+    Unknown ids become nulls.
+    '''
+    return series.map(ids).astype('Int64')
+
+
+def read_header(file):
+    '''
+    Reads the header line of an open cuffdiff file.
+    '''
+    return file.readline().rstrip('\r\n').split('\t')
+
+
+def read_table(file, header, chunksize, **kwargs):
+    '''
+    Returns an iterator over `chunksize` rows long DataFrames of the
+    open cuffdiff `file` with the `header` already read.
+    '''
+    return pd.read_csv(file, sep='\t', header=None, names=header,
+        na_values=NA_VALUES, keep_default_na=False, chunksize=chunksize, **kwargs)
+
+
+def _concrete_fields(model):
+    '''
+    Returns a dict of the regular (non-relational) fields of `model`
+    keyed by name.
+    '''
+    return dict((f.name, f) for f in model._meta.fields
+        if not f.rel and not f.primary_key)
+
+
+def _string_dtypes(model, columns):
+    '''
+    Char fields have to be read as strings, otherwise pandas happily
+    turns ids like `000123` into integers.
+    '''
+    fields = _concrete_fields(model)
+    return dict((c, str) for c, f in columns.items()
+        if f in fields and fields[f].get_internal_type() == 'CharField')
+
+
+def _blank_strings(frame, model):
+    '''
+    Fills the NAs in the columns of the non-null char fields of `model`
+    (e.g. `-` for a track without a reference gene) with ''.
+    '''
+    fields = _concrete_fields(model)
+    for column in frame.columns:
+        field = fields.get(column)
+        if field is not None and not field.null and field.get_internal_type() == 'CharField':
+            frame[column] = frame[column].fillna('')
+    return frame
+
+
+def sample_columns(header, sample_names, suffixes):
+    '''
+    Maps per-sample columns of the `header` to (sample_name, field)
+    pairs. Sample names are matched against the known `sample_names`
+    (longest first) so that names containing underscores are handled
+    correctly.
+    '''
+    names = sorted(sample_names, key=len, reverse=True)
+    mapping = {}
+    for column in header:
+        for name in names:
+            prefix = '{0}_'.format(name)
+            if column.startswith(prefix):
+                suffix = column[len(prefix):].lower()
+                if suffix in suffixes:
+                    mapping[column] = (name, suffixes[suffix])
+                break
+    return mapping
+
+
+def melt_samples(frame, key_column, key, mapping, sample_ids):
+    '''
+    Melts wide per-sample `mapping` columns of `frame` to the long form
+    with one row per (`key`, sample) pair. Sample names are mapped to
+    primary keys with the `sample_ids` dict.
+    '''
+    wide = frame[list(mapping)]
+    wide.columns = pd.MultiIndex.from_tuples(
+        [mapping[c] for c in wide.columns], names=['sample', 'field'])
+    wide.index = key
+    long = wide.stack(level='sample', dropna=False)
+    long.columns.name = None
+    long.index.names = [key_column, 'sample_id']
+    long = long.reset_index()
+    long['sample_id'] = map_ids(long['sample_id'], sample_ids)
+    return long
+
+
+def _to_numeric(frame, model):
+    '''
+    `stack` turns mixed type columns into objects. Restore the numeric
+    types according to the model fields.
+    '''
+    fields = _concrete_fields(model)
+    for column in frame.columns:
+        field = fields.get(column)
+        if field is not None and field.get_internal_type() in ('FloatField', 'IntegerField'):
+            frame[column] = pd.to_numeric(frame[column])
+    return frame
+
+
+def encode_choices(frame, model):
+    '''
+    Replaces the labels in the columns of `model` fields with choices
+    (status, significant) by their codes. Raises ValueError for labels
+    that are not among the choices.
+    '''
+    fields = _concrete_fields(model)
+    for column in frame.columns:
+        field = fields.get(column)
+        if field is None or not field.choices:
+            continue
+        codes = dict((label, code) for code, label in field.choices)
+        encoded = frame[column].map(codes)
+        unknown = encoded.isnull() & frame[column].notnull()
+        if unknown.any():
+            raise ValueError('Unknown {field} values: {values}'.format(field=column,
+                values=', '.join(sorted(set(frame[column][unknown])))))
+        if field.get_internal_type() != 'BooleanField':
+            encoded = encoded.astype('Int64')
+        frame[column] = encoded
+    return frame
+
+
+def track_columns(model, track_field, header):
+    '''
+    Returns (source column, model attribute, is reference) triples
+    describing how to build <TrackBase> rows from the .fpkm_tracking
+    `header`. References to the parent tracks have to be mapped to
+    their primary keys.
+    '''
+    fields = _concrete_fields(model)
+    fks = dict((f.name, f.attname) for f in model._meta.fields if f.rel)
+    track_key = '{0}_id'.format(track_field)
+    columns = [('tracking_id', track_key, False)]
+    taken = set([track_key])
+    for column in header:
+        if column in TRACK_FK_COLUMNS:
+            attname = fks.get(TRACK_FK_COLUMNS[column])
+            if attname and attname not in taken:
+                columns.append((column, attname, True))
+                taken.add(attname)
+        elif column in fields and column not in taken:
+            columns.append((column, column, False))
+            taken.add(column)
+    return columns
+
+
+def read_fpkm(source, track_model, data_model, track_field, exp_pk, sample_ids, parent_ids,
+        chunksize, profiler=NULL_PROFILER):
+    '''
+    Yields (tracks, data) DataFrames for <TrackBase> and <Track>Data
+    tables from <track>.fpkm_tracking file. `sample_ids` maps sample
+    names and `parent_ids` (keyed by attribute name) the ids of the
+    parent tracks to primary keys. The track rows don't exist yet, so
+    `data` references them by tracking id in the `<track_field>_id`
+    column, which the caller maps once the tracks are written. `tracks`
+    also have the annotation columns (see `cuff.annotations`), '' where
+    they are missing, which the caller replaces by `annotation_id`.
+    '''
+    with open_source(source) as f:
+        header = read_header(f)
+        columns = track_columns(track_model, track_field, header)
+        annotation = [c for c in ANNOTATION_COLUMNS if c in header]
+        samples = sample_columns(header, sample_ids, DATA_SUFFIXES)
+        dtypes = _string_dtypes(track_model, dict((c, a) for c, a, k in columns))
+        dtypes.update((c, str) for c, a, is_ref in columns if is_ref)
+        dtypes.update((c, str) for c in annotation)
+        track_key = '{0}_id'.format(track_field)
+        for chunk in profiler.iterate('parse', read_table(f, header, chunksize, dtype=dtypes)):
+            with profiler.stage('reshape'):
+                tracks = _blank_strings(pd.DataFrame(dict(
+                    (attname, map_ids(chunk[column], parent_ids.get(attname, {}))
+                        if is_ref else chunk[column])
+                    for column, attname, is_ref in columns)), track_model)
+                for column in annotation:
+                    tracks[column] = chunk[column].fillna('')
+                tracks['experiment_id'] = exp_pk
+                if 'locus' in tracks:
+                    tracks = tracks.join(parse_loci(tracks['locus']))
+                data = encode_choices(_to_numeric(melt_samples(chunk, track_key,
+                    chunk['tracking_id'], samples, sample_ids), data_model), data_model)
+                data['experiment_id'] = exp_pk
+            yield tracks, data
+
+
+def read_diff(source, diff_model, track_field, exp_pk, track_ids, sample_ids, chunksize,
+        profiler=NULL_PROFILER):
+    '''
+    Yields DataFrames for <Track>ExpDiffData and dist level DiffData
+    tables from .diff files. Test ids are mapped to primary keys with
+    `track_ids`, sample names with `sample_ids`.
+    '''
+    with open_source(source) as f:
+        fields = _concrete_fields(diff_model)
+        header = read_header(f)
+        columns = dict((c, DIFF_COLUMNS.get(c, c)) for c in header
+            if DIFF_COLUMNS.get(c, c) in fields)
+        dtypes = _string_dtypes(diff_model, columns)
+        dtypes.update({'test_id': str, 'sample_1': str, 'sample_2': str,})
+        track_key = '{0}_id'.format(track_field)
+        for chunk in profiler.iterate('parse', read_table(f, header, chunksize, dtype=dtypes)):
+            with profiler.stage('reshape'):
+                diff = encode_choices(chunk[list(columns)].rename(columns=columns), diff_model)
+                diff[track_key] = map_ids(chunk['test_id'], track_ids)
+                diff['sample_1_id'] = map_ids(chunk['sample_1'], sample_ids)
+                diff['sample_2_id'] = map_ids(chunk['sample_2'], sample_ids)
+                diff['experiment_id'] = exp_pk
+            yield diff
+
+
+def read_count(source, count_model, track_field, exp_pk, track_ids, sample_ids, chunksize,
+        profiler=NULL_PROFILER):
+    '''
+    Yields molten DataFrames for <Track>Count tables from
+    <track>.count_tracking file.
+    '''
+    with open_source(source) as f:
+        header = read_header(f)
+        samples = sample_columns(header, sample_ids, COUNT_SUFFIXES)
+        track_key = '{0}_id'.format(track_field)
+        reader = read_table(f, header, chunksize, dtype={'tracking_id': str})
+        for chunk in profiler.iterate('parse', reader):
+            with profiler.stage('reshape'):
+                counts = encode_choices(_to_numeric(melt_samples(chunk, track_key,
+                    map_ids(chunk['tracking_id'], track_ids), samples, sample_ids), count_model),
+                    count_model)
+                counts['experiment_id'] = exp_pk
+            yield counts
+
+
+def read_replicate(source, rep_model, track_field, exp_pk, track_ids, sample_ids, rep_ids,
+        chunksize, profiler=NULL_PROFILER):
+    '''
+    Yields DataFrames for <Track>ReplicateData tables from
+    <track>.read_group_tracking file. Replicate names are combined
+    from condition and replicate number and mapped to primary keys
+    with `rep_ids`.
+    '''
+    with open_source(source) as f:
+        fields = _concrete_fields(rep_model)
+        header = read_header(f)
+        columns = dict((c, c.lower()) for c in header if c.lower() in fields)
+        track_key = '{0}_id'.format(track_field)
+        dtypes = {'tracking_id': str, 'condition': str, 'replicate': str,}
+        for chunk in profiler.iterate('parse', read_table(f, header, chunksize, dtype=dtypes)):
+            with profiler.stage('reshape'):
+                reps = encode_choices(chunk[list(columns)].rename(columns=columns), rep_model)
+                reps[track_key] = map_ids(chunk['tracking_id'], track_ids)
+                reps['sample_id'] = map_ids(chunk['condition'], sample_ids)
+                reps['rep_name_id'] = map_ids(
+                    chunk['condition'] + '_' + chunk['replicate'], rep_ids)
+                reps['replicate'] = pd.to_numeric(chunk['replicate'])
+                reps['experiment_id'] = exp_pk
+            yield reps
+
+
+def read_gtf(source, feature_types, track_ids, exp_pk, chunksize, profiler=NULL_PROFILER):
+    '''
+    Yields (features, attributes) DataFrames for Feature and Attribute
+    tables from a .gtf file. `feature_types` maps GTF feature types to
+    Feature.type_id, unknown types become 0. Track references are
+    mapped to primary keys with the `track_ids` dicts (keyed by Feature
+    attribute name), i.e. only the tracks imported for the experiment
+    are referenced.
+    Features are numbered by their line (`line` column, comments not
+    counted) and the rows of `attributes` refer to them by it (`feature`
+    column) as feature ids are only known once the features are written.
+    '''
+    dtypes = dict((c, str) for c in GTF_COLUMNS)
+    dtypes.update({'start': int, 'end': int, 'score': float,})
+    with open_source(source) as f:
+        reader = pd.read_csv(f, sep='\t', header=None, names=GTF_COLUMNS,
+            comment='#', quoting=csv.QUOTE_NONE, na_values={'score': ['.']},
+            keep_default_na=False, dtype=dtypes, chunksize=chunksize)
+        line = 0
+        for chunk in profiler.iterate('parse', reader):
+            with profiler.stage('reshape'):
+                chunk.index = pd.RangeIndex(line + 1, line + 1 + len(chunk))
+                line += len(chunk)
+                features = chunk[['seqnames', 'source', 'start', 'end', 'score',
+                    'strand', 'frame']].copy()
+                features['line'] = chunk.index
+                features['experiment_id'] = exp_pk
+                features['type_id'] = chunk['type'].map(feature_types).fillna(0).astype(int)
+                attributes = chunk['attributes'].str.extractall(GTF_ATTRIBUTE)
+                attributes['feature'] = attributes.index.get_level_values(0)
+                attributes = attributes.reset_index(drop=True)
+                is_track = attributes['attribute'].isin([a for a, f in GTF_TRACK_ATTRIBUTES])
+                tracks = attributes[is_track].drop_duplicates(['feature', 'attribute'])
+                tracks = tracks.pivot(index='feature', columns='attribute', values='value')
+                for attribute, field in GTF_TRACK_ATTRIBUTES:
+                    keys = tracks.get(attribute, pd.Series()).reindex(features.index)
+                    features[field] = map_ids(keys, track_ids.get(field, {}))
+                attributes = attributes[~is_track]
+            yield features, attributes
@@ -0,0 +1,140 @@
+'''
+Dependency-aware scheduler for the import steps.
+
+Steps are registered with the names of the steps they depend on and
+form a DAG. `Scheduler.run` starts every step as soon as all of its
+dependencies are finished, running up to `jobs` steps at a time, each
+in a worker process of its own (or one after another in the current
+process if `jobs` is 1). Either way a failing step raises `StepFailed`,
+as does a worker killed before it reported back (e.g. by the OOM
+killer).
+
+    scheduler = Scheduler()
+    scheduler.add('gene', process_fpkm, ('gene', 'genes.fpkm_tracking'))
+    scheduler.add('gene.diff', process_diff, ('gene', 'gene_exp.diff'),
+        deps=('gene',))
+    results = scheduler.run(jobs=4)
+
+Step functions and their arguments have to be picklable, i.e. module
+level functions.
+'''
+import multiprocessing, traceback
+from collections import OrderedDict
+from Queue import Empty
+
+
+class StepFailed(Exception):
+    pass
+
+
+def _call(func, args):
+    '''
+    Runs a step and returns (True, result), or (False, traceback) if
+    it raises.
+    '''
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _work(queue, name, func, args):
+    '''
+    Runs in the worker process, sends (name, (ok, result)) back.
+    '''
+    queue.put((name, _call(func, args)))
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.steps = OrderedDict()
+
+    def add(self, name, func, args=(), deps=()):
+        self.steps[name] = (func, tuple(args), tuple(deps))
+
+    def order(self):
+        '''
+        Returns the step names in a topological order. Raises
+        ValueError for unknown dependencies and cycles.
+        '''
+        for name, (func, args, deps) in self.steps.items():
+            for dep in deps:
+                if dep not in self.steps:
+                    raise ValueError('Step {0} depends on unknown step {1}'.format(name, dep))
+        ordered = []
+        done = set()
+        while len(ordered) < len(self.steps):
+            ready = self.ready(done, done)
+            if not ready:
+                raise ValueError('Dependency cycle between steps: {0}'.format(
+                    ', '.join(n for n in self.steps if n not in done)))
+            ordered.extend(ready)
+            done.update(ready)
+        return ordered
+
+    def dependents(self, names):
+        '''
+        Returns `names` together with all the steps depending on them,
+        directly or not.
+        '''
+        result = set(names)
+        for name in self.order():
+            if any(dep in result for dep in self.steps[name][2]):
+                result.add(name)
+        return result
+
+    def ready(self, done, started):
+        '''
+        Returns the names of the steps which are not started yet and
+        have all of their dependencies done.
+        '''
+        return [name for name, (func, args, deps) in self.steps.items()
+            if name not in started and all(dep in done for dep in deps)]
+
+    def run(self, jobs=1):
+        '''
+        Runs all steps and returns a dict of their results keyed by
+        step name. Raises StepFailed for the first step which fails.
+        '''
+        order = self.order()
+        if jobs <= 1:
+            results = {}
+            for name in order:
+                ok, result = _call(*self.steps[name][:2])
+                if not ok:
+                    raise StepFailed('Step {0} failed:\n{1}'.format(name, result))
+                results[name] = result
+            return results
+        results = {}
+        running = {}
+        finished = multiprocessing.Queue()
+        try:
+            while len(results) < len(self.steps):
+                for name in self.ready(results, set(results) | set(running)):
+                    if len(running) >= jobs:
+                        break
+                    func, args, deps = self.steps[name]
+                    running[name] = multiprocessing.Process(target=_work,
+                        args=(finished, name, func, args), name='step {0}'.format(name))
+                    running[name].start()
+                # Poll with a timeout so that KeyboardInterrupt and dead
+                # workers get through
+                try:
+                    name, (ok, result) = finished.get(timeout=1)
+                except Empty:
+                    for name, worker in running.items():
+                        # A worker sends its result before it exits
+                        if worker.exitcode is not None and finished.empty():
+                            raise StepFailed('Step {0} failed: worker exited with code '
+                                '{1} before it finished'.format(name, worker.exitcode))
+                    continue
+                running.pop(name).join()
+                if not ok:
+                    raise StepFailed('Step {0} failed:\n{1}'.format(name, result))
+                results[name] = result
+        finally:
+            for worker in running.values():
+                worker.terminate()
+                worker.join()
+        return results
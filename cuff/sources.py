@@ -0,0 +1,550 @@
+'''
+Locating and reading cuffdiff output files.
+
+cuffdiff output can be imported from a directory or straight from a
+.tar (optionally gzip, bzip2 or xz compressed) or .zip archive, and
+every file in it may be compressed on its own (genes.fpkm_tracking.gz):
+
+    location = get_location('cuffdiff_out.tar.gz')
+    source = location.find('genes.fpkm_tracking')   # None if missing
+    with source.open() as f:
+        header = f.readline()
+
+Decompression runs in a background thread (or an `xz` process where
+Python has no lzma module) a few blocks ahead of the reader, so that it
+overlaps with parsing and writing to the database. Nothing is extracted
+to disk.
+
+Sources are plain picklable objects so that they can be handed to the
+import worker processes. There is no index in a tar archive, so every
+member of a compressed tar is read by decompressing the archive from
+the start up to the member.
+
+The sha1 checksum recorded for `import_exp --update` is computed from
+the raw blocks as they stream to the parser (`Source.read_checksum`), so
+an import reads every file once. Zip members use the CRC32 stored in the
+archive instead.
+'''
+import os, time, bz2, zlib, tarfile, zipfile, hashlib, threading, subprocess, sys, abc
+from Queue import Queue, Full
+
+from django.utils import six
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+BLOCK_SIZE = 1 << 20
+# Number of decompressed blocks buffered ahead of the reader
+READ_AHEAD = 8
+
+# File extension: compression
+COMPRESSED = (
+    ('.gz', 'gz'),
+    ('.bz2', 'bz2'),
+    ('.xz', 'xz'),
+    )
+TAR_ARCHIVES = (
+    ('.tar', None),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tbz2', 'bz2'),
+    ('.tar.xz', 'xz'),
+    ('.txz', 'xz'),
+    )
+ZIP_ARCHIVES = ('.zip',)
+
+
+def _read_blocks(file, size=BLOCK_SIZE):
+    return iter(lambda: file.read(size), '')
+
+
+def _stream_ended(decompressor):
+    '''
+    Tells whether `decompressor` has seen the end of the compressed
+    stream. Python 2 decompressors have no `eof` attribute: a finished
+    one puts any more data aside as `unused_data` (zlib) or refuses it
+    (bz2).
+    '''
+    if hasattr(decompressor, 'eof'):
+        return decompressor.eof
+    try:
+        decompressor.decompress('\0')
+    except EOFError:
+        return True
+    except Exception:
+        return False
+    return bool(decompressor.unused_data)
+
+
+def _decompress_stream(blocks, new_decompressor):
+    '''
+    Yields decompressed `blocks`. Concatenated streams (e.g. from
+    pigz or pbzip2) are handled by starting a new decompressor on the
+    data left over by the previous one.
+    '''
+    decompressor = new_decompressor()
+    for block in blocks:
+        while block:
+            try:
+                data = decompressor.decompress(block)
+            except EOFError:
+                # bz2 decompressor refuses any data after the end of stream
+                decompressor = new_decompressor()
+                continue
+            if data:
+                yield data
+            block = decompressor.unused_data
+            if block:
+                decompressor = new_decompressor()
+    if not _stream_ended(decompressor):
+        raise IOError('Compressed data ends unexpectedly')
+
+
+def _xz_process(blocks):
+    '''
+    Decompresses `blocks` with an `xz` process for the Pythons without
+    the lzma module.
+    '''
+    process = subprocess.Popen(['xz', '--decompress', '--stdout'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            for block in blocks:
+                process.stdin.write(block)
+        except IOError:
+            # xz exited early, reported below
+            pass
+        finally:
+            process.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    try:
+        for block in _read_blocks(process.stdout):
+            yield block
+    finally:
+        process.stdout.close()
+        feeder.join()
+        returncode = process.wait()
+    if returncode != 0:
+        raise IOError('xz failed to decompress the data')
+
+
+def decompress(blocks, compression):
+    '''
+    Yields the decompressed data of the `compression` ('gz', 'bz2',
+    'xz' or None) compressed `blocks`.
+    '''
+    if compression is None:
+        return blocks
+    elif compression == 'gz':
+        # 16 + MAX_WBITS: expect gzip header and trailer
+        return _decompress_stream(blocks,
+            lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    elif compression == 'bz2':
+        return _decompress_stream(blocks, bz2.BZ2Decompressor)
+    elif compression == 'xz':
+        if lzma is None:
+            return _xz_process(blocks)
+        return _decompress_stream(blocks, lzma.LZMADecompressor)
+    raise ValueError('Unknown compression: {0}'.format(compression))
+
+
+class BlockReader(object):
+    '''
+    Read-only file-like object over an iterable of data blocks.
+    '''
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.buffer = ''
+        self.eof = False
+
+    def _next_block(self):
+        try:
+            return next(self.blocks)
+        except StopIteration:
+            self.eof = True
+            return ''
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.buffer += self._next_block()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while not self.eof and '\n' not in self.buffer:
+            self.buffer += self._next_block()
+        end = self.buffer.find('\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.eof = True
+        self.buffer = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ThreadedReader(BlockReader):
+    '''
+    BlockReader producing the blocks in a background thread. Errors
+    raised by the producer are raised again in the reading thread.
+    '''
+    _END = object()
+
+    def __init__(self, blocks):
+        super(ThreadedReader, self).__init__(())
+        self.queue = Queue(READ_AHEAD)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(blocks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                if not self._put(block):
+                    return
+        except Exception:
+            self._put(sys.exc_info())
+        else:
+            self._put(self._END)
+
+    def _next_block(self):
+        if self.eof:
+            return ''
+        item = self.queue.get()
+        if item is self._END:
+            self.eof = True
+            return ''
+        if isinstance(item, tuple):
+            self.eof = True
+            six.reraise(*item)
+        return item
+
+    def close(self):
+        super(ThreadedReader, self).close()
+        self.stopped.set()
+
+
+class Source(object):
+    '''
+    A single cuffdiff file. `path` identifies the file in the messages
+    and the import checkpoints, `name` is the plain file name.
+
+    The sha1 checksum of the raw contents is computed as the file is
+    read, so that an import gets it without reading the file twice
+    (see `read_checksum`). Subclasses implement `blocks` and `stat`.
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, path, name, compression=None):
+        self.path = path
+        self.name = name
+        self.compression = compression
+        self._read_checksum = None
+
+    def __repr__(self):
+        return '<{cls} {path}>'.format(cls=self.__class__.__name__, path=self.path)
+
+    @abc.abstractmethod
+    def blocks(self):
+        '''
+        Yields the raw (possibly compressed) contents of the file.
+        '''
+
+    def _hashed(self, blocks):
+        checksum = hashlib.sha1()
+        for block in blocks:
+            checksum.update(block)
+            yield block
+        self._read_checksum = checksum.hexdigest()
+
+    def open(self):
+        '''
+        Returns a file-like object with the decompressed contents.
+        '''
+        self._read_checksum = None
+        return ThreadedReader(decompress(self._hashed(self.blocks()), self.compression))
+
+    @abc.abstractmethod
+    def stat(self):
+        '''
+        Returns (size, mtime) of the file.
+        '''
+
+    def checksum(self):
+        '''
+        Returns the checksum of the contents, reading the file once
+        more.
+        '''
+        return blocks_checksum(self.blocks())
+
+    def read_checksum(self):
+        '''
+        Returns the checksum of the contents if the file has been read
+        to the end since it was last opened, None otherwise.
+        '''
+        return self._read_checksum
+
+
+class FileSource(Source):
+
+    def blocks(self):
+        with open(self.path, 'rb') as f:
+            for block in _read_blocks(f):
+                yield block
+
+    def stat(self):
+        info = os.stat(self.path)
+        return info.st_size, info.st_mtime
+
+
+class TarMemberSource(Source):
+
+    def __init__(self, archive, archive_compression, member, size, mtime, compression=None):
+        super(TarMemberSource, self).__init__(
+            '{archive}/{member}'.format(archive=archive, member=member),
+            os.path.basename(member), compression)
+        self.archive = archive
+        self.archive_compression = archive_compression
+        self.member = member
+        self.size = size
+        self.mtime = mtime
+
+    def blocks(self):
+        for info, tar in _tar_members(self.archive, self.archive_compression):
+            if info.name == self.member:
+                for block in _read_blocks(tar.extractfile(info)):
+                    yield block
+                return
+        raise IOError('{member} not found in {archive}'.format(
+            member=self.member, archive=self.archive))
+
+    def stat(self):
+        return self.size, self.mtime
+
+
+class ZipMemberSource(Source):
+
+    def __init__(self, archive, member, size, mtime, crc, compression=None):
+        super(ZipMemberSource, self).__init__(
+            '{archive}/{member}'.format(archive=archive, member=member),
+            os.path.basename(member), compression)
+        self.archive = archive
+        self.member = member
+        self.size = size
+        self.mtime = mtime
+        self.crc = crc
+
+    def blocks(self):
+        with zipfile.ZipFile(self.archive) as archive:
+            member = archive.open(self.member)
+            try:
+                for block in _read_blocks(member):
+                    yield block
+            finally:
+                member.close()
+
+    def stat(self):
+        return self.size, self.mtime
+
+    def checksum(self):
+        # CRC32 of the member is stored in the archive
+        return 'crc32:{0:08x}'.format(self.crc)
+
+    def read_checksum(self):
+        return self.checksum()
+
+
+def _split_compression(filename):
+    '''
+    Returns (name, compression) for `filename` with an optional
+    compression extension.
+    '''
+    for ext, compression in COMPRESSED:
+        if filename.endswith(ext):
+            return filename[:-len(ext)], compression
+    return filename, None
+
+
+def _tar_members(archive, compression):
+    '''
+    Yields (TarInfo, TarFile) for the regular files in the `archive`
+    reading it as a stream.
+    '''
+    with open(archive, 'rb') as f:
+        stream = BlockReader(decompress(_read_blocks(f), compression))
+        tar = tarfile.open(fileobj=stream, mode='r|')
+        for info in tar:
+            if info.isfile():
+                yield info, tar
+
+
+class Directory(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+
+    def find(self, filename):
+        '''
+        Returns the Source for `filename` or its compressed variant,
+        None if there is neither.
+        '''
+        for ext, compression in (('', None),) + COMPRESSED:
+            path = os.path.join(self.path, filename + ext)
+            if os.path.isfile(path):
+                return FileSource(path, filename, compression)
+        return None
+
+
+class Archive(object):
+    '''
+    Archive members are matched by their base name wherever they are
+    in the archive (e.g. `cuffdiff_out/genes.fpkm_tracking.gz`).
+    Subclasses implement `list_members`, `member_name` and `get_source`.
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.members = {}
+        for member in self.list_members():
+            filename, compression = _split_compression(
+                os.path.basename(self.member_name(member)))
+            self.members.setdefault(filename, []).append((member, compression))
+
+    @abc.abstractmethod
+    def list_members(self):
+        '''
+        Returns the members (files) of the archive.
+        '''
+
+    @abc.abstractmethod
+    def member_name(self, member):
+        '''
+        Returns the path of `member` within the archive.
+        '''
+
+    @abc.abstractmethod
+    def get_source(self, member, compression):
+        '''
+        Returns the Source reading `member`.
+        '''
+
+    def find(self, filename):
+        members = self.members.get(filename)
+        if not members:
+            return None
+        if len(members) > 1:
+            raise ValueError('{path} contains more than one {name}'.format(
+                path=self.path, name=filename))
+        return self.get_source(*members[0])
+
+
+class TarArchive(Archive):
+
+    def __init__(self, path, name, compression):
+        self.compression = compression
+        super(TarArchive, self).__init__(path, name)
+
+    def list_members(self):
+        return [info for info, tar in _tar_members(self.path, self.compression)]
+
+    def member_name(self, info):
+        return info.name
+
+    def get_source(self, info, compression):
+        return TarMemberSource(self.path, self.compression, info.name,
+            info.size, info.mtime, compression)
+
+
+class ZipArchive(Archive):
+
+    def list_members(self):
+        with zipfile.ZipFile(self.path) as archive:
+            return [info for info in archive.infolist() if not info.filename.endswith('/')]
+
+    def member_name(self, info):
+        return info.filename
+
+    def get_source(self, info, compression):
+        mtime = time.mktime(info.date_time + (0, 0, -1))
+        return ZipMemberSource(self.path, info.filename, info.file_size,
+            mtime, info.CRC, compression)
+
+
+def get_location(path):
+    '''
+    Returns Directory or Archive to look the cuffdiff files up in.
+    Raises ValueError for anything else.
+    '''
+    if os.path.isdir(path):
+        return Directory(path)
+    basename = os.path.basename(path)
+    for ext in ZIP_ARCHIVES:
+        if basename.endswith(ext):
+            return ZipArchive(path, basename[:-len(ext)])
+    # Longest extension first: .tar.gz before .gz
+    for ext, compression in sorted(TAR_ARCHIVES, key=lambda a: -len(a[0])):
+        if basename.endswith(ext):
+            return TarArchive(path, basename[:-len(ext)], compression)
+    raise ValueError('{path} is neither a directory nor a tar or zip archive'.format(path=path))
+
+
+def file_source(path):
+    '''
+    Returns FileSource for the file at `path`, compressed or not.
+    '''
+    name, compression = _split_compression(os.path.basename(path))
+    return FileSource(path, name, compression)
+
+
+def open_source(source):
+    '''
+    Opens `source`, either a Source or a file path.
+    '''
+    if isinstance(source, basestring):
+        return open(source, 'rb')
+    return source.open()
+
+
+def blocks_checksum(blocks):
+    '''
+    Returns sha1 hex digest of the data `blocks`.
+    '''
+    checksum = hashlib.sha1()
+    for block in blocks:
+        checksum.update(block)
+    return checksum.hexdigest()
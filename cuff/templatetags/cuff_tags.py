@@ -11,13 +11,21 @@ def render_track_obj(obj):
     '''
     Renders track `obj` as a table row.
     Fields to render are specified in `obj._meta.list_display` property.
+    Coded fields (status, significant) are rendered by their labels.
     '''
     fields = obj._meta.list_display
     td_tmpl = '<td>{field}</td>'
-    row = ''.join([td_tmpl.format(field=getattr(obj,f)) for f in fields])
+    row = ''.join([td_tmpl.format(field=_display_value(obj, f)) for f in fields])
     return '<tr>%s</tr>' % row
 
 
+def _display_value(obj, field):
+    display = getattr(obj, 'get_{0}_display'.format(field), None)
+    if display is not None:
+        return display()
+    return getattr(obj, field)
+
+
 @register.inclusion_tag('cuff/includes/th_sort.html', takes_context=True)
 def render_header_field(context, field):
     '''
@@ -1,16 +1,1251 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests of the cuff app: the track views and the import of cuffdiff output.
 """
+import datetime
+import hashlib
+import json
+import os
+import pstats
+import shutil
+import sys
+import tarfile
+import tempfile
+import zlib
+from StringIO import StringIO
+
+import numpy as np
+import pandas as pd
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.db import connection, connections, DatabaseError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from cuff import (archive, counts, indexes, loaders, locus, matrices, partitions, profiling,
+    purge, reshape, sources, views)
+from cuff.scheduler import Scheduler, StepFailed
+from cuff.models import (STATUS_CHOICES, SIGNIFICANT_CHOICES, STATUS_OK, STATUS_NOTEST,
+    STATUS_LOWDATA, STATUS_HIDATA, Annotation, Feature, Attribute, Experiment, Sample,
+    Replicate, Comparison, Gene, GeneData, GeneCount, GeneReplicateData,
+    GeneExpDiffData, TSS, Isoform, IsoformData, SplicingDiffData, PromoterDiffData,
+    ExpStat, TableStat, ImportStep, ImportProfile, DeferredIndex)
+from plot.views import VolcanoPlotView
+
+SAMPLES = ('q1', 'q2',)
+
+
+def write_table(path, name, header, rows):
+    with open(os.path.join(path, name), 'w') as f:
+        for row in [header] + rows:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+
+
+def write_cuffdiff(path, genes=5):
+    '''
+    Writes the gene level cuffdiff output of `genes` genes in samples
+    q1 and q2 to the directory `path`. The second gene has no reference
+    gene or short name (`-`).
+    '''
+    write_table(path, 'run.info', ['param', 'value'],
+        [['cmd_line', 'cuffdiff -o out'], ['version', '2.2.1']])
+    write_table(path, 'read_groups.info', ['file', 'condition', 'replicate_num',
+        'total_mass', 'norm_mass', 'internal_scale', 'external_scale'],
+        [['%s.bam' % s, s, 0, 1000.0, 900.0, 1.0, 1.0] for s in SAMPLES])
+    header = ['tracking_id', 'class_code', 'nearest_ref_id', 'gene_id', 'gene_short_name',
+        'tss_id', 'locus', 'length', 'coverage']
+    for s in SAMPLES:
+        header += ['%s_FPKM' % s, '%s_conf_lo' % s, '%s_conf_hi' % s, '%s_status' % s]
+    rows = []
+    for i in range(genes):
+        ref, name = ('-', '-') if i == 1 else ('NM_%d' % i, 'g%d' % i)
+        row = ['XLOC_%06d' % i, '=', ref, 'XLOC_%06d' % i, name, '-',
+            'chr2L:%d-%d' % (i * 1000 + 1, i * 1000 + 500), 500, '-']
+        for j, s in enumerate(SAMPLES):
+            row += [i + j, i, i + j + 1, 'OK' if i % 2 else 'LOWDATA']
+        rows.append(row)
+    write_table(path, 'genes.fpkm_tracking', header, rows)
+    for name, column in (('gene_exp.diff', 'log2(fold_change)'), ('promoters.diff', 'sqrt(JS)')):
+        write_table(path, name, ['test_id', 'gene_id', 'gene', 'locus', 'sample_1', 'sample_2',
+            'status', 'value_1', 'value_2', column, 'test_stat', 'p_value', 'q_value',
+            'significant'], [['XLOC_%06d' % i, 'XLOC_%06d' % i, '-', 'chr2L:1-500', 'q1', 'q2',
+                'OK', 1.0, 2.0, 1.0, 0.5, 0.01 * i, 0.02 * i, 'yes' if i % 2 else 'no']
+                for i in range(genes)])
+
+
+def write_gtf(path):
+    '''
+    Writes a .gtf file with two transcripts of genes XLOC_000000 and
+    XLOC_000003 to `path`.
+    '''
+    with open(path, 'w') as f:
+        f.write('# merged by cuffmerge\n')
+        for i, (type, gene, transcript) in enumerate((
+                ('exon', 'XLOC_000000', 'TCONS_1'),
+                ('exon', 'XLOC_000000', 'TCONS_1'),
+                ('CDS', 'XLOC_000003', 'TCONS_2'),
+                ('intron', 'XLOC_000003', 'TCONS_2'),
+                ('exon', 'XLOC_999999', 'TCONS_3'),)):
+            f.write('\t'.join(['chr2L', 'Cufflinks', type, str(i * 100 + 1), str(i * 100 + 50),
+                '.' if i else '0.5', '+', '.', 'gene_id "{0}"; transcript_id "{1}"; '
+                'exon_number {2}; oId "CUFF.{2}";'.format(gene, transcript, i + 1)]) + '\n')
+
+
+class TrackViewQueriesTest(TestCase):
+    '''
+    A page of a track view takes the same number of queries whatever
+    the number of rows on it.
+    '''
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('test', 'test@example.com', 'test')
+        self.client.login(username='test', password='test')
+        
+    def make_exp(self, tracks):
+        today = datetime.date.today()
+        exp = Experiment.objects.create(title='test', species='test',
+            library='RNA-seq', run_date=today, analysis_date=today)
+        q1 = Sample.objects.create(experiment=exp, sample_name='q1')
+        q2 = Sample.objects.create(experiment=exp, sample_name='q2')
+        comparison = Comparison.objects.create(experiment=exp, sample_1=q1, sample_2=q2)
+        diff = dict(experiment=exp, sample_1=q1, sample_2=q2, comparison=comparison,
+            status=0, value_1=1.0, value_2=2.0, test_stat=1.0, p_value=0.01,
+            q_value=0.05, significant=True)
+        for i in range(tracks):
+            annotation, created = Annotation.objects.get_or_create(nearest_ref_id='ref%d' % i,
+                locus='chr2L:%d-%d' % (i * 1000 + 1, i * 1000 + 500),
+                defaults={'gene_short_name': 'g%d' % i})
+            track = dict(experiment=exp, annotation=annotation)
+            gene = Gene.objects.create(gene_id='XLOC_%06d' % i, **track)
+            tss = TSS.objects.create(tss_group_id='TSS%d' % i, gene=gene, **track)
+            isoform = Isoform.objects.create(isoform_id='TCONS_%08d' % i, gene=gene,
+                tss_group=tss, **track)
+            for sample in (q1, q2):
+                data = dict(experiment=exp, sample=sample, fpkm=i, conf_hi=i, conf_lo=i,
+                    status=0)
+                GeneData.objects.create(gene=gene, **data)
+                IsoformData.objects.create(isoform=isoform, **data)
+            GeneExpDiffData.objects.create(gene=gene, log2_fold_change=1.0, **diff)
+            SplicingDiffData.objects.create(tss_group=tss, js_dist=0.1, **diff)
+        return exp
+        
+    def get_url(self, exp, track, data=None, view='view'):
+        kwargs = {'exp_pk': exp.pk, 'track': track,}
+        if data:
+            kwargs['data'] = data
+        return reverse('track_{0}_{1}'.format('data' if data else 'base', view),
+            kwargs=kwargs)
+        
+    def count_queries(self, exp, track, data=None, view='view'):
+        '''
+        Returns the number of queries of the page and the response.
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.get_url(exp, track, data, view))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+        
+    def get_rows(self, response):
+        '''
+        Returns the number of rows shown by a track view response and
+        the number of rows it reports.
+        '''
+        if response['Content-Type'] == 'application/json':
+            data = json.loads(response.content)
+            return len(data['columns'][0]), data['count']['value']
+        tbody = response.content.split('<tbody>', 1)[1].split('</tbody>', 1)[0]
+        return tbody.count('<tr>'), response.context['row_count'].value
+        
+    def assertConstantQueries(self, track, data=None, view='view'):
+        small, large = self.make_exp(2), self.make_exp(20)
+        small_queries, small_response = self.count_queries(small, track, data, view)
+        large_queries, large_response = self.count_queries(large, track, data, view)
+        self.assertEqual(small_queries, large_queries)
+        # The pages show all the rows of the experiment
+        small_rows, large_rows = self.get_rows(small_response), self.get_rows(large_response)
+        self.assertEqual(small_rows[0], small_rows[1])
+        self.assertEqual(large_rows[0], large_rows[1])
+        self.assertTrue(0 < small_rows[0] < large_rows[0])
+        
+    def test_track(self):
+        self.assertConstantQueries('isoform')
+        self.assertConstantQueries('tss')
+        
+    def test_data(self):
+        self.assertConstantQueries('gene', 'data')
+        self.assertConstantQueries('isoform', 'data')
+        
+    def test_diff(self):
+        self.assertConstantQueries('gene', 'diff')
+        self.assertConstantQueries('splicing')
+        
+    def test_keyset(self):
+        threshold = views.KEYSET_THRESHOLD
+        views.KEYSET_THRESHOLD = 0
+        try:
+            self.assertConstantQueries('isoform', 'data')
+        finally:
+            views.KEYSET_THRESHOLD = threshold
+            
+    def test_scroll(self):
+        # The page has the first window of rows, the script continues
+        # after its cursor
+        exp = self.make_exp(2)
+        response = self.client.get(self.get_url(exp, 'isoform', 'data'))
+        self.assertContains(response, 'track-scroll.js')
+        self.assertContains(response, 'data-next=""')
+        self.assertTrue(response.context['keyset'])
+        with self.settings(CUFF_TRACK_SCROLL=False):
+            self.assertConstantQueries('isoform', 'data')
+            response = self.client.get(self.get_url(exp, 'isoform', 'data'))
+        self.assertNotContains(response, 'track-scroll.js')
+        self.assertNotContains(response, 'data-json')
+        self.assertFalse(response.context['keyset'])
+
+    def test_json(self):
+        self.assertConstantQueries('isoform', 'data', 'json')
+        self.assertConstantQueries('gene', 'diff', 'json')
+        
+    def test_json_windows(self):
+        exp = self.make_exp(20)
+        url = self.get_url(exp, 'isoform', 'data', 'json')
+        params, names = {'o': '-fpkm', 'limit': 7}, []
+        while params is not None:
+            data = json.loads(self.client.get(url, params).content)
+            self.assertEqual(data['fields'][0], 'isoform')
+            self.assertTrue(len(data['columns'][0]) <= 7)
+            names.extend(data['columns'][0])
+            params = data['next'] and dict(data['next'], o='-fpkm', limit=7)
+        self.assertEqual(len(names), 40)
+        self.assertEqual(names[0], unicode(Isoform.objects.get(experiment=exp,
+            isoform_id='TCONS_00000019')))
+        
+    def test_export(self):
+        exp = self.make_exp(20)
+        url = self.get_url(exp, 'isoform', 'data', 'export')
+        chunk = views.EXPORT_CHUNK
+        views.EXPORT_CHUNK = 7
+        try:
+            tsv = ''.join(self.client.get(url, {'o': '-fpkm'}).streaming_content)
+            gz = ''.join(self.client.get(url, {'o': '-fpkm', 'compress': 'gzip'}).streaming_content)
+            commas = ''.join(self.client.get(url, {'o': 'sample', 'format': 'csv'}).streaming_content)
+        finally:
+            views.EXPORT_CHUNK = chunk
+        lines = tsv.splitlines()
+        self.assertEqual(lines[0].split('\t')[0], 'isoform')
+        self.assertEqual(len(lines), 41)
+        self.assertEqual(lines[1].split('\t')[0], str(Isoform.objects.get(experiment=exp,
+            isoform_id='TCONS_00000019')))
+        self.assertEqual(zlib.decompress(gz, zlib.MAX_WBITS | 16), tsv)
+        self.assertEqual(len(commas.splitlines()), 41)
+        # Only orderings which can be read chunk by chunk by keyset
+        response = self.client.get(url, {'o': 'isoform__isoform_id'})
+        self.assertEqual(response.status_code, 404)
+        
+    def test_export_nullable(self):
+        # NULLs last, first in descending order, in chunks all the same
+        exp = self.make_exp(20)
+        for i, isoform in enumerate(Isoform.objects.filter(experiment=exp)):
+            if i % 2:
+                Isoform.objects.filter(pk=isoform.pk).update(coverage=i % 3)
+        url = self.get_url(exp, 'isoform', view='export')
+        tracks = Isoform.objects.filter(experiment=exp).values_list('pk', 'isoform_id', 'coverage')
+        chunk = views.EXPORT_CHUNK
+        views.EXPORT_CHUNK = 7
+        try:
+            for ordering in ('coverage', '-coverage'):
+                tsv = ''.join(self.client.get(url, {'o': ordering}).streaming_content)
+                ids = [line.split('\t')[2] for line in tsv.splitlines()[1:]]
+                expected = sorted(tracks, key=lambda (pk, id_, coverage): (coverage is None,
+                    coverage, pk), reverse=ordering.startswith('-'))
+                self.assertEqual(ids, [id_ for pk, id_, coverage in expected])
+        finally:
+            views.EXPORT_CHUNK = chunk
+
+
+
+class ImportMixin(object):
+    '''
+    Imports of small cuffdiff outputs with `import_exp`.
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        write_cuffdiff(self.path)
+        
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        
+    def import_exp(self, **options):
+        '''
+        Runs import_exp for the gene level files and returns the
+        experiment. The import steps print to sys.stdout.
+        '''
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            call_command('import_exp', self.path, exclude='TSS CDS isoform', matrices=False,
+                stdout=sys.stdout, **options)
+        finally:
+            sys.stdout = stdout
+        return Experiment.objects.order_by('-pk')[0]
+
+
+class ImportExpTest(ImportMixin, TestCase):
+    
+    def test_import(self):
+        exp = self.import_exp()
+        self.assertEqual(Gene.objects.for_exp(exp).count(), 5)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertEqual(GeneExpDiffData.objects.for_exp(exp).count(), 5)
+        self.assertEqual(PromoterDiffData.objects.for_exp(exp).count(), 5)
+        self.assertEqual(ExpStat.objects.get(experiment=exp).gene_count, 5)
+        self.assertEqual(set(ImportStep.objects.filter(experiment=exp).values_list(
+            'status', flat=True)), set([ImportStep.DONE]))
+        data = GeneData.objects.get(gene__gene_id='XLOC_000003', sample__sample_name='q2')
+        self.assertEqual((data.fpkm, data.conf_lo, data.conf_hi), (4.0, 3.0, 5.0))
+        
+    def test_batch_size(self):
+        # Rows are written and the tracks mapped batch by batch
+        exp = self.import_exp(batch_size=2)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertEqual(sorted(GeneData.objects.for_exp(exp).filter(sample__sample_name='q1'
+            ).values_list('gene__gene_id', 'fpkm')), [('XLOC_%06d' % i, i) for i in range(5)])
+        for size in (0, -1):
+            self.assertRaises(CommandError, self.import_exp, batch_size=size)
+        
+    def test_native_loader(self):
+        exp = self.import_exp(loader='native')
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertEqual(PromoterDiffData.objects.for_exp(exp).filter(significant=True).count(), 2)
+        # Errors other than a database without bulk loads don't fall
+        # back to the ORM
+        loader = loaders.get_loader('native')
+        frame = pd.DataFrame({'experiment_id': [exp.pk], 'gene_id': ['XLOC_000000']})
+        self.assertRaises(DatabaseError, loader.load, Gene, frame)
+        self.assertRaises(TypeError, loaders.StagingLoader)
+        self.assertRaises(TypeError, indexes.IndexManager)
+        
+    def test_missing_names(self):
+        # '-' for a track without a reference gene
+        exp = self.import_exp()
+        gene = Gene.objects.get(experiment=exp, gene_id='XLOC_000001')
+        self.assertEqual((gene.nearest_ref_id, gene.gene_short_name), ('', ''))
+        
+    def test_annotations(self):
+        # The tracks of both experiments share the annotations
+        first, second = self.import_exp(), self.import_exp()
+        self.assertEqual(Annotation.objects.count(), 5)
+        self.assertEqual(sorted(Gene.objects.for_gene_name('g3').values_list(
+            'experiment', flat=True)), [first.pk, second.pk])
+        gene = Gene.objects.get(experiment=second, gene_id='XLOC_000003')
+        self.assertEqual((gene.nearest_ref_id, gene.gene_short_name, gene.locus),
+            ('NM_3', 'g3', 'chr2L:3001-3500'))
+        self.assertEqual((gene.chrom, gene.chrom_start, gene.chrom_end), ('chr2L', 3001, 3500))
+        self.assertFalse(Gene.objects.filter(annotation__isnull=True).exists())
+        
+    def test_profile(self):
+        profile_dir = tempfile.mkdtemp()
+        try:
+            exp = self.import_exp(profile_dir=profile_dir)
+            files = os.listdir(profile_dir)
+            for stage in profiling.STAGES:
+                name = 'exp{pk}.gene.{stage}.pstats'.format(pk=exp.pk, stage=stage)
+                self.assertIn(name, files)
+                self.assertTrue(pstats.Stats(os.path.join(profile_dir, name)).total_calls)
+        finally:
+            shutil.rmtree(profile_dir)
+        steps = dict((step.name, step) for step in ImportStep.objects.filter(experiment=exp))
+        self.assertEqual(set(steps), set(['runinfo', 'reptable', 'gene', 'gene.diff', 'promoter']))
+        for step in steps.values():
+            self.assertTrue(step.wall_time > 0)
+            self.assertTrue(step.parse_time + step.reshape_time + step.write_time
+                <= step.wall_time)
+        # Track and data rows
+        self.assertEqual(steps['gene'].written, 15)
+        self.assertEqual(steps['gene'].rate, 15 / steps['gene'].wall_time)
+        self.assertTrue(steps['gene'].parse_time > 0 and steps['gene'].write_time > 0)
+        profile = ImportProfile.objects.get(experiment=exp)
+        self.assertEqual(profile.rows, sum(step.written for step in steps.values()))
+        self.assertIn('--jobs=1', profile.options)
+        if profiling.reset_peak_rss():
+            # Measured for every step alone
+            for step in steps.values():
+                self.assertTrue(0 < step.peak_rss <= profile.peak_rss)
+            data = 'x' * 2 ** 26
+            peak = profiling.peak_rss()
+            self.assertTrue(peak > 2 ** 26)
+            del data
+            profiling.reset_peak_rss()
+            self.assertTrue(profiling.peak_rss() < peak - 2 ** 25)
+        
+    def test_gtf(self):
+        gtf = os.path.join(self.path, 'merged.gtf')
+        write_gtf(gtf)
+        exp = self.import_exp(gtf=gtf, batch_size=2)
+        features = Feature.objects.filter(experiment=exp).order_by('line')
+        self.assertEqual([(f.line, f.type_id, f.gene and f.gene.gene_id, f.isoform)
+            for f in features], [
+                (1, Feature.EXON, 'XLOC_000000', None),
+                (2, Feature.EXON, 'XLOC_000000', None),
+                (3, Feature.CDS, 'XLOC_000003', None),
+                (4, Feature.OTHER, 'XLOC_000003', None),
+                (5, Feature.EXON, None, None),
+                ])
+        self.assertEqual((features[0].score, features[1].score), (0.5, None))
+        # Every feature has its own attributes, track ids are not kept
+        for feature in features:
+            self.assertEqual(dict(feature.attribute_set.values_list('attribute', 'value')),
+                {'exon_number': str(feature.line), 'oId': 'CUFF.%d' % feature.line})
+        self.assertEqual(Attribute.objects.filter(feature__experiment=exp).count(), 10)
+        # Reloaded together with the tracks
+        self.import_exp(resume=exp.pk)
+        self.assertEqual(Feature.objects.filter(experiment=exp).count(), 5)
+        
+    def test_purge(self):
+        gtf = os.path.join(self.path, 'merged.gtf')
+        write_gtf(gtf)
+        purged, kept = self.import_exp(gtf=gtf), self.import_exp(gtf=gtf)
+        
+        def count_rows():
+            rows = {}
+            cursor = connection.cursor()
+            for model, scope in purge.purge_order():
+                for exp in (purged, kept):
+                    cursor.execute('SELECT COUNT(*) FROM {0} WHERE {1}'.format(
+                        connection.ops.quote_name(model._meta.db_table), scope), [exp.pk])
+                    rows[model, exp.pk] = cursor.fetchone()[0]
+            return rows
+        
+        before = count_rows()
+        self.assertEqual(before[GeneData, purged.pk], 10)
+        self.assertEqual(before[Attribute, purged.pk], 10)
+        out = StringIO()
+        # Chunks of 3 rows, GeneData goes in 4
+        call_command('purge_exp', str(purged.pk), interactive=False, batch_size=3,
+            verbosity=2, stdout=out)
+        self.assertIn('GeneData: 10 rows deleted', out.getvalue())
+        self.assertEqual(out.getvalue().count('... GeneData: '), 4)
+        after = count_rows()
+        for model, scope in purge.purge_order():
+            self.assertEqual(after[model, purged.pk], 0, model._meta.object_name)
+            self.assertEqual(after[model, kept.pk], before[model, kept.pk], model._meta.object_name)
+        self.assertEqual(list(Experiment.objects.values_list('pk', flat=True)), [kept.pk])
+        self.assertEqual(Feature.objects.filter(experiment=kept).count(), 5)
+        self.assertRaises(CommandError, call_command, 'purge_exp', str(purged.pk),
+            interactive=False)
+        
+    def test_update(self):
+        exp = self.import_exp()
+        steps = dict((step.name, step) for step in ImportStep.objects.filter(experiment=exp))
+        with open(os.path.join(self.path, 'genes.fpkm_tracking'), 'rb') as f:
+            self.assertEqual(steps['gene'].checksum, hashlib.sha1(f.read()).hexdigest())
+        # Touched only: nothing is reloaded
+        os.utime(os.path.join(self.path, 'genes.fpkm_tracking'), (0, 0))
+        self.import_exp(update=exp.pk)
+        for step in ImportStep.objects.filter(experiment=exp):
+            self.assertEqual(step.started, steps[step.name].started)
+        # Changed: the promoters are reloaded, the genes are not
+        write_table(self.path, 'promoters.diff', ['test_id', 'gene_id', 'gene', 'locus',
+            'sample_1', 'sample_2', 'status', 'value_1', 'value_2', 'sqrt(JS)', 'test_stat',
+            'p_value', 'q_value', 'significant'], [['XLOC_%06d' % i, 'XLOC_%06d' % i, '-',
+                'chr2L:1-500', 'q1', 'q2', 'OK', 1.0, 2.0, 1.0, 0.5, 0.01, 0.02, 'yes']
+                for i in range(5)])
+        self.import_exp(update=exp.pk)
+        self.assertEqual(PromoterDiffData.objects.for_exp(exp).filter(significant=True).count(), 5)
+        updated = ImportStep.objects.get(experiment=exp, name='promoter')
+        self.assertNotEqual(updated.started, steps['promoter'].started)
+        self.assertNotEqual(updated.checksum, steps['promoter'].checksum)
+        self.assertEqual(ImportStep.objects.get(experiment=exp, name='gene').started,
+            steps['gene'].started)
+        
+    def test_resume(self):
+        exp = self.import_exp()
+        steps = dict((step.name, step) for step in ImportStep.objects.filter(experiment=exp))
+        ImportStep.objects.filter(experiment=exp, name='gene.diff').update(
+            status=ImportStep.FAILED)
+        self.import_exp(resume=exp.pk)
+        self.assertEqual(GeneExpDiffData.objects.for_exp(exp).count(), 5)
+        for step in ImportStep.objects.filter(experiment=exp):
+            self.assertEqual(step.status, ImportStep.DONE)
+            if step.name == 'gene.diff':
+                self.assertNotEqual(step.started, steps[step.name].started)
+            else:
+                self.assertEqual(step.started, steps[step.name].started)
+        
+    def test_archive(self):
+        archive = os.path.join(self.path, 'cuffdiff_out.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            for name in os.listdir(self.path):
+                if name != 'cuffdiff_out.tar.gz':
+                    tar.add(os.path.join(self.path, name), 'cuffdiff_out/' + name)
+        source = sources.get_location(archive).find('genes.fpkm_tracking')
+        with open(os.path.join(self.path, 'genes.fpkm_tracking'), 'rb') as f:
+            self.assertEqual(source.checksum(), hashlib.sha1(f.read()).hexdigest())
+        self.path = archive
+        try:
+            exp = self.import_exp()
+        finally:
+            self.path = os.path.dirname(archive)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertRaises(TypeError, sources.Source, archive, 'genes.fpkm_tracking')
+        self.assertRaises(TypeError, sources.Archive, archive, 'cuffdiff_out')
+        
+    def test_defer_indexes(self):
+        exp = self.import_exp(defer_indexes=True)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertFalse(DeferredIndex.objects.exists())
+        # Only for the first experiment: the indexes are shared
+        self.assertRaises(CommandError, self.import_exp, defer_indexes=True)
+        self.import_exp(defer_indexes=True, resume=exp.pk)
+        
+    def test_matrices(self):
+        header = ['tracking_id']
+        for s in SAMPLES:
+            header += ['%s_count' % s, '%s_count_variance' % s, '%s_count_uncertainty_var' % s,
+                '%s_count_dispersion_var' % s, '%s_status' % s]
+        # No counts for the fourth gene
+        write_table(self.path, 'genes.count_tracking', header, [['XLOC_%06d' % i,
+            i * 10, 2.0, 0.5, i + 0.25, 'OK', i * 10 + 5, 2.0, 0.5, i + 0.75, 'OK']
+            for i in (0, 1, 2, 4)])
+        write_table(self.path, 'genes.read_group_tracking', ['tracking_id', 'condition',
+            'replicate', 'raw_frags', 'internal_scaled_frags', 'external_scaled_frags', 'FPKM',
+            'effective_length', 'status'], [['XLOC_%06d' % i, s, 0, 10.0, 9.0, 8.0, i + j * 0.5,
+                '-', 'OK'] for i in range(5) for j, s in enumerate(SAMPLES)])
+        exp = self.import_exp()
+        with self.settings(CUFF_MATRIX_DIR=os.path.join(self.path, 'matrices')):
+            call_command('build_matrices', str(exp.pk), tracks=['gene'], stdout=StringIO())
+            store = matrices.get_store(exp, 'gene')
+            genes = Gene.objects.for_exp(exp).order_by('pk')
+            self.assertEqual(list(store['pk']), [g.pk for g in genes])
+            self.assertEqual(list(store['ids']), [g.gene_id for g in genes])
+            self.assertEqual(store.frame('fpkm').shape, (5, 2))
+            for model, columns, fields in ((GeneData, 'samples', ('fpkm', 'conf_lo', 'conf_hi')),
+                    (GeneCount, 'samples', ('count', 'dispersion')),
+                    (GeneReplicateData, 'replicates', ('fpkm',))):
+                column = 'rep_name' if columns == 'replicates' else 'sample'
+                rows = list(model.objects.for_exp(exp).values('gene', column, *fields))
+                self.assertTrue(rows)
+                for row in rows:
+                    i = store.rows([row['gene']])[0]
+                    j = store.column(row[column], columns)
+                    for field in fields:
+                        name = 'replicate_' + field if columns == 'replicates' else field
+                        self.assertAlmostEqual(store[name][i, j], row[field], places=5)
+            self.assertEqual(GeneCount.objects.for_exp(exp).count(), 8)
+            missing = store.rows([genes.get(gene_id='XLOC_000003').pk])[0]
+            self.assertTrue(all(value != value for value in store['count'][missing]))
+
+
+class ParallelImportTest(ImportMixin, TransactionTestCase):
+    '''
+    Imports with --jobs. The worker processes need the test database
+    in a file (TEST_NAME) on SQLite.
+    '''
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+            self.skipTest('the SQLite test database is in memory')
+        super(ParallelImportTest, self).setUp()
+        
+    def test_jobs(self):
+        exp = self.import_exp(jobs=2)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        self.assertEqual(PromoterDiffData.objects.for_exp(exp).count(), 5)
+        self.assertEqual(set(ImportStep.objects.filter(experiment=exp).values_list(
+            'status', flat=True)), set([ImportStep.DONE]))
+        serial = self.import_exp(jobs=1)
+        values = lambda exp: sorted(GeneData.objects.for_exp(exp).values_list(
+            'gene__gene_id', 'sample__sample_name', 'fpkm', 'conf_lo', 'conf_hi', 'status'))
+        self.assertEqual(values(exp), values(serial))
+        
+    def test_failed_step(self):
+        with open(os.path.join(self.path, 'gene_exp.diff'), 'a') as f:
+            f.write('\t'.join(['XLOC_000000', 'XLOC_000000', '-', 'chr2L:1-500', 'q1', 'q2',
+                'BOGUS', '1', '2', '1', '0.5', '0.01', '0.02', 'no']) + '\n')
+        for jobs in (1, 2):
+            with self.assertRaisesRegexp(CommandError, 'Step gene.diff failed'):
+                self.import_exp(jobs=jobs)
+            self.assertEqual(ImportStep.objects.get(experiment=Experiment.objects.order_by(
+                '-pk')[0], name='gene.diff').status, ImportStep.FAILED)
+
+
+class SchedulerTest(SimpleTestCase):
+    
+    def test_run(self):
+        scheduler = Scheduler()
+        scheduler.add('b', max, (2, 3), deps=('a',))
+        scheduler.add('a', min, (2, 3))
+        self.assertEqual(scheduler.order(), ['a', 'b'])
+        for jobs in (1, 2):
+            self.assertEqual(scheduler.run(jobs), {'a': 2, 'b': 3})
+        scheduler.add('a', min, (2, 3), deps=('b',))
+        self.assertRaises(ValueError, scheduler.order)
+        
+    def test_failures(self):
+        # Same error whether the step runs in a worker or not
+        scheduler = Scheduler()
+        scheduler.add('a', int, ('x',))
+        for jobs in (1, 2):
+            with self.assertRaisesRegexp(StepFailed, '(?s)Step a failed:.*ValueError'):
+                scheduler.run(jobs)
+        # A worker which dies doesn't hang the import
+        scheduler = Scheduler()
+        scheduler.add('a', os._exit, (3,))
+        scheduler.add('b', min, (2, 3), deps=('a',))
+        with self.assertRaisesRegexp(StepFailed, 'Step a failed: worker exited with code 3'):
+            scheduler.run(2)
+
+
+class ReshapeTest(SimpleTestCase):
+    '''
+    The vectorized helpers of the cuffdiff readers.
+    '''
+    def test_map_ids(self):
+        ids = reshape.map_ids(pd.Series(['XLOC_1', 'XLOC_3', None, 'XLOC_2']),
+            {'XLOC_1': 10, 'XLOC_2': 20})
+        self.assertEqual(str(ids.dtype), 'Int64')
+        self.assertEqual(list(ids.isnull()), [False, True, True, False])
+        self.assertEqual(list(ids.dropna()), [10, 20])
+        
+    def test_read_gtf(self):
+        path = tempfile.mkdtemp()
+        try:
+            write_gtf(os.path.join(path, 'merged.gtf'))
+            batches = list(reshape.read_gtf(sources.file_source(os.path.join(path,
+                'merged.gtf')), {'exon': 1, 'CDS': 2}, {'gene_id': {'XLOC_000003': 7},
+                'isoform_id': {'TCONS_1': 8, 'TCONS_2': 9}}, 3, 3))
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual([len(batch[0]) for batch in batches], [3, 2])
+        features = pd.concat([batch[0] for batch in batches])
+        attributes = pd.concat([batch[1] for batch in batches])
+        self.assertEqual(list(features['line']), [1, 2, 3, 4, 5])
+        self.assertEqual(list(features['type_id']), [1, 1, 2, 0, 1])
+        self.assertEqual(list(features['experiment_id']), [3] * 5)
+        self.assertEqual(list(features['gene_id'].isnull()), [True, True, False, False, True])
+        self.assertEqual(list(features['gene_id'].dropna()), [7, 7])
+        self.assertEqual(list(features['isoform_id'].dropna()), [8, 8, 9, 9])
+        self.assertTrue(features['tss_group_id'].isnull().all())
+        # Unquoted values too, the features are referred to by line
+        self.assertEqual(sorted(attributes[attributes['feature'] == 4][
+            ['attribute', 'value']].values.tolist()), [['exon_number', '4'], ['oId', 'CUFF.4']])
+        self.assertEqual(len(attributes), 10)
+        
+    def test_encode_choices(self):
+        frame = pd.DataFrame({
+            'status': ['OK', 'NOTEST', None],
+            'significant': ['yes', 'no', 'no'],
+            'p_value': [0.01, 1.0, 0.5],
+            })
+        frame = reshape.encode_choices(frame, GeneExpDiffData)
+        self.assertEqual(str(frame['status'].dtype), 'Int64')
+        self.assertEqual(list(frame['status'][:2]), [STATUS_OK, STATUS_NOTEST])
+        self.assertTrue(frame['status'].isnull()[2])
+        self.assertEqual(list(frame['significant']), [True, False, False])
+        self.assertEqual(list(frame['p_value']), [0.01, 1.0, 0.5])
+        frame = pd.DataFrame({'status': ['OK', 'BOGUS']})
+        self.assertRaises(ValueError, reshape.encode_choices, frame, GeneExpDiffData)
+
+
+class LocusTest(SimpleTestCase):
+    '''
+    The UCSC bins of the track loci.
+    '''
+    def test_bin_from_range(self):
+        self.assertEqual(locus.bin_from_range(0, 131071), 585)
+        self.assertEqual(locus.bin_from_range(1 << 20, (1 << 20) + 10), 593)
+        # Crosses a 128kb boundary, goes one level up
+        self.assertEqual(locus.bin_from_range(100000, 200000), 73)
+        self.assertEqual(locus.bin_from_range(0, (1 << 29) - 1), 0)
+        self.assertEqual(locus.bin_from_range(1 << 29, (1 << 29) + 10), 4681 + 4681 + 4096)
+        
+    def test_bin_ranges(self):
+        for start, end in ((0, 10), (100000, 200000), (5000000, 9000000),
+                ((1 << 29) - 10, (1 << 29) + 10)):
+            ranges = locus.bin_ranges(start, end)
+            for interval in ((start, start), (end, end), (start, end),
+                    (max(start - 50000, 0), start + 1)):
+                bin = locus.bin_from_range(*interval)
+                self.assertTrue(any(first <= bin <= last for first, last in ranges),
+                    '{0} not in the bins of {1}-{2}'.format(interval, start, end))
+        
+    def test_parse_loci(self):
+        frame = locus.parse_loci(pd.Series(['chr2L:100000-200000', 'chrX:5-5', '-', None]))
+        self.assertEqual(list(frame['chrom'][:2]), ['chr2L', 'chrX'])
+        self.assertEqual(list(frame['chrom_start'][:2]), [100000, 5])
+        self.assertEqual(list(frame['chrom_end'][:2]), [200000, 5])
+        self.assertEqual(list(frame['bin'][:2]),
+            [locus.bin_from_range(100000, 200000), locus.bin_from_range(5, 5)])
+        self.assertEqual(list(frame['bin'].isnull()), [False, False, True, True])
+        self.assertEqual(list(frame['chrom'].isnull()), [False, False, True, True])
+        frame = locus.parse_loci(pd.Series(['chr1:{0}-{1}'.format(1 << 29, (1 << 29) + 10)]))
+        self.assertEqual(frame['bin'][0], locus.bin_from_range(1 << 29, (1 << 29) + 10))
+        
+    def test_region_filter(self):
+        self.assertEqual(locus.parse_region('chr2L:1,000,000-2,000,000'),
+            ('chr2L', 1000000, 2000000))
+        self.assertEqual(locus.parse_region('chr2L:500'), ('chr2L', 500, 500))
+        for region in ('chr2L', 'chr2L:20-10', 'chr2L:a-b'):
+            self.assertRaises(ValueError, locus.parse_region, region)
+        q = str(locus.region_filter(Gene, 'chr2L:1-100'))
+        self.assertIn("('chrom', 'chr2L')", q)
+        self.assertIn("('chrom_start__lte', 100)", q)
+        self.assertIn("('chrom_end__gte', 1)", q)
+        self.assertIn("gene__chrom", str(locus.region_filter(GeneData, 'chr2L:1-100')))
+        self.assertRaises(ValueError, locus.region_filter, Sample, 'chr2L:1-100')
+
+
+
+class RegionViewTest(ImportMixin, TestCase):
+    '''
+    Track views and plots filtered by ?region=chr:start-end.
+    '''
+    def setUp(self):
+        super(RegionViewTest, self).setUp()
+        cache.clear()
+        User.objects.create_superuser('test', 'test@example.com', 'test')
+        self.client.login(username='test', password='test')
+        self.exp = self.import_exp()
+        
+    def get_rows(self, region, data=None):
+        kwargs = {'exp_pk': self.exp.pk, 'track': 'gene'}
+        if data:
+            kwargs['data'] = data
+        url = reverse('track_data_view' if data else 'track_base_view', kwargs=kwargs)
+        response = self.client.get(url, {'region': region})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['region'], region)
+        return response.context['object_list']
+        
+    def test_track_view(self):
+        # Genes i span chr2L:i*1000+1-i*1000+500
+        self.assertEqual(sorted(g.gene_id for g in self.get_rows('chr2L:1,200-2,100')),
+            ['XLOC_000001', 'XLOC_000002'])
+        self.assertEqual(sorted(g.gene_id for g in self.get_rows('chr2L:1501-2000')), [])
+        self.assertEqual(len(self.get_rows('chr2L:1-1,000,000')), 5)
+        self.assertEqual(len(self.get_rows('chr3R:1-1,000,000')), 0)
+        self.assertEqual(len(self.get_rows('not a region')), 0)
+        self.assertEqual(sorted((d.gene.gene_id, d.sample.sample_name)
+            for d in self.get_rows('chr2L:4500-4501', 'data')),
+            [('XLOC_000004', 'q1'), ('XLOC_000004', 'q2')])
+        
+    def test_plot(self):
+        request = RequestFactory().get('/', {'region': 'chr2L:1,200-2,100'})
+        view = VolcanoPlotView(request=request, kwargs={'exp_pk': self.exp.pk, 'track': 'gene'})
+        view.object_list = view.get_queryset()
+        # Plotted from the filtered rows, not the matrices of all tracks
+        self.assertIsNone(view.store)
+        self.assertEqual(sorted(view.object_list.values_list('gene__gene_id', flat=True)),
+            ['XLOC_000001', 'XLOC_000002'])
+        self.assertEqual(len(view.get_dataframe()), 2)
+        view = VolcanoPlotView(request=RequestFactory().get('/', {'region': 'chr2L'}),
+            kwargs={'exp_pk': self.exp.pk, 'track': 'gene'})
+        self.assertEqual(view.get_queryset().count(), 0)
+
+
+class ComparisonViewTest(ImportMixin, TestCase):
+    '''
+    Diff views and volcano plots of a single comparison (sample pair).
+    '''
+    def setUp(self):
+        super(ComparisonViewTest, self).setUp()
+        cache.clear()
+        User.objects.create_superuser('test', 'test@example.com', 'test')
+        self.client.login(username='test', password='test')
+        self.exp = self.import_exp()
+        self.q1q2 = Comparison.objects.get(experiment=self.exp)
+        q1, q2 = self.q1q2.sample_1, self.q1q2.sample_2
+        self.q2q1 = Comparison.objects.create(experiment=self.exp, sample_1=q2, sample_2=q1)
+        GeneExpDiffData.objects.filter(gene__gene_id__in=['XLOC_000003', 'XLOC_000004']).update(
+            comparison=self.q2q1, sample_1=q2, sample_2=q1)
+        
+    def test_track_view(self):
+        url = reverse('track_data_view', kwargs={'exp_pk': self.exp.pk, 'track': 'gene',
+            'data': 'diff'})
+        response = self.client.get(url, {'comparison__exact': self.q2q1.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(d.gene.gene_id for d in response.context['object_list']),
+            ['XLOC_000003', 'XLOC_000004'])
+        # The form offers the comparisons of the experiment only
+        field = response.context['form'].fields['comparison__exact']
+        self.assertEqual(list(field.queryset), [self.q1q2, self.q2q1])
+        self.assertEqual(field.initial, unicode(self.q2q1.pk))
+        response = self.client.get(url, {'comparison__exact': self.q1q2.pk})
+        self.assertEqual(len(response.context['object_list']), 3)
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['object_list']), 5)
+        
+    def get_plot_rows(self, comparison):
+        request = RequestFactory().get('/', {'comparison': comparison})
+        view = VolcanoPlotView(request=request, kwargs={'exp_pk': self.exp.pk, 'track': 'gene'})
+        view.object_list = view.get_queryset()
+        return sorted(view.object_list.values_list('gene__gene_id', flat=True))
+        
+    def test_plot(self):
+        self.assertEqual(self.get_plot_rows(self.q2q1.pk), ['XLOC_000003', 'XLOC_000004'])
+        self.assertEqual(self.get_plot_rows(self.q1q2.pk),
+            ['XLOC_000000', 'XLOC_000001', 'XLOC_000002'])
+        self.assertEqual(len(self.get_plot_rows('')), 5)
+        self.assertRaises(Http404, self.get_plot_rows, 'q1')
+        # Comparison menu of the plots page
+        response = self.client.get(reverse('track_plots_view', kwargs={'exp_pk': self.exp.pk,
+            'track': 'gene'}), {'comparison': self.q2q1.pk})
+        self.assertEqual(list(response.context['comparisons']), [self.q1q2, self.q2q1])
+        self.assertEqual(response.context['volcano_query'], '?comparison=%d' % self.q2q1.pk)
+
+
+class CountsTest(ImportMixin, TestCase):
+    '''
+    Row counts of the track views, see `cuff.counts`.
+    '''
+    def setUp(self):
+        super(CountsTest, self).setUp()
+        cache.clear()
+        self.exp = self.import_exp()
+        
+    def test_total(self):
+        self.assertFalse(TableStat.objects.exists())
+        self.assertEqual(counts.get_total(GeneData, self.exp), 10)
+        self.assertEqual(list(TableStat.objects.values_list('experiment', 'table', 'rows')),
+            [(self.exp.pk, 'cuff_genedata', 10)])
+        # Read from TableStat, not counted again
+        TableStat.objects.update(rows=12)
+        with self.assertNumQueries(1):
+            self.assertEqual(counts.get_total(GeneData, self.exp), 12)
+        count = counts.count_rows(GeneData.objects.for_exp(self.exp), self.exp, {})
+        self.assertEqual((count.value, count.exact), (12, True))
+        
+    def test_refresh(self):
+        counts.get_total(GeneData, self.exp)
+        other = self.import_exp()
+        counts.get_total(GeneData, other)
+        self.assertEqual(TableStat.objects.count(), 2)
+        # Imported again: counted again on the next view
+        os.utime(os.path.join(self.path, 'genes.fpkm_tracking'), (0, 0))
+        self.import_exp(update=self.exp.pk)
+        self.assertEqual(list(TableStat.objects.values_list('experiment', flat=True)), [other.pk])
+        self.assertEqual(counts.get_total(GeneData, self.exp), 10)
+        call_command('purge_exp', str(self.exp.pk), interactive=False, stdout=StringIO())
+        self.assertEqual(list(TableStat.objects.values_list('experiment', flat=True)), [other.pk])
+        
+    def test_cache(self):
+        queryset = GeneData.objects.for_exp(self.exp).filter(status=STATUS_OK)
+        filters = {'status__in': [STATUS_OK]}
+        count = counts.count_rows(queryset, self.exp, filters)
+        self.assertEqual((count.value, count.exact), (4, True))
+        # Same filters and region: from the cache
+        with self.assertNumQueries(0):
+            self.assertEqual(counts.count_rows(queryset, self.exp, filters).value, 4)
+        count = counts.count_rows(queryset, self.exp, filters, 'chr2L:1-1500')
+        self.assertEqual(count.value, 4)
+        # Above the threshold: no estimate on SQLite, a lower bound
+        queryset = GeneData.objects.for_exp(self.exp)
+        count = counts.count_rows(queryset, self.exp, {'fpkm__gte': 0}, threshold=3)
+        self.assertEqual((count.value, count.exact, count.at_least), (3, False, True))
+        self.assertEqual(unicode(count), 'more than 3')
+        self.assertIsNone(counts.estimate(queryset))
+        with self.settings(CUFF_COUNT_CACHE_TTL=0):
+            cache.clear()
+            self.assertEqual(counts.count_rows(queryset, self.exp, {'fpkm__gte': 0}).value, 10)
+            # Not cached: checked against the threshold and counted again
+            with self.assertNumQueries(2):
+                counts.count_rows(queryset, self.exp, {'fpkm__gte': 0})
+        
+    def test_row_count(self):
+        self.assertEqual(unicode(counts.RowCount(1234567)), '1,234,567')
+        self.assertEqual(unicode(counts.RowCount(1234567, exact=False)), 'about 1.2M')
+        self.assertEqual(unicode(counts.RowCount(56789, exact=False)), 'about 57k')
+        self.assertEqual(unicode(counts.RowCount(0, exact=False)), 'about 0')
+        
+    def test_counted_queryset(self):
+        queryset = GeneData.objects.for_exp(self.exp).order_by('pk')
+        counted = counts.CountedQuerySet(queryset, 42)
+        self.assertIs(counted.model, GeneData)
+        with self.assertNumQueries(0):
+            self.assertEqual(counted.count(), 42)
+            self.assertEqual(len(counted), 42)
+        self.assertEqual([d.pk for d in counted[2:4]], [d.pk for d in queryset[2:4]])
+        self.assertEqual([d.pk for d in counted], [d.pk for d in queryset])
+
+
+class ArchiveTest(ImportMixin, TestCase):
+    '''
+    Archival of experiments to files and their restore.
+    '''
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        self.archive_dir = self.settings(CUFF_ARCHIVE_DIR=os.path.join(self.path, 'archive'))
+        self.archive_dir.enable()
+        gtf = os.path.join(self.path, 'merged.gtf')
+        write_gtf(gtf)
+        self.exp, self.other = self.import_exp(gtf=gtf), self.import_exp(gtf=gtf)
+        
+    def tearDown(self):
+        self.archive_dir.disable()
+        super(ArchiveTest, self).tearDown()
+        
+    def get_rows(self, exp):
+        '''
+        Returns {model: all the rows of `exp`} for the archived tables.
+        '''
+        rows = {}
+        cursor = connection.cursor()
+        for model, scope in archive.archived_models():
+            cursor.execute('SELECT * FROM {0} WHERE {1} ORDER BY 1'.format(
+                connection.ops.quote_name(model._meta.db_table), scope), [exp.pk])
+            rows[model] = cursor.fetchall()
+        return rows
+        
+    def test_round_trip(self):
+        before, other = self.get_rows(self.exp), self.get_rows(self.other)
+        # Some of the archived columns are NULL
+        self.assertTrue(Gene.objects.filter(experiment=self.exp, coverage__isnull=True).exists())
+        self.assertTrue(Feature.objects.filter(experiment=self.exp, score__isnull=True).exists())
+        chunk = archive.BATCH_SIZE
+        archive.BATCH_SIZE = 3
+        try:
+            archived = archive.archive_experiment(self.exp)
+        finally:
+            archive.BATCH_SIZE = chunk
+        self.assertEqual(archived[GeneData], 10)
+        self.assertTrue(Experiment.objects.get(pk=self.exp.pk).archived)
+        self.assertFalse(any(self.get_rows(self.exp).values()))
+        self.assertEqual(self.get_rows(self.other), other)
+        path = archive.get_path(self.exp)
+        # A file per 3 rows
+        chunks = archive.table_chunks(GeneData, path)
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual([len(archive.read_table(GeneData, c)) for c in chunks], [3, 3, 3, 1])
+        with np.load(archive.table_chunks(Feature, path)[0]) as arrays:
+            self.assertIn('score__null', arrays.files)
+            self.assertNotIn('line__null', arrays.files)
+        restored = archive.restore_experiment(self.exp)
+        self.assertEqual(restored, dict((m, n) for m, n in archived.items() if n))
+        self.assertFalse(Experiment.objects.get(pk=self.exp.pk).archived)
+        self.assertEqual(self.get_rows(self.exp), before)
+        self.assertEqual(self.get_rows(self.other), other)
+        self.assertFalse(os.path.exists(path))
+        
+    def test_queued_restore(self):
+        User.objects.create_superuser('test', 'test@example.com', 'test')
+        self.client.login(username='test', password='test')
+        call_command('archive_exp', str(self.exp.pk), stdout=StringIO())
+        url = reverse('track_data_view', kwargs={'exp_pk': self.exp.pk, 'track': 'gene',
+            'data': 'data'})
+        # The request doesn't restore the experiment, it is queued
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertTemplateUsed(response, 'cuff/restoring.html')
+        self.assertEqual(response['Retry-After'], str(views.RESTORE_RETRY))
+        response = self.client.get(reverse('volcano_plot_view',
+            kwargs={'exp_pk': self.exp.pk, 'track': 'gene'}))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(GeneData.objects.for_exp(self.exp).count(), 0)
+        self.assertTrue(os.path.exists(os.path.join(archive.get_path(self.exp),
+            archive.RESTORE_REQUEST)))
+        out = StringIO()
+        call_command('archive_exp', queued=True, stdout=out)
+        self.assertIn('Restored experiment {0}'.format(self.exp.pk), out.getvalue())
+        self.assertIn('GeneData: 10 rows restored', out.getvalue())
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(archive.restore_queued(), {})
+
+# Tables of the string composite keys schema, as created by syncdb
+# before the integer foreign keys
+OLD_SCHEMA = (
+    '''CREATE TABLE "cuff_experiment" ("id" integer NOT NULL PRIMARY KEY,
+        "title" varchar(100) NOT NULL, "species" varchar(100) NOT NULL,
+        "library" varchar(100) NOT NULL, "run_date" date NOT NULL,
+        "analysis_date" date NOT NULL, "description" text)''',
+    '''CREATE TABLE "cuff_sample" ("id" integer NOT NULL PRIMARY KEY,
+        "experiment_id" integer NOT NULL, "sample_index" integer NOT NULL,
+        "sample_name" varchar(45) NOT NULL, "sample_pk" varchar(75) NOT NULL UNIQUE)''',
+    '''CREATE TABLE "cuff_replicate" ("id" integer NOT NULL PRIMARY KEY,
+        "file_name" varchar(200) NOT NULL, "sample_id" varchar(75) NOT NULL,
+        "replicate" integer NOT NULL, "rep_pk" varchar(45) NOT NULL UNIQUE,
+        "rep_name" varchar(45) NOT NULL, "total_mass" real NOT NULL,
+        "norm_mass" real NOT NULL, "internal_scale" real NOT NULL,
+        "external_scale" real NOT NULL)''',
+    '''CREATE TABLE "cuff_gene" ("id" integer NOT NULL PRIMARY KEY,
+        "track_pk" varchar(75) NOT NULL UNIQUE, "experiment_id" integer NOT NULL,
+        "class_code" varchar(45), "nearest_ref_id" varchar(45) NOT NULL,
+        "gene_short_name" varchar(250) NOT NULL, "locus" varchar(45) NOT NULL,
+        "length" integer, "coverage" real, "gene_id" varchar(45) NOT NULL)''',
+    '''CREATE TABLE "cuff_genedata" ("id" integer NOT NULL PRIMARY KEY,
+        "sample_id" varchar(75) NOT NULL, "fpkm" real NOT NULL,
+        "conf_hi" real NOT NULL, "conf_lo" real NOT NULL,
+        "status" varchar(45) NOT NULL, "gene_id" varchar(75) NOT NULL)''',
+    '''CREATE TABLE "cuff_geneexpdiffdata" ("id" integer NOT NULL PRIMARY KEY,
+        "sample_1_id" varchar(75) NOT NULL, "sample_2_id" varchar(75) NOT NULL,
+        "status" varchar(45) NOT NULL, "value_1" real NOT NULL,
+        "value_2" real NOT NULL, "test_stat" real NOT NULL,
+        "p_value" real NOT NULL, "q_value" real NOT NULL,
+        "significant" varchar(45) NOT NULL, "gene_id" varchar(75) NOT NULL,
+        "log2_fold_change" real NOT NULL)''',
+    )
+
+OLD_ROWS = (
+    ('cuff_experiment', [(3, 'old', 'D.melanogaster', 'RNA-seq', '2013-01-01', '2013-02-01', None)]),
+    ('cuff_sample', [(5, 3, 0, 'q1', 'q1-exp-3'), (6, 3, 1, 'q2', 'q2-exp-3')]),
+    ('cuff_replicate', [(7, 'q1.bam', 'q1-exp-3', 0, 'q1_0-exp-3', 'q1_0', 1000.0, 900.0, 1.0, 1.0)]),
+    ('cuff_gene', [
+        (10, 'XLOC_1-exp-3', 3, '=', 'NM_1', 'g1', 'chr2L:1001-1500', 500, None, 'XLOC_1'),
+        (11, 'XLOC_2-exp-3', 3, 'u', '-', '-', 'chrX:5-5', 1, None, 'XLOC_2')]),
+    ('cuff_genedata', [
+        (20, 'q1-exp-3', 1.5, 2.0, 1.0, 'OK', 'XLOC_1-exp-3'),
+        (21, 'q2-exp-3', 0.0, 0.0, 0.0, 'LOWDATA', 'XLOC_1-exp-3'),
+        (22, 'q1-exp-3', 3.0, 4.0, 2.0, 'HIDATA', 'XLOC_2-exp-3'),
+        # References a track excluded from the import
+        (23, 'q1-exp-3', 1.0, 1.0, 1.0, 'OK', 'XLOC_9-exp-3')]),
+    ('cuff_geneexpdiffdata', [
+        (30, 'q1-exp-3', 'q2-exp-3', 'OK', 1.0, 2.0, 0.5, 0.01, 0.02, 'yes', 'XLOC_1-exp-3', 1.0),
+        (31, 'q1-exp-3', 'q2-exp-3', 'NOTEST', 3.0, 3.0, 0.0, 1.0, 1.0, 'no', 'XLOC_2-exp-3', 0.0)]),
+    )
+
 
-from django.test import TestCase
+class MigrationTest(ImportMixin, TestCase):
+    '''
+    Schema migration commands on databases of older schemas.
+    '''
+    
+    def tearDown(self):
+        if 'old' in connections.databases:
+            connections['old'].close()
+            del connections['old']
+            del connections.databases['old']
+        super(MigrationTest, self).tearDown()
+        
+    def old_database(self, schema=OLD_SCHEMA, rows=OLD_ROWS):
+        '''
+        Adds database 'old' with the tables `schema` filled with `rows`.
+        '''
+        connections.databases['old'] = {'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(self.path, 'old.db')}
+        cursor = connections['old'].cursor()
+        for sql in schema:
+            cursor.execute(sql)
+        for table, values in rows:
+            cursor.executemany('INSERT INTO {0} VALUES ({1})'.format(table,
+                ', '.join(['%s'] * len(values[0]))), values)
+        return connections['old']
+        
+    def test_migrate_keys(self):
+        self.old_database()
+        out = StringIO()
+        call_command('migrate_keys', source='old', stdout=out)
+        self.assertIn('1 dropped', out.getvalue())
+        experiment = Experiment.objects.get(pk=3)
+        self.assertEqual(experiment.species, 'D.melanogaster')
+        self.assertFalse(experiment.archived)
+        self.assertEqual(list(Sample.objects.filter(experiment=experiment)
+            .order_by('pk').values_list('pk', 'sample_name')), [(5, 'q1'), (6, 'q2')])
+        self.assertEqual(Replicate.objects.get(pk=7).sample_id, 5)
+        self.assertEqual(list(Gene.objects.filter(experiment=experiment)
+            .order_by('pk').values_list('pk', 'gene_id', 'class_code')),
+            [(10, 'XLOC_1', '='), (11, 'XLOC_2', 'u')])
+        # Annotation columns are linked to the dictionary, loci parsed
+        self.assertEqual(list(Gene.objects.order_by('pk').values_list(
+            'annotation__nearest_ref_id', 'annotation__gene_short_name', 'annotation__locus')),
+            [('NM_1', 'g1', 'chr2L:1001-1500'), ('', '', 'chrX:5-5')])
+        self.assertEqual(list(Gene.objects.order_by('pk').values_list(
+            'chrom', 'chrom_start', 'chrom_end', 'bin')),
+            [('chr2L', 1001, 1500, locus.bin_from_range(1001, 1500)),
+             ('chrX', 5, 5, locus.bin_from_range(5, 5))])
+        self.assertEqual(Annotation.objects.count(), 2)
+        self.assertEqual(list(GeneData.objects.order_by('pk').values_list(
+            'pk', 'experiment', 'gene', 'sample', 'status')),
+            [(20, 3, 10, 5, STATUS_OK), (21, 3, 10, 6, STATUS_LOWDATA), (22, 3, 11, 5, STATUS_HIDATA)])
+        self.assertEqual(list(GeneExpDiffData.objects.order_by('pk').values_list(
+            'experiment', 'gene', 'sample_1', 'sample_2', 'status', 'significant')),
+            [(3, 10, 5, 6, STATUS_OK, True), (3, 11, 5, 6, STATUS_NOTEST, False)])
+        # Migrated experiments are skipped
+        out = StringIO()
+        call_command('migrate_keys', source='old', stdout=out)
+        self.assertIn('Experiment 3 is already migrated', out.getvalue())
+        self.assertEqual(GeneData.objects.count(), 3)
+        self.assertEqual(Annotation.objects.count(), 2)
+        self.assertRaises(CommandError, call_command, 'migrate_keys')
+        
+    def test_backfill_experiment(self):
+        exp = self.import_exp()
+        expected = sorted(GeneData.objects.values_list('pk', 'gene__experiment'))
+        # Table of the schema before the experiment column
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE old_genedata AS SELECT id, sample_id, fpkm, conf_hi, '
+            'conf_lo, status, gene_id FROM cuff_genedata')
+        cursor.execute('DROP TABLE cuff_genedata')
+        cursor.execute('ALTER TABLE old_genedata RENAME TO cuff_genedata')
+        out = StringIO()
+        call_command('backfill_experiment', batch_size=3, stdout=out)
+        self.assertIn('GeneData: added experiment column', out.getvalue())
+        self.assertIn('GeneData: 10 rows backfilled', out.getvalue())
+        self.assertIn('GeneExpDiffData: 0 rows backfilled', out.getvalue())
+        self.assertEqual(sorted(GeneData.objects.values_list('pk', 'experiment')), expected)
+        self.assertEqual(GeneData.objects.for_exp(exp).count(), 10)
+        indexes = connection.introspection.get_indexes(cursor, 'cuff_genedata')
+        self.assertIn('experiment_id', indexes)
+        # Nothing left to do the second time
+        out = StringIO()
+        call_command('backfill_experiment', stdout=out)
+        self.assertNotIn('added', out.getvalue())
+        self.assertIn('GeneData: 0 rows backfilled', out.getvalue())
+        
+    def test_backfill_comparisons(self):
+        exp = self.import_exp()
+        comparison = Comparison.objects.get(experiment=exp)
+        self.assertEqual(PromoterDiffData.objects.count(), 5)
+        # Tables of the schema before the comparisons
+        cursor = connection.cursor()
+        cursor.execute('CREATE TABLE old_diff AS SELECT id, experiment_id, gene_id, sample_1_id, '
+            'sample_2_id, status, value_1, value_2, log2_fold_change, test_stat, p_value, '
+            'q_value, significant FROM cuff_geneexpdiffdata')
+        cursor.execute('DROP TABLE cuff_geneexpdiffdata')
+        cursor.execute('ALTER TABLE old_diff RENAME TO cuff_geneexpdiffdata')
+        cursor.execute('UPDATE cuff_promoterdiffdata SET comparison_id = NULL')
+        out = StringIO()
+        call_command('backfill_comparisons', batch_size=2, stdout=out)
+        self.assertNotIn('Created', out.getvalue())
+        self.assertIn('GeneExpDiffData: added comparison column', out.getvalue())
+        self.assertIn('GeneExpDiffData: 5 rows linked', out.getvalue())
+        self.assertNotIn('PromoterDiffData: added', out.getvalue())
+        self.assertIn('PromoterDiffData: 5 rows linked', out.getvalue())
+        # The sample pair is the comparison imported with the experiment
+        self.assertIn('1 comparisons', out.getvalue())
+        self.assertEqual(list(Comparison.objects.values_list('pk', flat=True)), [comparison.pk])
+        self.assertEqual(set(GeneExpDiffData.objects.values_list('comparison', flat=True)),
+            set([comparison.pk]))
+        self.assertEqual(GeneExpDiffData.objects.filter(comparison=comparison).count(), 5)
+        # Indexes starting with the comparison
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND "
+            "tbl_name = 'cuff_geneexpdiffdata'")
+        self.assertEqual(sorted(sql.split('(', 1)[1] for sql, in cursor.fetchall()),
+            ['"comparison_id", "q_value")', '"comparison_id", "significant", "q_value")'])
+        # Databases without the comparisons table get it
+        cursor.execute('DROP TABLE cuff_comparison')
+        cursor.execute('UPDATE cuff_geneexpdiffdata SET comparison_id = NULL')
+        out = StringIO()
+        call_command('backfill_comparisons', stdout=out)
+        self.assertIn('Created cuff_comparison', out.getvalue())
+        self.assertNotIn('added', out.getvalue())
+        self.assertIn('GeneExpDiffData: 5 rows linked', out.getvalue())
+        self.assertIn('PromoterDiffData: 0 rows linked', out.getvalue())
+        comparison = Comparison.objects.get()
+        self.assertEqual((comparison.sample_1.sample_name, comparison.sample_2.sample_name),
+            ('q1', 'q2'))
+        self.assertEqual(GeneExpDiffData.objects.filter(comparison=comparison).count(), 5)
+        self.assertRaises(CommandError, call_command, 'backfill_comparisons', database='nope')
+        
+    def text_columns(self, table, choices):
+        '''
+        Recreates `table` the way the old schema stored the columns of
+        `choices` ({column: choices}), as their text labels.
+        '''
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA table_info({0})'.format(table))
+        definitions, values = [], []
+        for cid, name, type, notnull, default, pk in cursor.fetchall():
+            if name in choices:
+                type = 'varchar(45)'
+                values.append('CASE "{0}" {1} END'.format(name, ' '.join(
+                    "WHEN {0} THEN '{1}'".format(int(code), label)
+                    for code, label in choices[name])))
+            else:
+                values.append('"{0}"'.format(name))
+            definitions.append('"{0}" {1}{2}{3}'.format(name, type,
+                ' NOT NULL' if notnull else '', ' PRIMARY KEY' if pk else ''))
+        cursor.execute('CREATE TABLE old_table ({0})'.format(', '.join(definitions)))
+        cursor.execute('INSERT INTO old_table SELECT {0} FROM {1}'.format(', '.join(values), table))
+        cursor.execute('DROP TABLE {0}'.format(table))
+        cursor.execute('ALTER TABLE old_table RENAME TO {0}'.format(table))
+        
+    def test_encode_status(self):
+        self.import_exp()
+        data = sorted(GeneData.objects.values_list('pk', 'status'))
+        diff = sorted(GeneExpDiffData.objects.values_list('pk', 'status', 'significant'))
+        self.text_columns('cuff_genedata', {'status': STATUS_CHOICES})
+        self.text_columns('cuff_geneexpdiffdata', {'status': STATUS_CHOICES,
+            'significant': SIGNIFICANT_CHOICES})
+        cursor = connection.cursor()
+        cursor.execute("UPDATE cuff_genedata SET status = 'BOGUS' WHERE id = %s", [data[0][0]])
+        self.assertRaisesRegexp(CommandError, 'GeneData.status: BOGUS', call_command,
+            'encode_status', batch_size=3, stdout=StringIO())
+        # Nothing was converted
+        cursor.execute('SELECT DISTINCT significant FROM cuff_geneexpdiffdata')
+        self.assertEqual(sorted(row[0] for row in cursor.fetchall()), ['no', 'yes'])
+        cursor.execute("UPDATE cuff_genedata SET status = %s WHERE id = %s",
+            [dict(STATUS_CHOICES)[data[0][1]], data[0][0]])
+        out = StringIO()
+        call_command('encode_status', batch_size=3, stdout=out)
+        self.assertIn('GeneData: converting status', out.getvalue())
+        self.assertIn('GeneExpDiffData: converting status, significant', out.getvalue())
+        self.assertEqual(sorted(GeneData.objects.values_list('pk', 'status')), data)
+        self.assertEqual(sorted(GeneExpDiffData.objects.values_list('pk', 'status', 'significant')), diff)
+        cursor.execute('SELECT DISTINCT typeof(status) FROM cuff_genedata')
+        self.assertEqual(cursor.fetchall(), [('integer',)])
+        # Converted columns are skipped
+        out = StringIO()
+        call_command('encode_status', stdout=out)
+        self.assertNotIn('converting', out.getvalue())
 
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+class PartitionTest(SimpleTestCase):
+    '''
+    Statements of the partition managers. PostgreSQL quotes names like
+    SQLite, so they are built with the SQLite test connection.
+    '''
+    def setUp(self):
+        self.partitions = partitions.PostgreSQLPartitions(connection)
+        
+    def test_postgresql(self):
+        self.assertEqual(self.partitions.create_sql('cuff_genedata', 3),
+            ['CREATE TABLE "cuff_genedata_exp3" PARTITION OF "cuff_genedata" FOR VALUES IN (3)'])
+        self.assertEqual(self.partitions.detach_sql('cuff_genedata', 3),
+            ['ALTER TABLE "cuff_genedata" DETACH PARTITION "cuff_genedata_exp3"'])
+        self.assertEqual(self.partitions.drop_sql('cuff_genedata', 3),
+            ['DROP TABLE "cuff_genedata_exp3"'])
+        self.assertEqual(self.partitions.partition_name('cuff_genedata', 3), 'cuff_genedata_exp3')
+        
+    def test_postgresql_setup(self):
+        statements = self.partitions.setup_sql(GeneData, [5, 2])
+        self.assertEqual(statements[:9], [
+            'ALTER TABLE "cuff_genedata" RENAME TO "cuff_genedata_unpartitioned"',
+            'CREATE TABLE "cuff_genedata" (LIKE "cuff_genedata_unpartitioned" INCLUDING DEFAULTS) '
+                'PARTITION BY LIST ("experiment_id")',
+            'ALTER SEQUENCE "cuff_genedata_id_seq" OWNED BY "cuff_genedata"."id"',
+            'CREATE TABLE "cuff_genedata_exp2" PARTITION OF "cuff_genedata" FOR VALUES IN (2)',
+            'INSERT INTO "cuff_genedata" SELECT * FROM "cuff_genedata_unpartitioned" '
+                'WHERE "experiment_id" = 2',
+            'CREATE TABLE "cuff_genedata_exp5" PARTITION OF "cuff_genedata" FOR VALUES IN (5)',
+            'INSERT INTO "cuff_genedata" SELECT * FROM "cuff_genedata_unpartitioned" '
+                'WHERE "experiment_id" = 5',
+            'DROP TABLE "cuff_genedata_unpartitioned"',
+            'ALTER TABLE "cuff_genedata" ADD PRIMARY KEY ("id", "experiment_id")',
+            ])
+        # The indexes are built on the partitioned table
+        indexes = statements[9:]
+        self.assertTrue(indexes)
+        self.assertTrue(all(sql.startswith('CREATE INDEX') and '"cuff_genedata"' in sql
+            for sql in indexes))
+        
+    def test_mysql(self):
+        mysql = partitions.MySQLPartitions(connection)
+        self.assertEqual(mysql.setup_sql(GeneData, []), [
+            'ALTER TABLE "cuff_genedata" DROP PRIMARY KEY, ADD PRIMARY KEY ("id", "experiment_id")',
+            'ALTER TABLE "cuff_genedata" PARTITION BY LIST ("experiment_id") '
+                '(PARTITION "p0" VALUES IN (0))',
+            ])
+        self.assertEqual(mysql.detach_sql('cuff_genedata', 3)[-2:], [
+            'ALTER TABLE "cuff_genedata" EXCHANGE PARTITION "p3" WITH TABLE "cuff_genedata_exp3"',
+            'ALTER TABLE "cuff_genedata" DROP PARTITION "p3"',
+            ])
+        self.assertEqual(mysql.drop_foreign_keys_sql('cuff_genedata', []), [])
+        
+    def test_sqlite(self):
+        self.assertIsNone(partitions.get_partition_manager(connection))
+        self.assertRaisesRegexp(CommandError, 'not supported', call_command, 'partition_exp')
+        self.assertEqual(set(partitions.partitioned_models()) & set([Gene, Sample]), set())
+        self.assertIn(GeneExpDiffData, partitions.partitioned_models())
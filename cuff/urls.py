@@ -12,6 +12,9 @@ from plot import views as plt_views
 #   /exp/density/<exp_pk>/<track>/ - density plot for the track in exp
 #   /exp/<exp_pk>/<track>/<data>/ - trac data for exp
 #                                   `data`: data, replicates, count, diff
+#   /exp/<exp_pk>/<track>/[<data>/]json/ - rows of the above as JSON
+#   /exp/<exp_pk>/<track>/[<data>/]export/ - all rows of the above as
+#                                            TSV/CSV
 
 #   /exp/<exp_pk>/<dist>/ - distribution diff data for exp
 #
@@ -25,6 +28,16 @@ urlpatterns = patterns('',
     # Track urls
     url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/$', login_required(views.TrackView.as_view()),
         name='track_base_view'),
+    # Rows of the track urls as JSON and exports, before `data` takes
+    # 'json' and 'export'
+    url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/json/$', login_required(views.TrackJSONView.as_view()),
+        name='track_base_json'),
+    url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/(?P<data>\w+)/json/$', login_required(views.TrackJSONView.as_view()),
+        name='track_data_json'),
+    url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/export/$', login_required(views.TrackExportView.as_view()),
+        name='track_base_export'),
+    url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/(?P<data>\w+)/export/$', login_required(views.TrackExportView.as_view()),
+        name='track_data_export'),
     url(r'^exp/(?P<exp_pk>\d+)/(?P<track>\w+)/(?P<data>\w+)/$', login_required(views.TrackView.as_view()),
         name='track_data_view'),
     # Plot urls
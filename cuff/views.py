@@ -1,14 +1,100 @@
+import csv, json, math, zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.urlresolvers import reverse
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.loading import get_model
-from django.shortcuts import get_object_or_404
+from django.shortcuts import get_object_or_404, render
 from django.views.generic.list import ListView
 from django.views.generic.base import TemplateView, View
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.utils.encoding import smart_str
+from django.utils.http import urlencode
 from django.utils.text import capfirst
 
+from cuff import archive, counts, keyset
+from cuff.locus import region_filter
 from cuff.models import Experiment
 
-ALLOWED_LOOKUPS = ('iexact', 'icontains', 'in', 'gt', 'gte', 'lt',
+ALLOWED_LOOKUPS = ('exact', 'iexact', 'icontains', 'in', 'gt', 'gte', 'lt',
     'lte', 'istratswith', 'iendswith', 'range', 'isnull', 'iregex')
+# Rows per page of the track views
+PAGE_SIZE = 100
+# Largest window of rows of TrackJSONView
+MAX_WINDOW = 1000
+# Rows read at a time by TrackExportView
+EXPORT_CHUNK = 2000
+# format: (delimiter, content type) of TrackExportView
+EXPORT_FORMATS = {
+    'tsv': ('\t', 'text/tab-separated-values; charset=utf-8'),
+    'csv': (',', 'text/csv; charset=utf-8'),
+    }
+# Larger result sets are paged by cursor rather than by OFFSET (see
+# cuff.keyset) and their counts estimated (see cuff.counts)
+KEYSET_THRESHOLD = 10000
+# Seconds after which the pages of an experiment being restored are
+# reloaded
+RESTORE_RETRY = 30
+
+
+def scroll_enabled():
+    '''
+    Whether the track tables are scrolled through, a window of rows of
+    TrackJSONView at a time (see static/js/track-scroll.js), rather
+    than paginated.
+    '''
+    return getattr(settings, 'CUFF_TRACK_SCROLL', True)
+
+
+def display_paths(model):
+    '''
+    Returns the related fields (lookup paths) read when rendering the
+    `list_display` fields of `model` rows: the foreign keys displayed
+    and whatever their __unicode__ reads (`display_related` of the
+    related model), so that they are selected with the rows.
+    '''
+    paths = []
+    for name in getattr(model._meta, 'list_display', ()):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if field.rel:
+            paths.append(name)
+            paths.extend(_related_paths(field.rel.to, name))
+    return paths
+
+
+def _related_paths(model, prefix):
+    paths = []
+    for name in getattr(model._meta, 'display_related', ()):
+        path = '{0}__{1}'.format(prefix, name) if prefix else name
+        paths.append(path)
+        paths.extend(_related_paths(model._meta.get_field(name).rel.to, path))
+    return paths
+
+
+class RestoreMixin(object):
+    '''
+    Views of the rows of an experiment. An archived experiment (see
+    `cuff.archive`) is queued for restore and the view answers 503 with
+    a "restoring" page until its rows are back.
+    '''
+    restoring_template = 'cuff/restoring.html'
+
+    def restoring_response(self, request, exp):
+        return render(request, self.restoring_template,
+            {'exp': exp, 'retry': RESTORE_RETRY}, status=503)
+
+    def dispatch(self, request, *args, **kwargs):
+        exp = get_object_or_404(Experiment, pk=int(kwargs.get('exp_pk', '')))
+        if exp.archived:
+            archive.request_restore(exp)
+            response = self.restoring_response(request, exp)
+            response['Retry-After'] = str(RESTORE_RETRY)
+            return response
+        return super(RestoreMixin, self).dispatch(request, *args, **kwargs)
 
 
 class TrackPlotsView(TemplateView):
@@ -18,12 +104,20 @@ class TrackPlotsView(TemplateView):
         context = super(TrackPlotsView, self).get_context_data(**kwargs)
         self.exp = get_object_or_404(Experiment, pk=int(self.kwargs.get('exp_pk', '')))
         context['exp'] = self.exp
+        # The volcano plot shows a single comparison if one is selected
+        context['comparisons'] = self.exp.comparison_set.select_related('sample_1', 'sample_2')
+        comparison = self.request.GET.get('comparison', '')
+        context['comparison'] = comparison if comparison.isdigit() else ''
+        context['volcano_query'] = '?comparison={0}'.format(
+            context['comparison']) if context['comparison'] else ''
         return context
 
 
-class TrackView(ListView):
+class TrackView(RestoreMixin, ListView):
     template_name = 'cuff/track.html'
     plot_qs = False
+    region = ''
+    cursor = ''
     
     def __init__(self, **kwargs):
         super(TrackView, self).__init__(**kwargs)
@@ -31,17 +125,45 @@ class TrackView(ListView):
         self.filters = kwargs.get('filters', {})
         self.ordering = kwargs.get('order', [])
         
+    def _get_codes(self, name):
+        '''
+        Returns {label: code} for the model field `name` if it is
+        stored as codes, None otherwise.
+        '''
+        fields = dict((f.name, f) for f in self.model._meta.fields)
+        if name in fields and fields[name].choices:
+            return dict((label.lower(), code) for code, label in fields[name].choices)
+        return None
+        
     def _get_filters(self, request):
         params = request.GET.copy()
         params.pop('page', None)
         params.pop('_filter', None)
+        # Keyset pagination cursor, see `get_keyset_page`
+        self.cursor = params.pop('cursor', [''])[-1]
+        # Window of rows of TrackJSONView
+        params.pop('limit', None)
+        # Options of TrackExportView
+        params.pop('format', None)
+        params.pop('compress', None)
         # TODO: Factor ordering out to `self.get_ordering()`
         self.ordering = params.pop('o', [])
+        # Region ('chr:start-end') is matched against the track
+        # coordinates, see `get_queryset`
+        self.region = params.pop('region', [''])[-1].strip()
         opts = self.model._meta
         filters = {}
         for k,v in params.items():
             if not v:
                 continue
+            name = k.split('__')[0]
+            codes = self._get_codes(name)
+            if codes is not None:
+                # Coded fields (status, significant) are filtered by
+                # label, unknown labels match nothing
+                filters.update({smart_str('%s__in' % name):
+                    [codes[v.lower()]] if v.lower() in codes else [],})
+                continue
             try:
                 field, lookup = k.split('__')
                 if lookup in ALLOWED_LOOKUPS:
@@ -54,24 +176,95 @@ class TrackView(ListView):
 
     def get_queryset(self):
         qs = self.model._default_manager.for_exp(self.exp)
+        if self.region:
+            try:
+                qs = qs.filter(region_filter(self.model, self.region))
+            except ValueError:
+                # Not a region, matches nothing
+                qs = qs.none()
+        paths = display_paths(self.model)
+        if paths:
+            # One query per page rather than one per row and foreign key
+            qs = qs.select_related(*paths)
         return qs.filter(**self.filters).order_by(*self.ordering)
     
     def get_form(self):
         if self.form_class:
-            return self.form_class()
+            form = self.form_class()
+            if 'comparison__exact' in form.fields:
+                # Diff tables are filtered by the comparisons of the
+                # experiment
+                field = form.fields['comparison__exact']
+                field.queryset = field.queryset.filter(experiment=self.exp)
+                field.initial = self.filters.get('comparison__exact')
+            return form
         else:
             return None
 
+    def get_row_count(self, queryset):
+        '''
+        Returns the RowCount of `queryset` (see `cuff.counts`), None if
+        counting is switched off.
+        '''
+        if not counts.counts_enabled():
+            return None
+        return counts.count_rows(queryset, self.exp, self.filters, self.region,
+            KEYSET_THRESHOLD)
+
+    def get_keyset_page(self, queryset, count, scroll=False):
+        '''
+        Returns the keyset page (see `cuff.keyset`) of `queryset` at
+        the requested cursor, or None if it is paged by OFFSET: result
+        sets counted to up to KEYSET_THRESHOLD rows and orderings keyset
+        pagination can't handle. Scrolled tables always start with a
+        keyset page, which the script continues after.
+        '''
+        if not scroll and not self.cursor and count is not None and count.exact and \
+                count.value <= KEYSET_THRESHOLD:
+            return None
+        try:
+            return keyset.paginate(queryset, self.ordering, self.cursor, PAGE_SIZE)
+        except ValueError:
+            # Mangled cursor or one of another ordering, start over
+            return keyset.paginate(queryset, self.ordering, None, PAGE_SIZE)
+
     def get_context_data(self,  **kwargs):
+        queryset = kwargs.get('object_list', self.object_list)
+        count = self.get_row_count(queryset)
+        # The windows of TrackJSONView are keyset pages
+        scroll = scroll_enabled() and keyset.get_sort_key(self.model, self.ordering) is not None
+        page = self.get_keyset_page(queryset, count, scroll)
+        if page is not None:
+            kwargs['object_list'] = page.object_list
+        elif count is not None and count.exact:
+            # Not counted again by the paginator
+            kwargs['object_list'] = counts.CountedQuerySet(queryset, count.value)
         context = super(TrackView, self).get_context_data(**kwargs)
         opts = self.model._meta
         context.update({
             'filters': self.filters,
+            'region': self.region,
             'model': self.model,
             'fields': opts.list_display,
             'form': self.get_form(),
             'exp': self.exp,
+            'page_size': PAGE_SIZE,
+            'keyset': page,
+            'row_count': count,
+            'scroll': scroll,
             })
+        # The GET parameters other than the cursor, for the links to the
+        # other pages, the rows of TrackJSONView and TrackExportView
+        params = [(k, v) for k, v in self.request.GET.items()
+            if k not in ('cursor', 'page')]
+        if page is not None:
+            context['keyset_getvars'] = '&' + urlencode(params) if params else ''
+        query = urlencode([(k, v) for k, v in params if k not in ('_plot', '_clear')])
+        name = 'track_data_{0}' if 'data' in self.kwargs else 'track_base_{0}'
+        context['json_url'] = '{0}?{1}'.format(reverse(name.format('json'),
+            kwargs=self.kwargs), query)
+        context['export_url'] = '{0}?{1}'.format(reverse(name.format('export'),
+            kwargs=self.kwargs), query)
         if self.plot_qs:
             context.update({
                 'plot_qs': self.plot_qs,
@@ -122,11 +315,164 @@ class TrackView(ListView):
         if '_clear' in request.GET:
             self.filters.clear()
             self.ordering = []
+            self.region = ''
         else:
             filters = self._get_filters(request)
             self.filters.update(filters)
-            if '_plot' in request.GET and self.filters:
+            if '_plot' in request.GET and (self.filters or self.region):
                 # TODO: Enable plotting only for TrackData
                 self.plot_qs = True
             #self.ordering = self._get_ordering(request)
         return super(TrackView, self).get(request, *args, **kwargs)
+
+
+class TrackJSONView(TrackView):
+    '''
+    Window of rows of a track view as JSON, for the virtual scrolling
+    of the track tables (see static/js/track-scroll.js):
+
+        {"fields": [<list_display>],
+         "columns": [[<values of the field>], ...],
+         "count": {"value": 1200000, "exact": false, "text": "about 1.2M"},
+         "next": {"cursor": "..."}}
+
+    Takes the filters and ordering of TrackView, `limit` rows (up to
+    MAX_WINDOW) and the `next` parameters of the previous window.
+    Windows are keyset pages (see cuff.keyset), so orderings by the
+    fields of related models get 404. Rows are read as values(), foreign
+    keys are rendered with one query per column and coded fields by
+    their labels.
+    '''
+    def _set_window_options(self, request):
+        self._set_options()
+        self.filters.update(self._get_filters(request))
+        if keyset.get_sort_key(self.model, self.ordering) is None:
+            raise Http404
+
+    def get_window(self, queryset, limit, cursor=None):
+        '''
+        Returns the `limit` rows after `cursor` and the parameters of the
+        next window (None at the end).
+        '''
+        rows = queryset.values()
+        try:
+            page = keyset.paginate(rows, self.ordering, cursor, limit)
+        except ValueError:
+            page = keyset.paginate(rows, self.ordering, None, limit)
+        return page.object_list, {'cursor': page.next_cursor} if page.has_next else None
+
+    def get_column(self, name, rows):
+        try:
+            field = self.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return [None] * len(rows)
+        values = [row[field.attname] for row in rows]
+        if field.rel:
+            related = field.rel.to._default_manager.select_related(
+                *_related_paths(field.rel.to, '')).in_bulk(set(v for v in values if v is not None))
+            return [unicode(related[v]) if v in related else None for v in values]
+        if field.choices:
+            labels = dict(field.flatchoices)
+            return [labels.get(v, v) for v in values]
+        # No infinity and NaN in JSON
+        return [unicode(v) if isinstance(v, float) and (math.isinf(v) or math.isnan(v)) else v
+            for v in values]
+
+    def get(self, request, *args, **kwargs):
+        self._set_window_options(request)
+        try:
+            limit = min(max(int(request.GET.get('limit', PAGE_SIZE)), 1), MAX_WINDOW)
+        except ValueError:
+            limit = PAGE_SIZE
+        queryset = self.get_queryset()
+        count = self.get_row_count(queryset)
+        rows, next_window = self.get_window(queryset, limit, self.cursor)
+        fields = self.model._meta.list_display
+        data = {
+            'fields': fields,
+            'columns': [self.get_column(name, rows) for name in fields],
+            'count': None if count is None else {
+                'value': count.value,
+                'exact': count.exact,
+                'text': unicode(count),},
+            'next': next_window,
+            }
+        return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')),
+            content_type='application/json')
+
+
+class _Echo(object):
+    '''
+    File-like object returning what is written to it, so that the lines
+    of a csv.writer can be yielded.
+    '''
+    def write(self, value):
+        return value
+
+
+def _export_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return repr(value)
+    return smart_str(value)
+
+
+def _gzip(chunks):
+    '''
+    Compresses the string `chunks` to a gzip stream as they come.
+    '''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class TrackExportView(TrackJSONView):
+    '''
+    All the rows of a track view, with its filters and ordering, as a
+    TSV (or `format=csv`) download, gzip compressed with
+    `compress=gzip`.
+
+    The rows are read EXPORT_CHUNK at a time as the windows of
+    TrackJSONView, each an index range scan after the last row of the
+    previous one (see cuff.keyset), and sent as they are read, so the
+    download starts right away and the memory used doesn't grow with the
+    table.
+    '''
+    def get_lines(self, queryset, delimiter):
+        '''
+        Yields the header line and the lines of each chunk of rows of
+        `queryset`.
+        '''
+        writer = csv.writer(_Echo(), delimiter=delimiter, lineterminator='\n')
+        fields = self.model._meta.list_display
+        yield writer.writerow([smart_str(name) for name in fields])
+        window = {}
+        while window is not None:
+            rows, window = self.get_window(queryset, EXPORT_CHUNK, window.get('cursor'))
+            columns = [self.get_column(name, rows) for name in fields]
+            yield ''.join(writer.writerow([_export_value(v) for v in row])
+                for row in zip(*columns))
+
+    def get_filename(self, extension):
+        parts = ['exp{0}'.format(self.exp.pk), self.kwargs['track']]
+        if 'data' in self.kwargs:
+            parts.append(self.kwargs['data'])
+        return '{0}.{1}'.format('_'.join(parts), extension)
+
+    def get(self, request, *args, **kwargs):
+        self._set_window_options(request)
+        extension = request.GET.get('format', 'tsv')
+        if extension not in EXPORT_FORMATS:
+            raise Http404
+        delimiter, content_type = EXPORT_FORMATS[extension]
+        lines = self.get_lines(self.get_queryset(), delimiter)
+        filename = self.get_filename(extension)
+        if request.GET.get('compress') == 'gzip':
+            lines, content_type, filename = _gzip(lines), 'application/gzip', filename + '.gz'
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)
+        return response
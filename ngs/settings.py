@@ -51,6 +51,27 @@ USE_TZ = True
 # Example: "/var/www/example.com/media/"
 MEDIA_ROOT = '/var/www/media/'
 
+# Absolute filesystem path to the directory holding the memory-mapped
+# expression matrices of the experiments (see cuff/matrices.py).
+# None disables the matrix store, plots are then built from the database.
+CUFF_MATRIX_DIR = '/var/www/matrices/'
+
+# Absolute filesystem path to the directory holding the compressed rows of
+# the archived experiments (see cuff/archive.py). Required by archive_exp.
+CUFF_ARCHIVE_DIR = '/var/www/archive/'
+
+# Whether the track views show (possibly estimated) row counts, see
+# cuff/counts.py. False only links to the next and previous pages.
+CUFF_TRACK_COUNTS = True
+
+# Seconds the row counts of filtered track views are cached for. Use a
+# shared cache backend (CACHES) when running several server processes.
+CUFF_COUNT_CACHE_TTL = 600
+
+# Whether the track tables are scrolled through, loading the rows as they
+# come into view (static/js/track-scroll.js), rather than paginated.
+CUFF_TRACK_SCROLL = True
+
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash.
 # Examples: "http://example.com/media/", "http://media.example.com/"
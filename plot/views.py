@@ -7,13 +7,16 @@ from pylab import figure, plot
 from scipy.stats.kde import gaussian_kde
 import matplotlib.pyplot as plt
 
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.core.exceptions import ImproperlyConfigured, FieldError
 from django.db.models.loading import get_model
 from django.shortcuts import get_object_or_404
 from django.views.generic.list import ListView
 
+from cuff.locus import region_filter
+from cuff.matrices import get_store
 from cuff.models import Experiment
+from cuff.views import RestoreMixin
 from plot.ggstyle import rstyle
 
 
@@ -57,11 +60,12 @@ class PlotMixin(object):
         return response
 
 
-class QuerysetPlotView(ListView, PlotMixin):
+class QuerysetPlotView(RestoreMixin, ListView, PlotMixin):
     '''
     A view that plots data from a queryset.
     '''
     data_fields = None
+    store = None
     
     def _get_model_from_track(self):
         return get_model('cuff', self.kwargs['track'])
@@ -69,15 +73,36 @@ class QuerysetPlotView(ListView, PlotMixin):
     def get_queryset(self):
         self.model = self._get_model_from_track()
         self.exp = get_object_or_404(Experiment, pk=int(self.kwargs.get('exp_pk', '')))
-        return self.model._default_manager.for_exp(self.exp)
+        qs = self.model._default_manager.for_exp(self.exp)
+        region = self.request.GET.get('region', '').strip()
+        self.store = None if region else get_store(self.exp, self.kwargs['track'])
+        if region:
+            # Tracks overlapping 'chr:start-end' only
+            try:
+                qs = qs.filter(region_filter(self.model, region))
+            except ValueError:
+                qs = qs.none()
+        return qs
+        
+    def restoring_response(self, request, exp):
+        return HttpResponse('Experiment {0} is being restored'.format(exp.pk),
+            content_type='text/plain', status=503)
         
     def get_dataframe(self, sample=None):
         '''
         Builds a pandas dataframe by retrieving the fields specified
-        in self.data_fields from self.queryset.
+        in self.data_fields from self.queryset, or from the matrix
+        store of the experiment if the plot isn't filtered.
         '''
         opts = self.model._meta
         fields = [f for f in opts.get_all_field_names() if f in self.data_fields]
+        if (sample is not None and self.store is not None
+                and all(f in self.store for f in fields)):
+            # Columns of the memory-mapped matrices, tracks without
+            # data for the sample are NaN
+            column = self.store.column(sample.pk)
+            df = pd.DataFrame(dict((f, self.store[f][:, column]) for f in fields))
+            return df.dropna(how='all')
         if sample is None:
             values_dict = self.object_list.values(*fields)
         else:
@@ -99,7 +124,7 @@ class BarPlotView(QuerysetPlotView):
         return get_model('cuff', '{0}Data'.format(track))
     
     def _get_gene_short_names(self):
-        gene_name_field = 'gene__gene_short_name'
+        gene_name_field = 'gene__annotation__gene_short_name'
         track = self.kwargs['track'].lower()
         if track == 'tss':
             gene_name_field = 'tss_group__{0}'.format(gene_name_field)
@@ -110,6 +135,7 @@ class BarPlotView(QuerysetPlotView):
     def get_queryset(self):
         qs = super(BarPlotView, self).get_queryset()
         if self.pk_list:
+            self.store = None
             return qs.filter(pk__in=self.pk_list)
         else:
             return qs
@@ -148,7 +174,7 @@ class BarPlotView(QuerysetPlotView):
                 alpha=0.45)
         
         plt.xticks(np.arange(self.object_list.count() // num_exp),
-            [name for i,name in enumerate(gene_names) if i % num_exp == 0])
+            [name or '' for i,name in enumerate(gene_names) if i % num_exp == 0])
         plt.legend()
         plt.tight_layout()
         rstyle(ax)
@@ -168,6 +194,17 @@ class VolcanoPlotView(QuerysetPlotView):
             diff_data = 'ExpDiffData'
         return get_model('cuff', '{0}{1}'.format(track, diff_data))
 
+    def get_queryset(self):
+        qs = super(VolcanoPlotView, self).get_queryset()
+        comparison = self.request.GET.get('comparison', '').strip()
+        if comparison:
+            # Rows of a single sample pair, see cuff.models.Comparison
+            try:
+                qs = qs.filter(comparison=int(comparison))
+            except ValueError:
+                raise Http404
+        return qs
+
     def make_plot(self):
         if self.kwargs['track'] in ['splicing', 'promoter', 'relcds']:
             x_field = 'js_dist'
@@ -0,0 +1,109 @@
+/*
+ * Virtual scrolling of the track tables.
+ *
+ * Turns the rows of a `table[data-json]` into a scrolling window. The
+ * page comes with the first window of rows (a keyset page) and the
+ * cursor after it in `data-next`; the following rows are loaded from
+ * the JSON view of the track (see cuff.views.TrackJSONView) a window at
+ * a time as the table is scrolled down. Only the rows in sight are in
+ * the page, the rest is padding of the same height.
+ *
+ * Included by the track pages only when CUFF_TRACK_SCROLL is on.
+ */
+(function ($) {
+    'use strict';
+
+    // Rows requested at once
+    var WINDOW = 200;
+    // Rows rendered above and below the visible ones
+    var BUFFER = 20;
+    // Height of the scrolling table, pixels
+    var HEIGHT = 600;
+
+    function escape(value) {
+        if (value === null || value === undefined) {
+            return 'None';
+        }
+        return String(value).replace(/&/g, '&amp;').replace(/</g, '&lt;')
+            .replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+    }
+
+    function TrackScroller(table) {
+        this.table = table;
+        this.url = table.data('json');
+        this.tbody = table.find('tbody');
+        this.width = table.find('thead th').length;
+        this.rowHeight = this.tbody.find('tr').first().outerHeight() || 37;
+        // Rendered rows, the first window comes with the page
+        this.rows = this.tbody.children('tr').map(function () {
+            return this.outerHTML;
+        }).get();
+        this.next = table.attr('data-next') ? {cursor: table.attr('data-next')} : null;
+        this.loading = false;
+        this.box = $('<div class="track-scroll"></div>').css({
+            'max-height': HEIGHT, 'overflow-y': 'auto'});
+        table.wrap(this.box);
+        this.box = table.parent();
+        table.parent().siblings('.pagination').hide();
+        this.count = table.parent().siblings('p.muted');
+        this.box.on('scroll', $.proxy(this.update, this));
+        this.update();
+    }
+
+    TrackScroller.prototype.load = function () {
+        if (this.loading || this.next === null) {
+            return;
+        }
+        this.loading = true;
+        var url = this.url + (this.url.indexOf('?') < 0 ? '?' : '&') +
+            $.param($.extend({limit: WINDOW}, this.next));
+        $.getJSON(url).done($.proxy(function (data) {
+            var columns = data.columns, i, j, row;
+            for (i = 0; columns.length && i < columns[0].length; i++) {
+                row = [];
+                for (j = 0; j < columns.length; j++) {
+                    row.push(escape(columns[j][i]));
+                }
+                this.rows.push('<tr><td>' + row.join('</td><td>') + '</td></tr>');
+            }
+            this.next = data.next;
+            if (data.count) {
+                this.count.text(data.count.text + ' rows');
+            }
+            this.loading = false;
+            this.update();
+        }, this)).fail($.proxy(function () {
+            // Stop loading, the rows loaded so far stay
+            this.next = null;
+            this.loading = false;
+        }, this));
+    };
+
+    TrackScroller.prototype.padding = function (rows) {
+        return rows > 0 ? '<tr><td colspan="' + this.width + '" style="height: ' +
+            rows * this.rowHeight + 'px; padding: 0; border: 0;"></td></tr>' : '';
+    };
+
+    TrackScroller.prototype.update = function () {
+        var top = this.box.scrollTop() - this.table.find('thead').outerHeight(),
+            visible = Math.ceil(this.box.height() / this.rowHeight),
+            first = Math.max(Math.min(Math.floor(top / this.rowHeight) - BUFFER,
+                this.rows.length - visible - BUFFER), 0),
+            last = Math.min(first + visible + 2 * BUFFER, this.rows.length),
+            html = [this.padding(first)], i;
+        for (i = first; i < last; i++) {
+            html.push(this.rows[i]);
+        }
+        html.push(this.padding(this.rows.length - last));
+        this.tbody.html(html.join(''));
+        if (last + BUFFER >= this.rows.length) {
+            this.load();
+        }
+    };
+
+    $(function () {
+        $('table[data-json]').each(function () {
+            new TrackScroller($(this));
+        });
+    });
+}(jQuery));